@@ -69,6 +69,13 @@ resource "aws_secretsmanager_secret_version" "SecretsManagerSecret" {
     sns_arn_l3  = "${aws_sns_topic.SNSTopicLargeFileInit.arn}"
     sns_arn_l4  = "${aws_sns_topic.SNSTopicLargeFilePart.arn}"
     sns_arn_l5  = "${aws_sns_topic.SNSTopicLargeFileRecomb.arn}"
+    trackerTable = "${aws_dynamodb_table.UploadTrackerTable.name}"
+    governorTable = "${aws_dynamodb_table.GovernorTable.name}"
+    sqs_url_l2 = "${aws_sqs_queue.SQSQueueDownload.url}"
+    sqs_url_l3 = "${aws_sqs_queue.SQSQueueLargeFileInit.url}"
+    sqs_url_l4_retry = "${aws_sqs_queue.SQSQueueLargeFilePartRetry.url}"
+    sqs_url_events = "${aws_sqs_queue.SQSQueueBlobEvents.url}"
+    sns_arn_dlq = "${aws_sns_topic.SNSTopicDeadLetterQueue.arn}"
   })
 }
 
@@ -88,6 +95,13 @@ resource "aws_secretsmanager_secret_version" "SecretsManagerSecret" {
 #     sns_arn_l3  = "${aws_sns_topic.SNSTopicLargeFileInit.arn}"
 #     sns_arn_l4  = "${aws_sns_topic.SNSTopicLargeFilePart.arn}"
 #     sns_arn_l5  = "${aws_sns_topic.SNSTopicLargeFileRecomb.arn}"
+#     trackerTable = "${aws_dynamodb_table.UploadTrackerTable.name}"
+#     governorTable = "${aws_dynamodb_table.GovernorTable.name}"
+#     sqs_url_l2 = "${aws_sqs_queue.SQSQueueDownload.url}"
+#     sqs_url_l3 = "${aws_sqs_queue.SQSQueueLargeFileInit.url}"
+#     sqs_url_l4_retry = "${aws_sqs_queue.SQSQueueLargeFilePartRetry.url}"
+#     sqs_url_events = "${aws_sqs_queue.SQSQueueBlobEvents.url}"
+#     sns_arn_dlq = "${aws_sns_topic.SNSTopicDeadLetterQueue.arn}"
 #   })
 # }
 
@@ -171,6 +185,57 @@ resource "aws_s3_bucket" "S3Bucket" {
   }
 }
 
+### Create DynamoDB table holding the shared Azure request rate (token bucket) of every storage account
+resource "aws_dynamodb_table" "GovernorTable" {
+  name         = format("%s%s%s%s", var.PrefixCode, "ddb", var.EnvironmentCode, "azs3copygovernor")
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "bucket"
+
+  attribute {
+    name = "bucket"
+    type = "S"
+  }
+  server_side_encryption {
+    enabled     = true
+    kms_key_arn = aws_kms_key.KMSKey.arn
+  }
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "ddb", var.EnvironmentCode, "azs3copygovernor"),
+    rtype = "storage"
+  }
+}
+
+### Create DynamoDB table tracking the parts of the large file multipart uploads
+resource "aws_dynamodb_table" "UploadTrackerTable" {
+  name         = format("%s%s%s%s", var.PrefixCode, "ddb", var.EnvironmentCode, "azs3copyuploads")
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "upload_id"
+  range_key    = "part"
+
+  attribute {
+    name = "upload_id"
+    type = "S"
+  }
+  attribute {
+    name = "part"
+    type = "N"
+  }
+  ttl {
+    attribute_name = "expires"
+    enabled        = true
+  }
+  server_side_encryption {
+    enabled     = true
+    kms_key_arn = aws_kms_key.KMSKey.arn
+  }
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "ddb", var.EnvironmentCode, "azs3copyuploads"),
+    rtype = "storage"
+  }
+}
+
 resource "aws_s3_bucket_policy" "S3Bucket" {
   bucket = aws_s3_bucket.S3Bucket.id
   policy = data.aws_iam_policy_document.S3Bucket.json
@@ -244,6 +309,20 @@ resource "aws_s3_bucket_versioning" "S3Bucket" {
   }
 }
 
+# Uploads left behind by failed copies stop being billed, the initiator resumes younger ones (reapAfterHours)
+resource "aws_s3_bucket_lifecycle_configuration" "S3Bucket" {
+  bucket = aws_s3_bucket.S3Bucket.id
+
+  rule {
+    id     = "AbortIncompleteMultipartUploads"
+    status = "Enabled"
+    filter {}
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 3
+    }
+  }
+}
+
 resource "aws_s3_bucket_public_access_block" "S3Bucket" {
   bucket                  = aws_s3_bucket.S3Bucket.id
   block_public_acls       = true
@@ -290,6 +369,7 @@ resource "aws_iam_role_policy" "LambdaIAM" {
           "s3:ListBucketMultipartUploads",
           "s3:ListMultipartUploadParts",
           "s3:AbortMultipartUpload",
+          "s3:DeleteObject",
           "s3:CreateBucket",
           "s3:Put*"
         ]
@@ -319,7 +399,46 @@ resource "aws_iam_role_policy" "LambdaIAM" {
         ]
         Effect = "Allow"
         Resource = [
-          "${aws_secretsmanager_secret.SecretsManagerSecret.arn}"
+          "${aws_secretsmanager_secret.SecretsManagerSecret.arn}",
+          # Account secrets of a multi account launcher
+          "arn:aws:secretsmanager:${var.Region}:${data.aws_caller_identity.current.account_id}:secret:${var.PrefixCode}sms${var.EnvironmentCode}azs3copy-*"
+        ]
+      },
+      {
+        Action = [
+          "dynamodb:PutItem",
+          "dynamodb:UpdateItem",
+          "dynamodb:Query",
+          "dynamodb:BatchWriteItem"
+        ]
+        Effect = "Allow"
+        Resource = [
+          "${aws_dynamodb_table.UploadTrackerTable.arn}"
+        ]
+      },
+      {
+        Action = [
+          "dynamodb:GetItem",
+          "dynamodb:PutItem"
+        ]
+        Effect = "Allow"
+        Resource = [
+          "${aws_dynamodb_table.GovernorTable.arn}"
+        ]
+      },
+      {
+        Action = [
+          "sqs:SendMessage",
+          "sqs:ReceiveMessage",
+          "sqs:DeleteMessage",
+          "sqs:GetQueueAttributes"
+        ]
+        Effect = "Allow"
+        Resource = [
+          "${aws_sqs_queue.SQSQueueDownload.arn}",
+          "${aws_sqs_queue.SQSQueueLargeFileInit.arn}",
+          "${aws_sqs_queue.SQSQueueLargeFilePartRetry.arn}",
+          "${aws_sqs_queue.SQSQueueBlobEvents.arn}"
         ]
       },
       {
@@ -414,6 +533,8 @@ resource "aws_lambda_function" "LambdaFunction01" {
   architectures                  = ["arm64"]
   handler                        = "blobcopy-launch-qualification.lambda_handler"
   kms_key_arn                    = aws_kms_key.KMSKey.arn
+  # Azure SDKs for the change feed check of the accounts
+  layers                         = [aws_lambda_layer_version.azure-arm-identity.arn, aws_lambda_layer_version.azure-arm-storage.arn]
   role                           = aws_iam_role.LambdaIAM.arn
   runtime                        = "python3.13"
   memory_size                    = 128
@@ -457,7 +578,7 @@ resource "aws_lambda_function" "LambdaFunction02" {
   runtime                        = "python3.13"
   memory_size                    = 2560
   timeout                        = 900
-  reserved_concurrent_executions = 1
+  reserved_concurrent_executions = var.FinderConcurrency
 
   ephemeral_storage {
     size = 512
@@ -589,6 +710,76 @@ resource "aws_lambda_function" "LambdaFunction06" {
   }
 }
 
+resource "aws_lambda_function" "LambdaFunction07" {
+  filename      = "../CFN/azs3copy-lambda07.zip"
+  function_name = format("%s%s%s%s", var.PrefixCode, "lmd", var.EnvironmentCode, "azs3copylambda07")
+  description   = "Azure Blob to Amazon S3 Copy Lambda07 (blobcopy-event-relay)"
+  architectures = ["arm64"]
+  handler       = "blobcopy-event-relay.lambda_handler"
+  kms_key_arn   = aws_kms_key.KMSKey.arn
+  role          = aws_iam_role.LambdaIAM.arn
+  runtime       = "python3.13"
+  memory_size   = 128
+  timeout       = 30
+
+  environment {
+    variables = {
+      secret = aws_secretsmanager_secret.SecretsManagerSecret.arn
+    }
+  }
+  ephemeral_storage {
+    size = 512
+  }
+  tracing_config {
+    mode = "Active"
+  }
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "lmd", var.EnvironmentCode, "azs3copylambda07")
+    rtype = "compute"
+  }
+}
+
+# Event Grid cannot sign requests, deliveries are checked against the eventGridKey secret instead
+resource "aws_lambda_function_url" "LambdaFunction07Url" {
+  function_name      = aws_lambda_function.LambdaFunction07.function_name
+  authorization_type = "NONE"
+}
+
+resource "aws_lambda_function" "LambdaFunction08" {
+  filename      = "../CFN/azs3copy-lambda08.zip"
+  function_name = format("%s%s%s%s", var.PrefixCode, "lmd", var.EnvironmentCode, "azs3copylambda08")
+  description   = "Azure Blob to Amazon S3 Copy Lambda08 (blobcopy-blob-events)"
+  architectures = ["arm64"]
+  handler       = "blobcopy-blob-events.lambda_handler"
+  kms_key_arn   = aws_kms_key.KMSKey.arn
+  layers        = [aws_lambda_layer_version.azure-arm-identity.arn, aws_lambda_layer_version.azure-arm-storage.arn]
+  role          = aws_iam_role.LambdaIAM.arn
+  runtime       = "python3.13"
+  memory_size   = 512
+  timeout       = 120
+
+  environment {
+    variables = {
+      secret               = aws_secretsmanager_secret.SecretsManagerSecret.arn
+      partitionSize        = var.PartitionSize
+      maxPartitionsPerFile = var.MaxPartitionsPerFile
+      UseFullFilePath      = var.UseFullFilePath
+    }
+  }
+  ephemeral_storage {
+    size = 512
+  }
+  tracing_config {
+    mode = "Active"
+  }
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "lmd", var.EnvironmentCode, "azs3copylambda08")
+    rtype = "compute"
+  }
+}
+
 ### Create SNS queues
 resource "aws_sns_topic" "SNSTopicL1L2" {
   name              = format("%s%s%s%s", var.PrefixCode, "sns", var.EnvironmentCode, "azs3copyL1_to_L2")
@@ -650,6 +841,141 @@ resource "aws_sns_topic" "SNSTopicDeadLetterQueue" {
   }
 }
 
+### Create SQS queues for delayed retries of large file parts
+resource "aws_sqs_queue" "SQSQueueLargeFilePartRetry" {
+  name                       = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyLargeFilePartRetry")
+  sqs_managed_sse_enabled    = true
+  visibility_timeout_seconds = 5400
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.SQSQueueLargeFilePartRetryDLQ.arn
+    maxReceiveCount     = 3
+  })
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyLargeFilePartRetry")
+    rtype = "messaging"
+  }
+}
+
+resource "aws_sqs_queue" "SQSQueueLargeFilePartRetryDLQ" {
+  name                      = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyLargeFilePartRetryDLQ")
+  sqs_managed_sse_enabled   = true
+  message_retention_seconds = 1209600
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyLargeFilePartRetryDLQ")
+    rtype = "messaging"
+  }
+}
+
+resource "aws_lambda_event_source_mapping" "LargeFilePartRetry" {
+  event_source_arn = aws_sqs_queue.SQSQueueLargeFilePartRetry.arn
+  function_name    = aws_lambda_function.LambdaFunction05.arn
+  batch_size       = 1
+}
+
+### Create SQS queues for the Azure Event Grid blob events
+resource "aws_sqs_queue" "SQSQueueBlobEvents" {
+  name                       = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyBlobEvents")
+  sqs_managed_sse_enabled    = true
+  visibility_timeout_seconds = 720
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.SQSQueueBlobEventsDLQ.arn
+    maxReceiveCount     = 5
+  })
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyBlobEvents")
+    rtype = "messaging"
+  }
+}
+
+resource "aws_sqs_queue" "SQSQueueBlobEventsDLQ" {
+  name                      = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyBlobEventsDLQ")
+  sqs_managed_sse_enabled   = true
+  message_retention_seconds = 1209600
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyBlobEventsDLQ")
+    rtype = "messaging"
+  }
+}
+
+resource "aws_lambda_event_source_mapping" "BlobEvents" {
+  event_source_arn                   = aws_sqs_queue.SQSQueueBlobEvents.arn
+  function_name                      = aws_lambda_function.LambdaFunction08.arn
+  batch_size                         = 10
+  maximum_batching_window_in_seconds = 1
+  function_response_types            = ["ReportBatchItemFailures"]
+}
+
+### Create SQS queues of the download and large file initiator functions (dispatchBackend sqs, delayed download retries)
+resource "aws_sqs_queue" "SQSQueueDownload" {
+  name                       = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyDownload")
+  sqs_managed_sse_enabled    = true
+  visibility_timeout_seconds = 5400
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.SQSQueueDownloadDLQ.arn
+    maxReceiveCount     = 5
+  })
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyDownload")
+    rtype = "messaging"
+  }
+}
+
+resource "aws_sqs_queue" "SQSQueueDownloadDLQ" {
+  name                      = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyDownloadDLQ")
+  sqs_managed_sse_enabled   = true
+  message_retention_seconds = 1209600
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyDownloadDLQ")
+    rtype = "messaging"
+  }
+}
+
+resource "aws_sqs_queue" "SQSQueueLargeFileInit" {
+  name                       = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyLargeFileInit")
+  sqs_managed_sse_enabled    = true
+  visibility_timeout_seconds = 5400
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.SQSQueueLargeFileInitDLQ.arn
+    maxReceiveCount     = 3
+  })
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyLargeFileInit")
+    rtype = "messaging"
+  }
+}
+
+resource "aws_sqs_queue" "SQSQueueLargeFileInitDLQ" {
+  name                      = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyLargeFileInitDLQ")
+  sqs_managed_sse_enabled   = true
+  message_retention_seconds = 1209600
+
+  tags = {
+    Name  = format("%s%s%s%s", var.PrefixCode, "sqs", var.EnvironmentCode, "azs3copyLargeFileInitDLQ")
+    rtype = "messaging"
+  }
+}
+
+resource "aws_lambda_event_source_mapping" "Download" {
+  event_source_arn                   = aws_sqs_queue.SQSQueueDownload.arn
+  function_name                      = aws_lambda_function.LambdaFunction03.arn
+  batch_size                         = 10
+  maximum_batching_window_in_seconds = 1
+  function_response_types            = ["ReportBatchItemFailures"]
+}
+
+resource "aws_lambda_event_source_mapping" "LargeFileInit" {
+  event_source_arn = aws_sqs_queue.SQSQueueLargeFileInit.arn
+  function_name    = aws_lambda_function.LambdaFunction04.arn
+  batch_size       = 1
+}
+
 resource "aws_sns_topic_subscription" "SNSSubscriptionL1L2" {
   topic_arn = aws_sns_topic.SNSTopicL1L2.arn
   protocol  = "lambda"
@@ -1019,4 +1345,9 @@ resource "aws_cloudwatch_dashboard" "CloudwatchDashboard" {
     ]
   }
 EOF
-}
\ No newline at end of file
+}
+
+output "EventGridWebhookUrl" {
+  description = "Endpoint of the Azure Event Grid subscription, append ?key=<eventGridKey secret>"
+  value       = aws_lambda_function_url.LambdaFunction07Url.function_url
+}
@@ -55,6 +55,11 @@ variable "BlobToS3SyncStartDate" {
   type        = string
   default     = "20220820"
 }
+variable "FinderConcurrency" {
+  description = "Finder invocations that may run at once. Raise it to the number of storage accounts the launcher starts in parallel"
+  type        = number
+  default     = 1
+}
 
 # Advanced Settings
 variable "PartitionSize" {
@@ -0,0 +1,81 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+# Part size planner benchmark over a table of blob sizes
+# For every size it reports the planned part size, part count, concurrency and estimated transfer time, the part
+# invocations per GB, and the same figures for the fixed partitionSize of the previous finders.
+# The planner call itself is timed, it runs once per large blob in the finders
+#
+#   python bench_part_planner.py
+#   python bench_part_planner.py --memory-mb 2056 --throughput 80 --overhead 0.5 --json planner.json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from blobcopy_planner import MIB, plan_parts
+
+GIB = 1024 * MIB
+
+# name, blob size in bytes
+SIZES = [
+    ('150 MiB', 150 * MIB),
+    ('1 GiB', GIB),
+    ('5 GiB', 5 * GIB),
+    ('50 GiB', 50 * GIB),
+    ('500 GiB', 500 * GIB),
+    ('1 TiB', 1024 * GIB),
+    ('5 TiB', 5 * 1024 * GIB),
+]
+
+# Fixed part size of the previous finders, with their maxPartitions adjustment (which divided by the ceiling)
+def previous_part_size(size, partition_size, max_partitions):
+    ceiling = partition_size * max_partitions
+    return int(math.ceil(size / ceiling)) if size > ceiling else partition_size
+
+def bench(args):
+    rows = []
+    print('%-8s %10s %7s %6s %9s %9s | %10s %10s' % ('blob', 'part MiB', 'parts', 'conc', 'est s', 'parts/GB', 'prev parts', 'plan us'))
+    for name, size in SIZES:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            plan = plan_parts(size, args.memory_mb, args.throughput, args.overhead, args.timeout,
+                              args.max_parts, args.max_concurrency, args.partition_size)
+        plan_us = (time.perf_counter() - start) / args.repeat * 1000000
+        previous = previous_part_size(size, args.partition_size, args.max_parts)
+        row = {
+            'blob': name,
+            'size': size,
+            'part_size': plan.part_size,
+            'part_count': plan.part_count,
+            'concurrency': plan.concurrency,
+            'seconds': plan.seconds,
+            'parts_per_gb': round(plan.part_count / (size / GIB), 2),
+            'previous_part_size': previous,
+            'previous_part_count': int(math.ceil(size / previous)),
+            'plan_us': round(plan_us, 2),
+        }
+        rows.append(row)
+        print('%-8s %10.1f %7d %6d %9.1f %9.2f | %10d %10.2f' % (
+            name, plan.part_size / MIB, plan.part_count, plan.concurrency, plan.seconds, row['parts_per_gb'],
+            row['previous_part_count'], row['plan_us']))
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Part size planner benchmark over a range of blob sizes')
+    parser.add_argument('--memory-mb', type=int, default=2048, help='memory of the large file part function')
+    parser.add_argument('--throughput', type=float, default=50.0, help='measured MiB/s of one part')
+    parser.add_argument('--overhead', type=float, default=1.0, help='fixed seconds per part (invocation, SNS hop, requests)')
+    parser.add_argument('--timeout', type=int, default=900, help='timeout of the large file part function')
+    parser.add_argument('--max-parts', type=int, default=10000, help='maxPartitionsPerFile')
+    parser.add_argument('--max-concurrency', type=int, default=1000, help='part functions that can run at once')
+    parser.add_argument('--partition-size', type=int, default=100 * MIB, help='partitionSize, the smallest part')
+    parser.add_argument('--repeat', type=int, default=10000, help='planner calls timed per blob size')
+    parser.add_argument('--json', help='also write the results to this json file')
+    args = parser.parse_args()
+
+    output = bench(args)
+    if args.json:
+        with open(args.json, 'w') as result_file:
+            json.dump(output, result_file, indent=2)
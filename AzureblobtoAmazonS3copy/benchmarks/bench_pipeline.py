@@ -0,0 +1,297 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# End to end throughput benchmark of the copy pipeline
+# The lambda handlers run in-process against Azurite (Azure) and moto (S3 and Secrets Manager), the SNS topics
+# between the functions are replaced by the in-memory bus of blobcopy_local. A synthetic workload is uploaded to
+# Azurite, the launcher starts a run and the bus is drained stage by stage until every blob is copied. Retried
+# messages are held back for their backoff like in the pipeline. Reported per stage: invocations,
+# latency percentiles and the AWS and Azure requests made, overall MB/s and requests per GB.
+# With --baseline the run fails (exit code 1) when MB/s or requests per GB regress by more than --tolerance
+#
+#   azurite-blob --silent &
+#   python bench_pipeline.py --workload mixed --json mixed.json
+#   python bench_pipeline.py --workload tiny --set packBlobs=1 --baseline mixed.json
+#   python bench_pipeline.py --workload huge --set parallelCopyMaxSize=67108864 --set partitionSize=16777216
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+from bench_startup import percentile
+from blobcopy_local import STAGES, LambdaContext, MessageBus, load_handler
+
+KIB = 1024
+MIB = 1024 * KIB
+GIB = 1024 * MIB
+
+AZURITE = ('DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;'
+           'AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;'
+           'BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;')
+
+# Blob size distributions, (count, size) - every size is drawn between half and the full size
+WORKLOADS = {
+    'tiny': [(5000, 4 * KIB)],
+    'small': [(1000, 256 * KIB)],
+    'mixed': [(1000, 16 * KIB), (200, 1 * MIB), (20, 32 * MIB), (2, 256 * MIB)],
+    'huge': [(2, 1 * GIB)],
+}
+
+# Request counts by stage, the bench runs one stage at a time so the current stage is global
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage = 'launch'
+        self.requests = {}
+        self.latencies = {}
+
+    def count(self, api):
+        with self.lock:
+            stage = self.requests.setdefault(self.stage, {})
+            stage[api] = stage.get(api, 0) + 1
+
+    def latency(self, stage, ms):
+        with self.lock:
+            self.latencies.setdefault(stage, []).append(ms)
+
+    # botocore before-call event, registered on the default session before any client is created
+    def on_aws_call(self, model, **kwargs):
+        self.count(model.service_model.service_name + '.' + model.name)
+
+# Readable of repeated random bytes, large blobs are uploaded without holding them in memory
+class SyntheticBlob:
+
+    def __init__(self, block, size):
+        self.block = block
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+        start = self.position % len(self.block)
+        data = (self.block[start:] + self.block * (size // len(self.block) + 1))[:size]
+        self.position += size
+        return data
+
+def workload_blobs(name, scale, seed):
+    rng = random.Random(seed)
+    blobs = []
+    for count, size in WORKLOADS[name]:
+        for _ in range(max(1, int(count * scale))):
+            blobs.append(('bench/%s/%08d.bin' % (name, len(blobs)), rng.randint(max(1, size // 2), size)))
+    return blobs
+
+def azure_client(connection_string, stats, **hooks):
+    from azure.core.pipeline.policies import SansIOHTTPPolicy
+    from azure.storage.blob import BlobServiceClient
+
+    class CountingPolicy(SansIOHTTPPolicy):
+        def on_request(self, request):
+            query = request.http_request.query
+            stats.count('azure.' + request.http_request.method + ' ' + query.get('comp', query.get('restype', 'blob')))
+
+    return BlobServiceClient.from_connection_string(connection_string, per_call_policies=[CountingPolicy()], **hooks)
+
+def upload_workload(blob_service_client, container, blobs, concurrency):
+    container_client = blob_service_client.get_container_client(container)
+    if not container_client.exists():
+        container_client.create_container()
+    block = os.urandom(4 * MIB)
+    def upload(blob):
+        container_client.upload_blob(blob[0], SyntheticBlob(block, blob[1]), length=blob[1], overwrite=True, max_concurrency=4)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(upload, blobs))
+
+def bench_config(args, workdir):
+    config = {
+        'isactive': 'true',
+        'begindate': '1911-01-01 00:00:00',
+        'tenantid': 'bench', 'appid': 'bench', 'appsecret': 'bench',
+        'bloburl': args.azure_url,
+        'bucket_name': args.bucket,
+        'sns_arn_l1': 'sns_arn_l1', 'sns_arn_l2': 'sns_arn_l2', 'sns_arn_l3': 'sns_arn_l3',
+        'sns_arn_l4': 'sns_arn_l4', 'sns_arn_l5': 'sns_arn_l5',
+        'includePrefixes': 'bench/' + args.workload + '/',
+        'parallelCopyMaxSize': str(128 * MIB),
+        'trackerStore': 'sqlite',
+        'trackerPath': os.path.join(workdir, 'tracker.db'),
+        'reapIncompleteUploads': 'false',
+    }
+    for setting in args.set or []:
+        key, value = setting.split('=', 1)
+        config[key] = value
+    return config
+
+def invoke(module, stage, memory_mb, records, stats):
+    start = time.perf_counter()
+    try:
+        module.lambda_handler({'Records': records}, LambdaContext(memory_mb))
+    finally:
+        stats.latency(stage, (time.perf_counter() - start) * 1000)
+
+# Sns records one message at a time, download batches as SQS records like an SQS event source with BatchSize
+def stage_events(stage, messages, download_batch):
+    if stage == 'download' and download_batch > 1:
+        return [[{'messageId': str(uuid.uuid4()), 'body': message} for message in messages[i:i + download_batch]]
+                for i in range(0, len(messages), download_batch)]
+    return [[{'Sns': {'Message': message}}] for message in messages]
+
+# Retries are held back by the bus for their backoff, the bench waits for them when no stage has messages
+def drain(bus, stats, handlers, workers, download_batch):
+    while bus.pending():
+        taken = False
+        for stage, _, topic, memory_mb in STAGES:
+            messages = bus.take(topic)
+            if not messages:
+                continue
+            taken = True
+            stats.stage = stage
+            with ThreadPoolExecutor(max_workers=1 if stage == 'find' else workers) as pool:
+                futures = [pool.submit(invoke, handlers[stage], stage, memory_mb, records, stats)
+                           for records in stage_events(stage, messages, download_batch)]
+                for future in futures:
+                    future.result()
+        if not taken:
+            bus.wait(0.1)
+
+def copied_objects(s3, bucket, prefix):
+    objects = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            objects[item['Key']] = item['Size']
+    return objects
+
+def report(args, blobs, seconds, stats, objects):
+    total = sum(size for _, size in blobs)
+    gb = total / GIB
+    result = {
+        'workload': args.workload,
+        'settings': args.set or [],
+        'blobs': len(blobs),
+        'bytes': total,
+        'seconds': round(seconds, 2),
+        'mbps': round(total / MIB / seconds, 2) if seconds else 0.0,
+        'missing': sum(1 for name, size in blobs if objects.get(name) != size),
+        'stages': {},
+    }
+    print('%-10s %8s %9s %9s %9s %10s %12s' % ('stage', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'requests', 'requests/GB'))
+    for stage in ['launch'] + [stage[0] for stage in STAGES]:
+        latencies = stats.latencies.get(stage, [])
+        requests = stats.requests.get(stage, {})
+        if not latencies and not requests:
+            continue
+        row = {
+            'invocations': len(latencies),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'requests': dict(sorted(requests.items())),
+            'requests_total': sum(requests.values()),
+            'requests_per_gb': round(sum(requests.values()) / gb, 1) if gb else 0.0,
+        }
+        result['stages'][stage] = row
+        print('%-10s %8d %9.1f %9.1f %9.1f %10d %12.1f' % (
+            stage, row['invocations'], row['p50_ms'], row['p95_ms'], row['p99_ms'], row['requests_total'], row['requests_per_gb']))
+    result['requests_per_gb'] = round(sum(row['requests_total'] for row in result['stages'].values()) / gb, 1) if gb else 0.0
+    print('blobs: %d  GiB: %.2f  seconds: %.1f  MB/s: %.1f  requests/GB: %.1f  missing: %d' % (
+        len(blobs), gb, seconds, result['mbps'], result['requests_per_gb'], result['missing']))
+    return result
+
+# Regressions against a previous result of the same workload
+def regressions(result, baseline, tolerance):
+    found = []
+    if result['mbps'] < baseline['mbps'] * (1 - tolerance):
+        found.append('MB/s %.1f < baseline %.1f' % (result['mbps'], baseline['mbps']))
+    for stage, row in result['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if previous and row['requests_per_gb'] > previous['requests_per_gb'] * (1 + tolerance):
+            found.append('%s requests/GB %.1f > baseline %.1f' % (stage, row['requests_per_gb'], previous['requests_per_gb']))
+    if result['missing']:
+        found.append('%d blobs missing or of the wrong size in S3' % result['missing'])
+    return found
+
+def bench(args):
+    import boto3
+    from moto import mock_aws
+    import blobcopy_clients
+    from blobcopy_governor import get_governor
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    stats = Stats()
+    blobs = workload_blobs(args.workload, args.scale, args.seed)
+    print('Uploading %d blobs (%.2f GiB) to Azurite' % (len(blobs), sum(size for _, size in blobs) / GIB))
+    upload_workload(azure_client(args.azurite, Stats()), args.container, blobs, args.workers)
+
+    with mock_aws(), tempfile.TemporaryDirectory() as workdir:
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register('before-call', stats.on_aws_call)
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=args.bucket)
+        config = bench_config(args, workdir)
+        secret_arn = boto3.client('secretsmanager').create_secret(Name='azs3copy-bench', SecretString=json.dumps(config))['ARN']
+        os.environ.update({'secret': secret_arn, 'partitionSize': config.get('partitionSize', '104857600'),
+                           'maxPartitionsPerFile': config.get('maxPartitionsPerFile', '10000'), 'UseFullFilePath': 'true'})
+
+        # The handlers get the bus and the Azurite client from the client cache of a warm container
+        bus = MessageBus(on_call=stats.count)
+        blobcopy_clients.clients[('boto3', 'sns')] = bus
+        azure_key = ('azure', 'bench', 'bench', hashlib.sha256(b'bench').hexdigest(), config['bloburl'])
+        blobcopy_clients.clients[azure_key + (False,)] = azure_client(args.azurite, stats)
+        # With governorStore=sqlite the handlers use the client with the governor hooks
+        governor = get_governor(dict(config, oauth_url=config['bloburl']))
+        if governor is not None:
+            blobcopy_clients.clients[azure_key + (True,)] = azure_client(
+                args.azurite, stats, raw_request_hook=governor.before_request, raw_response_hook=governor.after_response)
+
+        handlers = {stage: load_handler(name) for stage, name, _, _ in STAGES if name}
+        handlers['find'] = load_handler(args.finder)
+        launch = load_handler('blobcopy-launch-qualification')
+        start = time.perf_counter()
+        invoke(launch, 'launch', 128, [], stats)
+        drain(bus, stats, handlers, args.workers, args.download_batch)
+        seconds = time.perf_counter() - start
+        stats.stage = 'verify'
+        objects = copied_objects(s3, args.bucket, 'bench/' + args.workload + '/')
+    return report(args, blobs, seconds, stats, objects)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput benchmark of the copy pipeline against Azurite and moto')
+    parser.add_argument('--workload', choices=sorted(WORKLOADS), default='mixed', help='blob size distribution')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the blob counts of the workload')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the blob sizes')
+    parser.add_argument('--finder', default='blobcopy-find-blobs', choices=['blobcopy-find-blobs', 'blobcopy-find-blobs-optimized'])
+    parser.add_argument('--workers', type=int, default=16, help='invocations of a stage that run at once')
+    parser.add_argument('--download-batch', type=int, default=1, help='deliver download messages as SQS batches of this size')
+    parser.add_argument('--set', action='append', metavar='KEY=VALUE', help='configuration value, e.g. partitionSize=16777216, can be repeated')
+    parser.add_argument('--azurite', default=os.environ.get('AZURITE_CONNECTION_STRING', AZURITE), help='Azurite connection string')
+    parser.add_argument('--azure-url', default='http://127.0.0.1:10000/devstoreaccount1', help='blob endpoint of the Azurite account')
+    parser.add_argument('--container', default='azs3copy-bench')
+    parser.add_argument('--bucket', default='azs3copy-bench')
+    parser.add_argument('--baseline', help='previous --json result to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed regression against the baseline')
+    parser.add_argument('--json', help='also write the results to this json file')
+    args = parser.parse_args()
+
+    output = bench(args)
+    if args.json:
+        with open(args.json, 'w') as result_file:
+            json.dump(output, result_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            found = regressions(output, json.load(baseline_file), args.tolerance)
+        for regression in found:
+            print('Regression: ' + regression)
+        if found:
+            sys.exit(1)
@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+# Startup benchmark for the copy lambdas
+#   local mode  - imports every handler in a fresh interpreter (like a cold start) and reports the import time
+#                 percentiles plus the slowest modules reported by python -X importtime
+#   logs mode   - reads the REPORT lines of the deployed functions from CloudWatch Logs and reports
+#                 the p50/p99 of Init Duration and Duration, e.g. after a fan-out burst
+#
+# Local mode imports the handlers for real, so it needs boto3 and the packages of the Azure layers installed, as in
+# the Lambda image (public.ecr.aws/lambda/python:3.13 with the layer requirements). Handlers whose imports fail are
+# reported as skipped with the missing module
+#
+#   python bench_startup.py --runs 20
+#   python bench_startup.py --log-group /aws/lambda/etllmddvazs3copylambda05 --hours 24
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+HANDLERS = [
+    'blobcopy-launch-qualification',
+    'blobcopy-find-blobs',
+    'blobcopy-find-blobs-optimized',
+    'blobcopy-download',
+    'blobcopy-large-file-initiator',
+    'blobcopy-large-file-part',
+    'blobcopy-large-file-recombinator',
+    'blobcopy-blob-events',
+    'blobcopy-event-relay',
+    # Not a lambda, its imports delay the first copies of a backfill run
+    'blobcopy-backfill',
+]
+
+IMPORT_HANDLER = '''
+import importlib.util, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('handler', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print((time.perf_counter() - start) * 1000)
+'''
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+# Import a handler in a new interpreter, returns (import ms, process ms, importtime stderr)
+def import_once(handler, importtime=False):
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', IMPORT_HANDLER, os.path.join(SRC, handler + '.py')]
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=SRC, capture_output=True, text=True, env=dict(os.environ, PYTHONPATH=SRC))
+    process_ms = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(handler + ': ' + result.stderr.strip().splitlines()[-1])
+    return float(result.stdout.strip().splitlines()[-1]), process_ms, result.stderr
+
+# Top level packages by cumulative import time from the -X importtime output
+def slowest_imports(stderr, top):
+    packages = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', line)
+        if match and len(match.group(2)) <= 1:
+            package = match.group(3).split('.')[0]
+            packages[package] = packages.get(package, 0) + int(match.group(1)) / 1000.0
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+def bench_local(runs, top):
+    results = {}
+    print('%-36s %10s %10s %10s %12s' % ('handler', 'p50 ms', 'p99 ms', 'max ms', 'process p50'))
+    for handler in HANDLERS:
+        try:
+            samples = [import_once(handler) for _ in range(runs)]
+        except RuntimeError as error:
+            print('%-36s skipped - %s' % (handler, error))
+            continue
+        imports = [sample[0] for sample in samples]
+        processes = [sample[1] for sample in samples]
+        slowest = slowest_imports(import_once(handler, importtime=True)[2], top)
+        results[handler] = {
+            'import_p50_ms': round(statistics.median(imports), 1),
+            'import_p99_ms': round(percentile(imports, 99), 1),
+            'import_max_ms': round(max(imports), 1),
+            'process_p50_ms': round(statistics.median(processes), 1),
+            'slowest_imports_ms': [[name, round(ms, 1)] for name, ms in slowest],
+        }
+        print('%-36s %10.1f %10.1f %10.1f %12.1f   %s' % (
+            handler, results[handler]['import_p50_ms'], results[handler]['import_p99_ms'], results[handler]['import_max_ms'],
+            results[handler]['process_p50_ms'], ', '.join('%s %.0f' % item for item in slowest)))
+    if not results:
+        print('No handler could be imported, run the benchmark where boto3 and the Azure SDK layers are installed')
+    return results
+
+# p50/p99 of Init Duration (cold starts only) and Duration from the lambda REPORT log lines
+def bench_logs(log_group, hours):
+    from boto3 import client as Client
+    logs = Client('logs')
+    init, duration = [], []
+    paginator = logs.get_paginator('filter_log_events')
+    start = int((time.time() - hours * 3600) * 1000)
+    for page in paginator.paginate(logGroupName=log_group, startTime=start, filterPattern='REPORT RequestId'):
+        for event in page['events']:
+            match = re.search(r'\tDuration: ([\d.]+) ms', event['message'])
+            if match:
+                duration.append(float(match.group(1)))
+            match = re.search(r'Init Duration: ([\d.]+) ms', event['message'])
+            if match:
+                init.append(float(match.group(1)))
+    result = {
+        'log_group': log_group,
+        'invocations': len(duration),
+        'cold_starts': len(init),
+        'init_p50_ms': percentile(init, 50),
+        'init_p99_ms': percentile(init, 99),
+        'duration_p50_ms': percentile(duration, 50),
+        'duration_p99_ms': percentile(duration, 99),
+    }
+    print(json.dumps(result, indent=2))
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time and init duration benchmark for the copy lambdas')
+    parser.add_argument('--runs', type=int, default=10, help='cold imports per handler in local mode')
+    parser.add_argument('--top', type=int, default=3, help='slowest top level imports to show per handler')
+    parser.add_argument('--log-group', action='append', help='CloudWatch log group of a deployed function, can be repeated')
+    parser.add_argument('--hours', type=float, default=24, help='how far back to read REPORT lines in logs mode')
+    parser.add_argument('--json', help='also write the results to this json file')
+    args = parser.parse_args()
+
+    if args.log_group:
+        output = [bench_logs(log_group, args.hours) for log_group in args.log_group]
+    else:
+        output = bench_local(args.runs, args.top)
+    if args.json:
+        with open(args.json, 'w') as result_file:
+            json.dump(output, result_file, indent=2)
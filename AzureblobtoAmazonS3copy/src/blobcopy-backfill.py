@@ -0,0 +1,225 @@
+import argparse
+import json
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from blobcopy_clients import clients, get_client
+from blobcopy_local import STAGES, LambdaContext, MessageBus, load_handler
+from blobcopy_manifest import flush_copied
+from blobcopy_message import config_cache, unpack_message
+
+# Single host backfill runner
+# Runs the finder, download, large file initiator, part and recombinator handlers in one process, for first time
+# copies of large accounts from an EC2 host. The SNS topics between the functions are replaced by the in-memory
+# bus of blobcopy_local, every stage runs on its own bounded thread pool and all stages run at the same time.
+# Objects are written to S3 by the same handler code as the lambdas. Retries of failed parts and blobs keep the
+# backoff of the retry scheduler, handler errors are retried like asynchronous lambda invocations (twice) and then
+# reported as failed. The run configuration is pinned in the configuration cache, continuations of the finder keep it.
+# Only bytes of blobs and parts their invocation did not send back for a retry are counted as copied.
+#
+#   python blobcopy-backfill.py --secret <secret arn> --download-workers 64 --part-workers 32
+#   python blobcopy-backfill.py --config backfill.json --finder blobcopy-find-blobs-optimized --progress-seconds 30
+
+# Async lambda invocations are retried twice before the event is dropped
+INVOCATION_ATTEMPTS = 3
+
+class Progress:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = {}
+        self.bytes = 0
+        self.failed = []
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def copied(self, size):
+        with self.lock:
+            self.bytes += size
+
+    def report(self, queue, inflight):
+        with self.lock:
+            seconds = time.time() - self.started
+            counts = dict(self.counts)
+            copied = self.bytes
+        print(json.dumps({
+            'backfill': {
+                'seconds': round(seconds, 1),
+                'invocations': counts,
+                'bytes': copied,
+                'mbps': round(copied / 1048576 / seconds, 2) if seconds else 0.0,
+                'inflight': inflight,
+                'queued': queue.pending(),
+                'dead_letters': len(queue.dead_letters),
+                'failed': len(self.failed)
+            }
+        }))
+
+# Bytes a message copied, taken from the messages its invocation published on the bus. The handlers hand failed
+# copies to their retries instead of raising, so the blobs and parts sent back to their own topic or to the dead
+# letter topic did not copy. Large files count by their uploaded parts
+def copied_bytes(stage, values, sent, home, dead_letter):
+    returned = []
+    for topic, message in sent:
+        if topic == home:
+            returned.append(json.loads(message))
+        elif topic == dead_letter:
+            returned.append(json.loads(message).get('message', {}))
+    if stage == 'download':
+        failed = {(item.get('container'), item.get('blob')) for message in returned for item in unpack_message(message)}
+        return sum(item.get('size', 0) for item in unpack_message(values) if (item.get('container'), item.get('blob')) not in failed)
+    if stage == 'part':
+        return 0 if returned else values.get('bytesToDownload', 0)
+    return 0
+
+class Runner:
+
+    def __init__(self, args, values, queue):
+        self.args = args
+        self.values = values
+        self.queue = queue
+        self.progress = Progress()
+        self.handlers = {stage: load_handler(name or args.finder) for stage, name, _, _ in STAGES}
+        workers = {'find': args.find_workers, 'download': args.download_workers, 'initiate': args.initiate_workers,
+                   'part': args.part_workers, 'recombine': args.initiate_workers}
+        self.pools = {stage: ThreadPoolExecutor(max_workers=workers[stage]) for stage, _, _, _ in STAGES}
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.running = {stage: 0 for stage, _, _, _ in STAGES}
+        self.topics = {stage: values[topic] for stage, _, topic, _ in STAGES}
+        # Messages published by the invocation running on a thread
+        self.local = threading.local()
+        queue.on_publish = self.published
+
+    def published(self, topic, message):
+        sent = getattr(self.local, 'sent', None)
+        if sent is not None:
+            sent.append((topic, message))
+
+    def invoke(self, stage, message):
+        try:
+            for attempt in range(INVOCATION_ATTEMPTS):
+                try:
+                    self.local.sent = []
+                    self.handlers[stage].lambda_handler({'Records': [{'Sns': {'Message': message}}]},
+                                                        LambdaContext(self.args.memory_mb, self.args.timeout))
+                    self.progress.add(stage)
+                    self.progress.copied(copied_bytes(stage, json.loads(message), self.local.sent, self.topics[stage], self.values.get('sns_arn_dlq')))
+                    return
+                except Exception as error:
+                    print("Invocation failed - stage: ", stage, ' attempt: ', attempt + 1, ' error: ', error)
+                finally:
+                    self.local.sent = None
+            with self.progress.lock:
+                self.progress.failed.append({'stage': stage, 'message': message})
+        finally:
+            with self.lock:
+                self.running[stage] -= 1
+            self.queue.notify()
+
+    def run(self):
+        self.queue.publish(TargetArn=self.values['sns_arn_l1'], Message=json.dumps({'default': json.dumps(self.values)}), MessageStructure='json')
+        last_report = time.time()
+        while True:
+            submitted = 0
+            for stage, _, topic, _ in STAGES:
+                # Only take what the stage can start now, the rest stays queued
+                with self.lock:
+                    free = self.workers[stage] - self.running[stage]
+                for message in self.queue.take(self.values[topic], free) if free > 0 else []:
+                    with self.lock:
+                        self.running[stage] += 1
+                    self.pools[stage].submit(self.invoke, stage, message)
+                    submitted += 1
+            with self.lock:
+                inflight = sum(self.running.values())
+            if time.time() - last_report >= self.args.progress_seconds:
+                self.progress.report(self.queue, inflight)
+                last_report = time.time()
+            if not submitted and not inflight and not self.queue.pending():
+                break
+            if not submitted:
+                self.queue.wait(0.5)
+        for pool in self.pools.values():
+            pool.shutdown()
+        # Copies recorded in the inventory manifest are buffered like in a warm lambda container
+        flush_copied()
+        self.progress.report(self.queue, 0)
+        return not self.progress.failed and not self.queue.dead_letters
+
+# Stand-in of the secret for runs from a config file, the finder writes the new begindate back to the file
+# so the next run only copies what changed
+class LocalSecret:
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_secret_value(self, SecretId):
+        with open(self.path) as config_file:
+            return {'SecretString': config_file.read()}
+
+    def update_secret(self, SecretId, SecretString):
+        with open(self.path, 'w') as config_file:
+            config_file.write(SecretString)
+        return {}
+
+# Configuration of the run, the same values the launcher publishes to the finder
+def run_values(args):
+    secret_arn = args.secret or args.config
+    secrets = json.loads(get_client('secretsmanager').get_secret_value(SecretId=secret_arn)['SecretString'])
+    for setting in args.set or []:
+        key, value = setting.split('=', 1)
+        secrets[key] = value
+    # Every hop goes through the in-memory bus of this process, retries included
+    secrets['dispatchBackend'] = 'sns'
+    for key in ('sqs_url_l2', 'sqs_url_l3', 'sqs_url_l4_retry'):
+        secrets.pop(key, None)
+    for stage, _, topic, _ in STAGES:
+        secrets.setdefault(topic, 'backfill-' + stage)
+    secrets.setdefault('sns_arn_dlq', 'backfill-dead-letter')
+    secrets['secret_arn'] = secret_arn
+    secrets['oauth_url'] = secrets.get('bloburl', 'bloburlNotFound')
+    secrets.setdefault('partitionSize', args.partition_size)
+    secrets.setdefault('maxPartitionsPerFile', args.max_partitions)
+    secrets.setdefault('UseFullFilePath', args.use_full_file_path)
+    secrets['run_id'] = 'backfill-' + str(uuid.uuid4())
+    return secrets
+
+# The handlers find the in-memory bus and the run configuration in the caches of a warm container, the configuration
+# never expires so every invocation of the run (finder continuations included) uses it
+def install_run(values, queue):
+    clients[('boto3', 'sns')] = queue
+    config_cache[values['secret_arn']] = (float('inf'), values)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy an Azure storage account to S3 from a single host with the lambda handlers')
+    parser.add_argument('--secret', help='ARN of the azs3copy secret with the configuration and Azure credentials')
+    parser.add_argument('--config', help='json file with the configuration instead of the secret')
+    parser.add_argument('--set', action='append', metavar='KEY=VALUE', help='configuration value, can be repeated')
+    parser.add_argument('--finder', default='blobcopy-find-blobs', choices=['blobcopy-find-blobs', 'blobcopy-find-blobs-optimized'])
+    parser.add_argument('--find-workers', type=int, default=1, help='finder invocations at once')
+    parser.add_argument('--download-workers', type=int, default=32, help='download invocations at once')
+    parser.add_argument('--initiate-workers', type=int, default=4, help='initiator and recombinator invocations at once')
+    parser.add_argument('--part-workers', type=int, default=16, help='large file part invocations at once')
+    parser.add_argument('--memory-mb', type=int, default=5120, help='memory an invocation may plan with (parallel copies)')
+    parser.add_argument('--timeout', type=int, default=900, help='seconds an invocation sees as its time limit')
+    parser.add_argument('--partition-size', default='104857600', help='partitionSize when the configuration has none')
+    parser.add_argument('--max-partitions', default='10000', help='maxPartitionsPerFile when the configuration has none')
+    parser.add_argument('--use-full-file-path', default='true', help='UseFullFilePath when the configuration has none')
+    parser.add_argument('--progress-seconds', type=float, default=10, help='seconds between progress lines')
+    args = parser.parse_args()
+    if not args.secret and not args.config:
+        parser.error('--secret or --config is required')
+
+    if args.config:
+        clients[('boto3', 'secretsmanager')] = LocalSecret(args.config)
+    values = run_values(args)
+    queue = MessageBus(values.get('sns_arn_dlq'))
+    install_run(values, queue)
+    print("Backfill run: ", values['run_id'])
+    sys.exit(0 if Runner(args, values, queue).run() else 1)
@@ -0,0 +1,119 @@
+import json
+from azure.core.exceptions import ResourceNotFoundError
+from blobcopy_clients import get_blob_service_client, get_client, log_cache_stats
+from blobcopy_compress import SUFFIXES, CompressionRules
+from blobcopy_dispatch import dispatch_targets, get_dispatcher, publish_blob
+from blobcopy_events import BLOB_CREATED, BLOB_DELETED, blob_location, event_age_ms, event_configs, event_type
+from blobcopy_filter import BlobFilter
+from blobcopy_governor import get_governor
+from blobcopy_manifest import DISPATCHED, blob_entry, get_manifest_store
+from blobcopy_message import object_key, record_body, resolve_config
+from blobcopy_metrics import Metrics, record_queue_delay
+from blobcopy_planner import PartPlanner
+from os import environ
+
+# Near real time copy of blobs from Azure Event Grid events, consumed from the event queue (see blobcopy-event-relay.py)
+# A created blob goes straight to the download or large file functions with the same filters as the finders,
+# a deleted blob is only removed from the bucket with eventDeletes set to delete (default ignore)
+# Dispatched blobs are recorded in the inventory manifest of the account, so the listing of the finder does not
+# copy them again
+
+def blob_created(config, container, name, dispatcher, run_id):
+    blob_filter = BlobFilter(config)
+    if not blob_filter.container_matches(container) or not blob_filter.in_prefixes(name):
+        return None
+    blob_service_client = get_blob_service_client(
+        config.get('tenantid', 'notFound'),
+        config.get('appid', 'notFound'),
+        config.get('appsecret', 'notFound'),
+        config.get('oauth_url', 'notFound'),
+        get_governor(config)
+    )
+    try:
+        # The event has no content settings, the properties also give the current size of an appended blob
+        blob = blob_service_client.get_blob_client(container, name).get_blob_properties()
+    except ResourceNotFoundError:
+        print("Blob deleted before its copy - blob: ", name)
+        return None
+    if not blob_filter.matches(blob):
+        return None
+    download_target, large_file_target = dispatch_targets(config)
+    publish_blob(dispatcher, dict(config, run_id=run_id), container, blob, blob.last_modified, PartPlanner(config),
+                 config['UseFullFilePath'], download_target, large_file_target)
+    return blob
+
+# One manifest write per account and container of the batch, once its messages are sent
+def record_dispatched(configs, dispatched_blobs):
+    for (url, container), updates in dispatched_blobs.items():
+        store = get_manifest_store(configs[url])
+        if store is not None:
+            store.append(container, updates)
+
+def blob_deleted(config, name):
+    if config.get('eventDeletes', 'ignore') != 'delete':
+        return False
+    blobKey = object_key(name, config['UseFullFilePath'], config.get('keyPrefix', ''))
+    keys = [blobKey]
+    # The copy may have been compressed into <key>.gz / <key>.zst
+    if CompressionRules(config).codec:
+        keys += [blobKey + suffix for suffix in SUFFIXES.values()]
+    get_client('s3').delete_objects(Bucket=config.get('bucket_name', 'bucketNotFound'), Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+    print("Deleted copy of blob: ", name)
+    return True
+
+def lambda_handler(event, context):
+    run_id = getattr(context, 'aws_request_id', 'local')
+    values = resolve_config({'config_ref': environ['secret']})
+    configs = {}
+    for url, config in event_configs(values).items():
+        configs[url] = dict(config, partitionSize=environ['partitionSize'], maxPartitionsPerFile=environ['maxPartitionsPerFile'],
+                            UseFullFilePath=environ['UseFullFilePath'])
+    metrics = Metrics('blobcopy-blob-events', run_id)
+    dispatcher = get_dispatcher(values)
+
+    failures = []
+    dispatched = []
+    dispatched_blobs = {}
+    for record in event['Records']:
+        record_queue_delay(metrics, record)
+        try:
+            item = json.loads(record_body(record))
+            age = event_age_ms(item)
+            if age is not None:
+                metrics.put('EventAge', age, 'Milliseconds')
+            url, container, name = blob_location(item)
+            config = configs.get(url)
+            if config is None:
+                print("Event of an unknown storage account - url: ", url)
+                metrics.put('EventsIgnored', 1)
+                continue
+            if event_type(item) == BLOB_CREATED:
+                blob = blob_created(config, container, name, dispatcher, run_id)
+                if blob is not None:
+                    dispatched.append(record)
+                    dispatched_blobs.setdefault((url, container), {})[blob.name] = blob_entry(blob, DISPATCHED)
+                else:
+                    metrics.put('EventsIgnored', 1)
+            elif event_type(item) == BLOB_DELETED:
+                metrics.put('BlobsDeleted' if blob_deleted(config, name) else 'EventsIgnored', 1)
+        except Exception as error:
+            print("Blob event failed: ", error)
+            failures.append({'itemIdentifier': record['messageId']})
+
+    try:
+        dispatcher.close()
+    except Exception as error:
+        # Messages of the batch may be lost, every dispatched event is delivered again
+        print("Dispatch failed: ", error)
+        failures += [{'itemIdentifier': record['messageId']} for record in dispatched]
+        dispatched_blobs = {}
+    try:
+        record_dispatched(configs, dispatched_blobs)
+    except Exception as error:
+        # The copies are on their way, the finder only lists these blobs again
+        print("Manifest update failed: ", error)
+    dispatcher.put_metrics(metrics)
+    metrics.put('EventsFailed', len(failures))
+    metrics.flush()
+    log_cache_stats('blobcopy-blob-events')
+    return {'batchItemFailures': failures}
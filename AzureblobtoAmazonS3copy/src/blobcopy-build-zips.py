@@ -0,0 +1,114 @@
+import argparse
+import ast
+import io
+import os
+import sys
+import warnings
+import zipfile
+
+# Builds the lambda zips of ../CFN (and of the Cloud Intelligence Dashboard) from the handlers and the shared modules they import
+# Every zip holds its handler and the blobcopy_* modules it imports (also the ones imported inside functions) at the
+# root of the zip. The zips are reproducible: entries are sorted and carry a fixed time, so a zip only changes when
+# one of its files changes. Run it after changing a handler or a shared module and commit the zips with the change.
+#
+#   python blobcopy-build-zips.py            rebuild every zip
+#   python blobcopy-build-zips.py --check    exit code 1 when a committed zip or the readme table is out of date
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(SRC, '..')
+
+# zip (relative to AzureblobtoAmazonS3copy) -> handler
+ZIPS = {
+    'CFN/azs3copy-lambda01.zip': 'blobcopy-launch-qualification',
+    'CFN/azs3copy-lambda02.zip': 'blobcopy-find-blobs',
+    'CFN/azs3copy-lambda03.zip': 'blobcopy-download',
+    'CFN/azs3copy-lambda04.zip': 'blobcopy-large-file-initiator',
+    'CFN/azs3copy-lambda05.zip': 'blobcopy-large-file-part',
+    'CFN/azs3copy-lambda06.zip': 'blobcopy-large-file-recombinator',
+    'CFN/azs3copy-lambda07.zip': 'blobcopy-event-relay',
+    'CFN/azs3copy-lambda08.zip': 'blobcopy-blob-events',
+    # The Cloud Intelligence Dashboard runs the same handlers, its secret sets keyPrefix and exportSelection
+    '../CloudIntelligenceDashboardforAzure/CFN/cid-azure-lambda01.zip': 'blobcopy-launch-qualification',
+    '../CloudIntelligenceDashboardforAzure/CFN/cid-azure-lambda02.zip': 'blobcopy-find-blobs',
+    '../CloudIntelligenceDashboardforAzure/CFN/cid-azure-lambda03.zip': 'blobcopy-download',
+    '../CloudIntelligenceDashboardforAzure/CFN/cid-azure-lambda04.zip': 'blobcopy-large-file-initiator',
+    '../CloudIntelligenceDashboardforAzure/CFN/cid-azure-lambda05.zip': 'blobcopy-large-file-part',
+    '../CloudIntelligenceDashboardforAzure/CFN/cid-azure-lambda06.zip': 'blobcopy-large-file-recombinator',
+}
+
+ZIP_TIME = (2026, 1, 1, 0, 0, 0)
+
+# Shared modules imported by a file, followed through the modules themselves
+def shared_modules(name, found=None):
+    found = set() if found is None else found
+    with open(os.path.join(SRC, name)) as source, warnings.catch_warnings():
+        # Escape sequences of the handler sources are not the concern of the build
+        warnings.simplefilter('ignore', SyntaxWarning)
+        warnings.simplefilter('ignore', DeprecationWarning)
+        tree = ast.parse(source.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            modules = [node.module]
+        else:
+            continue
+        for module in modules:
+            if module.startswith('blobcopy_') and module + '.py' not in found:
+                found.add(module + '.py')
+                shared_modules(module + '.py', found)
+    return found
+
+def zip_files(handler):
+    return [handler + '.py'] + sorted(shared_modules(handler + '.py'))
+
+def zip_bytes(files):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name in files:
+            info = zipfile.ZipInfo(name, ZIP_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with open(os.path.join(SRC, name), 'rb') as source:
+                archive.writestr(info, source.read())
+    return data.getvalue()
+
+# Rows of the zip table in readme.md, the dashboard zips hold the same files as their azs3copy zip
+def table_rows():
+    return ['| %s | %s |' % (os.path.basename(path), ', '.join(zip_files(handler)[1:])) for path, handler in ZIPS.items() if path.startswith('CFN/')]
+
+# Zips and readme rows that differ from the sources
+def stale():
+    found = []
+    for path, handler in ZIPS.items():
+        target = os.path.join(ROOT, path)
+        if not os.path.exists(target):
+            found.append(path)
+            continue
+        with open(target, 'rb') as current:
+            if current.read() != zip_bytes(zip_files(handler)):
+                found.append(path)
+    with open(os.path.join(SRC, 'readme.md')) as readme:
+        lines = readme.read().splitlines()
+    found += ['readme.md: ' + row for row in table_rows() if row not in lines]
+    return found
+
+def build():
+    for path, handler in ZIPS.items():
+        files = zip_files(handler)
+        with open(os.path.join(ROOT, path), 'wb') as target:
+            target.write(zip_bytes(files))
+        print(path, len(files), 'files')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the lambda zips from the handlers and their shared modules')
+    parser.add_argument('--check', action='store_true', help='only report zips and readme rows that are out of date')
+    args = parser.parse_args()
+    if args.check:
+        out_of_date = stale()
+        for item in out_of_date:
+            print('Out of date: ' + item)
+        sys.exit(1 if out_of_date else 0)
+    build()
+    for row in table_rows():
+        print(row)
@@ -1,21 +1,23 @@
 import json
-import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib import parse
-from boto3 import client as Client
-from azure.identity import ClientSecretCredential
-from azure.storage.blob import BlobServiceClient
+from blobcopy_checksum import Md5Verifier, checksum_algorithm, content_md5, verification_metadata
+from blobcopy_clients import get_blob_service_client, get_client, log_cache_stats
+from blobcopy_compress import SUFFIXES, CompressionRules, compression_metadata, open_compressed
+from blobcopy_governor import get_governor
+from blobcopy_manifest import record_copied
+from blobcopy_message import ENVELOPE_VERSION, record_body, resolve_config, unpack_message
+from blobcopy_metrics import Metrics, record_queue_delay
+from blobcopy_parallel import copy_in_parts
+from blobcopy_retry import RetryScheduler
+from blobcopy_stream import open_download
 
-# Azure Blob Copy function to retrieve the blob file via info from the SNS topic
-# New secure token created for the Azure connection to avoid connection noise and enable distinct blob downloads
-def lambda_handler(event, context):
-
-    response = event['Records'][0]['Sns'].get('Message','not found')
-    # The initial json loaded into values is the BlobInfo object
-    # BlobInfo contains the values payload as a property, loading that separately as valuePayload
-    values = json.loads(response)
-    
-    valuePayload = json.loads(json.dumps(values['valuePayload']))
+# Copy one blob described by a BlobInfo envelope
+# The configuration is resolved from the config_ref of the envelope and cached while the container is warm
+def copy_blob(values, context, metrics):
+    valuePayload = resolve_config(values)
     # accountName = valuePayload.get('account_name','nameNotFound')
     active_directory_tenant_id = valuePayload.get('tenantid','notFound')
     active_directory_application_id = valuePayload.get('appid','notFound') 
@@ -26,40 +28,173 @@ def lambda_handler(event, context):
     containerName = values.get("container","notFound")
     blobName = values.get("blob","notFound")
     fileName = values.get("fileName","notFound")
-    # TODO: if blobSize > someArbituary value: increase lambda specs or perform partition download
     blobSize = values.get("size","notFound")
     blobLastModified = values.get("lastmodified","1900-01-01 00:00:00")
     blobKey = values.get('fullFilePath',''+'/'+fileName)
-    token_credential = ClientSecretCredential(
+    blob_service_client = get_blob_service_client(
         active_directory_tenant_id,
         active_directory_application_id,
-        active_directory_application_secret
+        active_directory_application_secret,
+        oauth_url,
+        get_governor(valuePayload)
     )
-    blob_service_client = BlobServiceClient(
-        account_url=oauth_url, 
-        credential=token_credential
+
+    # Chunks read from Azure are handed to an S3 upload_fileobj stream, which uploads parts in the background
+    # while the next chunk downloads. Memory stays at about streamChunkSize * (streamConcurrency + 1)
+    # whatever the blob size, and nothing is written to /tmp
+    streamChunkSize = int(valuePayload.get('streamChunkSize', str(8 * 1024 * 1024)))
+    streamConcurrency = int(valuePayload.get('streamConcurrency', '4'))
+    # s3transfer is only loaded by the first streamed copy, not while the function initializes
+    from boto3.s3.transfer import TransferConfig
+    transfer_config = TransferConfig(
+        multipart_threshold=streamChunkSize,
+        multipart_chunksize=streamChunkSize,
+        max_concurrency=streamConcurrency,
+        max_io_queue=streamConcurrency
     )
 
     # Blob_client to directly retrieves the blob from the specified container
     blob_client = blob_service_client.get_blob_client(container=containerName, blob=blobName)
-    os.chdir('/tmp')
 
     # Upload the file to the user specified S3 bucket
-    with open(fileName, "wb") as my_blob:
-        download_stream = blob_client.download_blob()
-        my_blob.write(download_stream.readall())
-        s3 = Client('s3')
-        tags = {"container": containerName,"blobname": re.sub("[^\w.:+=@_/-]", "-",blobName),"size": blobSize, "lastmodified": blobLastModified}
+    s3 = get_client('s3')
+    tags = {"container": containerName,"blobname": re.sub("[^\w.:+=@_/-]", "-",blobName),"size": blobSize, "lastmodified": blobLastModified}
+
+    # Parts are uploaded with an S3 additional checksum, the Azure side is checked while the data streams
+    algorithm = checksum_algorithm(valuePayload)
+    verifyAzureRanges = valuePayload.get('verifyAzureRanges', 'false') == 'true'
 
-        s3.upload_file(
-            Filename = fileName,
+    # Mid-sized blobs (sent here instead of to the large file initiator, see parallelCopyMaxSize) are copied
+    # with concurrent ranged downloads and part uploads in this invocation
+    parallelPartSize = int(valuePayload.get('parallelPartSize', str(64 * 1024 * 1024)))
+    parallelConcurrency = int(valuePayload.get('parallelConcurrency', '8'))
+
+    # Blobs matching the compression rules are streamed through the codec into <key>.gz / <key>.zst,
+    # whatever their size since the compressed size of a range is only known once it is compressed
+    compression = CompressionRules(valuePayload)
+    codec = compression.codec_for(blobName, values.get('contentType'), values.get('contentEncoding'))
+    if codec:
+        blobKey = blobKey + SUFFIXES[codec]
+    start = time.perf_counter()
+    if blobSize > parallelPartSize and codec is None:
+        # The ranges are hashed in blob order and compared with the Content-MD5 of the blob before the upload completes
+        md5 = values.get('contentMD5')
+        metadata = verification_metadata(md5, 'azure-md5' if md5 else ('azure-ranges' if verifyAzureRanges else None))
+        copy_in_parts(blob_client, s3, bucket_name, blobKey, blobSize, parallelPartSize, parallelConcurrency, parse.urlencode(tags),
+                      algorithm, metadata, verifyAzureRanges, int(context.memory_limit_in_mb), metrics, md5)
+    else:
+        # A blob with a Content-MD5 is hashed as it streams, a mismatch fails the read and the upload is aborted
+        download_stream = blob_client.download_blob()
+        md5 = content_md5(download_stream.properties.content_settings)
+        extra_args = {"Tagging": parse.urlencode(tags), "Metadata": compression_metadata(verification_metadata(md5, 'azure-md5' if md5 else None), codec)}
+        if algorithm:
+            extra_args["ChecksumAlgorithm"] = algorithm
+        reader = open_download(download_stream, verifier=Md5Verifier(md5) if md5 else None)
+        upload_reader = reader
+        if codec:
+            # The Content-MD5 is checked on the blob as it comes from Azure, before compression
+            extra_args["ContentEncoding"] = codec
+            upload_reader = open_compressed(reader, codec, compression.level)
+        s3.upload_fileobj(
+            Fileobj = upload_reader,
             Bucket =  bucket_name,
             Key = blobKey,
-            ExtraArgs = {"Tagging": parse.urlencode(tags)}
+            ExtraArgs = extra_args,
+            Config = transfer_config
             )
-       
-    
+        # Azure and S3 overlap while streaming, the S3 time is the part of the copy not spent waiting on Azure
+        azure_seconds = reader.raw.wait_seconds
+        metrics.put('AzureDownloadTime', azure_seconds * 1000, 'Milliseconds')
+        metrics.put('S3UploadTime', (time.perf_counter() - start - azure_seconds) * 1000, 'Milliseconds')
+        if codec:
+            metrics.put('CompressedBytes', upload_reader.raw.bytes_out, 'Bytes')
+    metrics.transferred(blobSize, time.perf_counter() - start)
+    metrics.put('BlobsCopied', 1)
+
+
+# Copy the blobs of an invocation, returns the blobs that failed with their errors by record
+# Blobs copied in parts already use the memory of the function, they are copied one at a time after the small ones
+def copy_blobs(work, context, concurrency, parallel_part_size, metrics):
+    def attempt(entry):
+        index, values = entry
+        try:
+            copy_blob(values, context, metrics)
+            return None
+        except Exception as error:
+            print("Failure Downloading - blob: ", values.get("blob","notFound"), ' run_id: ', values.get("run_id"), ' error: ', error)
+            metrics.put('BlobsFailed', 1)
+            return (index, values, error)
+    small, large = [], []
+    for entry in work:
+        size = entry[1].get('size')
+        (large if isinstance(size, int) and size > parallel_part_size else small).append(entry)
+    if len(small) > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(attempt, small))
+    else:
+        results = [attempt(entry) for entry in small]
+    results += [attempt(entry) for entry in large]
+    failed = {}
+    for result in results:
+        if result is not None:
+            failed.setdefault(result[0], []).append(result[1:])
+    return failed
+
+# Send only the failed blobs of a record back, with backoff through the download queue whether the record came from
+# SNS or SQS, the home topic only takes them without a download queue (backfill)
+def retry_failed(values, failed, metrics):
+    config = resolve_config(failed[0][0])
+    scheduler = RetryScheduler(config, 'sqs_url_l2')
+    if len(failed) == 1 and 'batch' not in values:
+        message = values
+    else:
+        message = {'v': ENVELOPE_VERSION, 'batch': [item for item, _ in failed], 'attempt': values.get('attempt', 0)}
+    outcome = scheduler.retry(message, 'attempt', config.get('sns_arn_l2', 'notFound'), failed[0][1])
+    metrics.put('DeadLetters' if outcome == 'dead_letter' else 'Retries', 1)
+    return outcome
+
+# Azure Blob Copy function to retrieve the blob file via info from the SNS topic
+# Messages arrive from SNS, or in batches from SQS when the finders use the sqs dispatch backend. A message is a
+# single BlobInfo envelope or a pack of small blobs, the blobs of an invocation are copied concurrently over the
+# cached Azure credential and clients. Failed blobs are retried on their own, the others are not copied again
+def lambda_handler(event, context):
+    records = event['Records']
+    messages = [json.loads(record_body(record)) for record in records]
+    work = [(index, item) for index, values in enumerate(messages) for item in unpack_message(values)]
+    metrics = Metrics('blobcopy-download', work[0][1].get('run_id') if work else None)
+    for record in records:
+        record_queue_delay(metrics, record)
+    config = resolve_config(work[0][1]) if work else {}
+    concurrency = int(config.get('downloadConcurrency', '8'))
+    parallelPartSize = int(config.get('parallelPartSize', str(64 * 1024 * 1024)))
+    failed = copy_blobs(work, context, concurrency, parallelPartSize, metrics)
+    # Copied blobs are recorded in the inventory manifest, a failed write only means they are sent again later
+    failed_items = {id(item) for errors in failed.values() for item, _ in errors}
+    try:
+        record_copied(config, [item for _, item in work if id(item) not in failed_items])
+    except Exception as error:
+        print("Manifest update failed: ", error)
+
+    failures = []
+    for index, errors in failed.items():
+        try:
+            retry_failed(messages[index], errors, metrics)
+        except Exception as error:
+            # Report the record as a partial batch failure so SQS redelivers it, SNS records fail the invocation
+            print("Retry scheduling failed: ", error)
+            if 'messageId' not in records[index]:
+                raise
+            failures.append({'itemIdentifier': records[index]['messageId']})
+
+    response = {'copied': len(work) - sum(len(errors) for errors in failed.values()), 'failed': sum(len(errors) for errors in failed.values())}
+    print("Download batch: ", response)
+    governor = get_governor(config)
+    if governor is not None:
+        governor.put_metrics(metrics)
+    metrics.flush()
+    log_cache_stats('blobcopy-download')
     return {
         'statusCode': 200,
-        'body': json.dumps(response)
+        'body': json.dumps(response),
+        'batchItemFailures': failures
     }
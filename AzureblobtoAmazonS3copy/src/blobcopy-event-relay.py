@@ -0,0 +1,52 @@
+import base64
+import hmac
+import json
+from blobcopy_clients import log_cache_stats
+from blobcopy_events import BLOB_EVENTS, SUBSCRIPTION_VALIDATION, event_type, get_event_queue
+from blobcopy_message import resolve_config
+from blobcopy_metrics import Metrics
+from os import environ
+
+# Webhook of the Azure Event Grid subscription (lambda function URL)
+# Answers the subscription validation handshake and relays BlobCreated / BlobDeleted events to the event queue,
+# the blob events function copies them. Deliveries must carry the eventGridKey secret as ?key= in the endpoint url
+
+def response(status, body=None, headers=None):
+    return {'statusCode': status, 'headers': headers or {'Content-Type': 'application/json'}, 'body': json.dumps(body or {})}
+
+def lambda_handler(event, context):
+    values = resolve_config({'config_ref': environ['secret']})
+    expected = values.get('eventGridKey', '')
+    key = (event.get('queryStringParameters') or {}).get('key', '')
+    if not expected or not hmac.compare_digest(key.encode('utf-8'), expected.encode('utf-8')):
+        print('Rejected event delivery - invalid key')
+        return response(403)
+
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    # CloudEvents schema validation handshake
+    if event.get('requestContext', {}).get('http', {}).get('method') == 'OPTIONS':
+        return response(200, headers={'WebHook-Allowed-Origin': headers.get('webhook-request-origin', '*'), 'WebHook-Allowed-Rate': '*'})
+
+    body = event.get('body') or '[]'
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+    events = json.loads(body)
+    # CloudEvents deliveries may hold a single event
+    if isinstance(events, dict):
+        events = [events]
+
+    # Event Grid schema validation handshake
+    for item in events:
+        if event_type(item) == SUBSCRIPTION_VALIDATION:
+            print('Event Grid subscription validated')
+            return response(200, {'validationResponse': item['data']['validationCode']})
+
+    blob_events = [item for item in events if event_type(item) in BLOB_EVENTS]
+    # A failed relay returns an error so Event Grid retries the delivery
+    get_event_queue(values).send(blob_events)
+    metrics = Metrics('blobcopy-event-relay')
+    metrics.put('EventsRelayed', len(blob_events))
+    metrics.put('EventsIgnored', len(events) - len(blob_events))
+    metrics.flush()
+    log_cache_stats('blobcopy-event-relay')
+    return response(200, {'relayed': len(blob_events)})
@@ -1,10 +1,16 @@
 import json
-import math
-import os
+import time
 from datetime import datetime
-from boto3 import client as Client
-from azure.identity import ClientSecretCredential
-from azure.storage.blob import BlobServiceClient
+from blobcopy_clients import get_blob_service_client, get_client, log_cache_stats
+from blobcopy_checkpoint import get_checkpoint_store, launch_scope
+from blobcopy_dispatch import dispatch_targets, get_dispatcher, publish_new_blob
+from blobcopy_exports import ExportSelector
+from blobcopy_filter import BlobFilter, to_utc
+from blobcopy_governor import get_governor
+from blobcopy_manifest import get_manifest_store
+from blobcopy_message import launch_message, resolve_launch
+from blobcopy_metrics import Metrics, record_queue_delay
+from blobcopy_planner import PartPlanner
 
 def try_strptime(s, fmts=['%d-%b-%y','%m/%d/%Y','%Y-%m-%d %H:%M:%S%z','%Y%m%d','%Y-%m-%d %H:%M:%S','%Y-%m-%d %H:%M:%S%Z']):
     for fmt in fmts:
@@ -17,138 +23,149 @@ def try_strptime(s, fmts=['%d-%b-%y','%m/%d/%Y','%Y-%m-%d %H:%M:%S%z','%Y%m%d','
 dt_format_code = '%Y-%m-%d %H:%M:%S'
 dt_formats_to_try =['%d-%b-%y','%m/%d/%Y','%Y-%m-%d %H:%M:%S%z','%Y%m%d','%Y-%m-%d %H:%M:%S','%Y-%m-%d %H:%M:%S%Z']
 
-class BlobInfo:
-    def __init__(self, container, blob, useFullFilePath, lastmodified, size, partitionSize, valuePayload, contentSettings):
-        self.container = container
-        self.blob = blob
-        self.fileName = os.path.basename(blob)
-        self.lastmodified = lastmodified
-        self.size = size
-        self.partitionSize = partitionSize
-        self.valuePayload = valuePayload
-        self.contentType = contentSettings.content_type
-        self.contentEncoding = contentSettings.content_encoding
-        self.contentLanguage = contentSettings.content_language
-        self.UseFullFilePath = useFullFilePath
-        self.fullFilePath = self.fileName
-        if self.UseFullFilePath == 'true':
-            self.fullFilePath = '' + self.blob
-
-    def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
-
 def lambda_handler(event, context):
     response = event['Records'][0]['Sns'].get('Message', 'not found')
-    values = json.loads(response)
+    # The launch message refers to the secret, the credentials are resolved here
+    values = resolve_launch(json.loads(response))
 
     # Get pagination parameters
-    batch_size = int(values.get('batch_size', '1000'))  # Process 1000 blobs per execution
-    container_name = values.get('container_name', None)  # Process specific container
-    continuation_token = values.get('continuation_token', None)
+    batch_size = int(values.get('batch_size', '1000'))  # Dispatch about 1000 blobs per execution
+    # A run spans several executions, progress of every container is kept in the checkpoint store under the launch
+    # (secret and begindate), the run id of the launcher only correlates the messages
+    scope = launch_scope(values)
+    run_id = values.setdefault('run_id', scope)
+    metrics = Metrics('blobcopy-find-blobs-optimized', run_id)
+    # Stop starting new pages once less than this is left on the Lambda clock, the next execution resumes
+    safetyMillis = int(values.get('shardSafetyMillis', '120000'))
+    remainingMillis = context.get_remaining_time_in_millis() if hasattr(context, 'get_remaining_time_in_millis') else 900000
+    deadline = time.time() + (remainingMillis - safetyMillis) / 1000
+    metrics.set_property('account', values.get('account_name'))
+    record_queue_delay(metrics, event['Records'][0])
     
     active_directory_tenant_id = values.get('tenantid', 'notFound')
     active_directory_application_id = values.get('appid', 'notFound')
     active_directory_application_secret = values.get('appsecret', 'notFound')
     oauth_url = values.get('oauth_url', 'notFound')
 
-    processStartDate = try_strptime(values.get('begindate', '1911-01-01 00:00:00'),dt_formats_to_try)
-    latestdate = try_strptime(values.get('begindate', '1911-01-01 00:00:00'),dt_formats_to_try)
+    # Parsed once and compared directly with the timezone aware last modified date of every blob
+    processStartDate = to_utc(try_strptime(values.get('begindate', '1911-01-01 00:00:00'),dt_formats_to_try))
+    latestdate = processStartDate
 
     sns_arn_1 = values.get('sns_arn_l1', 'notFound')  # Self-trigger for continuation
-    sns_arn_2 = values.get('sns_arn_l2', 'notFound')
-    sns_arn_3 = values.get('sns_arn_l3', 'notFound')
+    # SNS topics (or SQS queues) that trigger the Download and large file lambdas
+    download_target, large_file_target = dispatch_targets(values)
     secret_arn = values.get('secret_arn', 'secretArnNotFound')
 
-    partitionSize = int(values.get('partitionSize','5242880'))
-    maxPartitionsPerFile = int(values.get('maxPartitions','9999'))
+    # Large file threshold and part sizes, planned per blob
+    planner = PartPlanner(values)
     UseFullFilePath = values.get('UseFullFilePath','True')
 
-    token_credential = ClientSecretCredential(
+    # Azure credential and Blob client, cached while the lambda container is warm
+    # Listing requests take tokens of the same account governor as the copies
+    governor = get_governor(values)
+    blob_service_client = get_blob_service_client(
         active_directory_tenant_id,
         active_directory_application_id,
-        active_directory_application_secret
-    )
-
-    blob_service_client = BlobServiceClient(
-        account_url=oauth_url,
-        credential=token_credential
+        active_directory_application_secret,
+        oauth_url,
+        governor
     )
-    client = Client('sns')
+    client = get_client('sns')
+    dispatcher = get_dispatcher(values)
+    blob_filter = BlobFilter(values)
+    # With an inventory manifest only new or changed blobs (by etag) are dispatched
+    manifest_store = get_manifest_store(values)
+    # Only the newest cost export of every billing period is copied (exportSelection), the exports of a container
+    # are held until it is listed, and checkpointed with the page token when the container is handed over
+    exports = ExportSelector(values)
+    store = get_checkpoint_store(values)
+    checkpoints = store.list(scope)
 
+    # Blobs sent to the download or large file topics by this execution
     processed_count = 0
     
-    # Process specific container or get next container
-    if container_name:
-        containers_to_process = [{'name': container_name}]
-    else:
-        all_containers = list(blob_service_client.list_containers(include_metadata=True))
-        containers_to_process = all_containers
-
-    for container in containers_to_process:
-        if processed_count >= batch_size:
-            # Trigger next batch
-            next_values = values.copy()
-            next_values['container_name'] = container['name']
-            client.publish(
-                TargetArn=sns_arn_1,
-                Message=json.dumps({'default': json.dumps(next_values)}),
-                MessageStructure='json'
-            )
-            break
-            
-        container_client = blob_service_client.get_container_client(container['name'])
-        
-        # Use pagination for blobs
-        blob_iter = container_client.list_blobs()
-        if continuation_token:
-            blob_iter = container_client.list_blobs(marker=continuation_token)
-            
-        for blob in blob_iter:
-            if processed_count >= batch_size:
-                # Trigger continuation with token
-                next_values = values.copy()
-                next_values['container_name'] = container['name']
-                next_values['continuation_token'] = blob.name
-                client.publish(
-                    TargetArn=sns_arn_1,
-                    Message=json.dumps({'default': json.dumps(next_values)}),
-                    MessageStructure='json'
-                )
-                return 'batch_complete'
-                
-            fileTime = try_strptime(blob.last_modified.strftime(dt_format_code),dt_formats_to_try)
-            size = blob.size
-            adaptiveCeiling = partitionSize * maxPartitionsPerFile
-            
-            if fileTime > latestdate:
-                latestdate = fileTime
-
-            if fileTime > processStartDate:
-                if (size > partitionSize):
-                    if(size > adaptiveCeiling):
-                        partitionSize = int(math.ceil(size / adaptiveCeiling))
-                    b = BlobInfo(container['name'], blob.name, UseFullFilePath, fileTime.strftime(dt_format_code), size, partitionSize, values, blob.content_settings)
-                    client.publish(
-                        TargetArn=sns_arn_3,
-                        Message=json.dumps({'default': b.toJSON()}),
-                        MessageStructure='json'
-                    )
-                else:
-                    b = BlobInfo(container['name'], blob.name, UseFullFilePath, fileTime.strftime(dt_format_code), size, partitionSize, values, blob.content_settings)
+    for container in blob_service_client.list_containers(include_metadata=True):
+        if not blob_filter.container_matches(container['name']):
+            continue
+        # Every include prefix of a container is listed and checkpointed on its own
+        for prefix in blob_filter.prefixes:
+            unit = container['name'] if prefix is None else container['name'] + '|' + prefix
+            state = checkpoints.get(unit, {'status': 'pending', 'token': None})
+            if state.get('status') == 'done':
+                continue
+
+            container_latest = to_utc(try_strptime(state.get('latestdate', ''), dt_formats_to_try)) or processStartDate
+            exports.restore(container['name'], state.get('held', []))
+            container_client = blob_service_client.get_container_client(container['name'])
+            manifest = manifest_store.open(container['name']) if manifest_store else None
+
+            # Resume from the page continuation token of this prefix, a new container always starts without one
+            pager = container_client.list_blobs(name_starts_with=prefix, results_per_page=min(batch_size, 5000)).by_page(continuation_token=state.get('token'))
+            for page in pager:
+                for blob in page:
+                    if not blob_filter.matches(blob):
+                        continue
+                    fileTime = blob.last_modified
+                    if fileTime > container_latest:
+                        container_latest = fileTime
+
+                    if fileTime > processStartDate and not exports.hold(container['name'], blob):
+                        if publish_new_blob(dispatcher, manifest, values, container['name'], blob, planner, UseFullFilePath, download_target, large_file_target):
+                            processed_count += 1
+
+                state = {'status': 'pending', 'token': pager.continuation_token, 'latestdate': container_latest.strftime(dt_format_code)}
+                if not state['token']:
+                    break
+                # Only checkpoint once every message of the page has been sent
+                dispatcher.drain()
+                if manifest:
+                    manifest.commit()
+                if exports.enabled:
+                    state['held'] = exports.save(container['name'])
+                store.put(scope, unit, state)
+
+                if processed_count >= batch_size or time.time() > deadline:
+                    # Trigger continuation, the next execution resumes from the saved page token with a single page fetch
+                    next_values = dict(values, run_id=run_id, container_name=container['name'])
+                    dispatcher.close()
+                    dispatcher.put_metrics(metrics)
                     client.publish(
-                        TargetArn=sns_arn_2,
-                        Message=json.dumps({'default': b.toJSON()}),
+                        TargetArn=sns_arn_1,
+                        Message=json.dumps({'default': json.dumps(launch_message(next_values))}),
                         MessageStructure='json'
                     )
-                    
-            processed_count += 1
+                    metrics.flush()
+                    return 'batch_complete'
+
+            for blob in exports.release(container['name']):
+                publish_new_blob(dispatcher, manifest, values, container['name'], blob, planner, UseFullFilePath, download_target, large_file_target)
+            state = {'status': 'done', 'token': None, 'latestdate': container_latest.strftime(dt_format_code)}
+            dispatcher.drain()
+            if manifest:
+                manifest.commit()
+            store.put(scope, unit, state)
+            checkpoints[unit] = state
+
+    dispatcher.close()
+    dispatcher.put_metrics(metrics)
+    exports.put_metrics(metrics)
+
+    # Every container is listed - pick the latest modified date over the whole run
+    for state in checkpoints.values():
+        container_latest = to_utc(try_strptime(state.get('latestdate', ''), dt_formats_to_try))
+        if container_latest and container_latest > latestdate:
+            latestdate = container_latest
+    store.clear(scope)
 
     # Update secret with latest date
-    if latestdate > processStartDate:
-        client = Client('secretsmanager')
+    # The manifest decides what is new, begindate then stays the fixed lower bound of the copy
+    if latestdate > processStartDate and manifest_store is None:
+        client = get_client('secretsmanager')
         response = client.get_secret_value(SecretId=secret_arn)
         secret = response['SecretString']
         secret = secret.replace('"begindate":"' + values.get('begindate', '1911-01-01 00:00:00') + '"', '"begindate":"' + latestdate.strftime(dt_format_code) + '"')
         client.update_secret(SecretId=secret_arn, SecretString=secret)
         
+    metrics.flush()
+    log_cache_stats('blobcopy-find-blobs-optimized')
     return 'success'
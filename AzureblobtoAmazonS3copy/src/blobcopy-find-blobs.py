@@ -1,12 +1,19 @@
 import json
-import math
-import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from boto3 import client as Client
 # noinspection PyUnresolvedReferences
-from azure.identity import ClientSecretCredential
-# noinspection PyUnresolvedReferences
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobPrefix
+from blobcopy_clients import get_blob_service_client, get_client, log_cache_stats
+from blobcopy_checkpoint import get_checkpoint_store
+from blobcopy_dispatch import dispatch_targets, get_dispatcher, publish_blob, publish_new_blob
+from blobcopy_exports import ExportSelector
+from blobcopy_filter import BlobFilter, to_utc
+from blobcopy_governor import get_governor
+from blobcopy_manifest import get_manifest_store
+from blobcopy_message import launch_message, resolve_launch
+from blobcopy_metrics import Metrics, record_queue_delay
+from blobcopy_planner import PartPlanner
 
 def try_strptime(s, fmts=['%d-%b-%y','%m/%d/%Y','%Y-%m-%d %H:%M:%S%z','%Y%m%d','%Y-%m-%d %H:%M:%S','%Y-%m-%d %H:%M:%S%Z']):
     for fmt in fmts:
@@ -19,37 +26,232 @@ def try_strptime(s, fmts=['%d-%b-%y','%m/%d/%Y','%Y-%m-%d %H:%M:%S%z','%Y%m%d','
 
 dt_format_code = '%Y-%m-%d %H:%M:%S'
 dt_formats_to_try =['%d-%b-%y','%m/%d/%Y','%Y-%m-%d %H:%M:%S%z','%Y%m%d','%Y-%m-%d %H:%M:%S','%Y-%m-%d %H:%M:%S%Z']
-class BlobInfo:
-
-    def __init__(self, container, blob, useFullFilePath, lastmodified, size, partitionSize, valuePayload, contentSettings):
-        self.container = container
-        self.blob = blob
-        self.fileName = os.path.basename(blob)
-        self.lastmodified = lastmodified
-        self.size = size
-        self.partitionSize = partitionSize
-        self.valuePayload = valuePayload
-        self.contentType = contentSettings.content_type
-        self.contentEncoding = contentSettings.content_encoding
-        self.contentLanguage = contentSettings.content_language
-        self.UseFullFilePath = useFullFilePath
-        self.fullFilePath  = self.fileName
-        if self.UseFullFilePath == 'true':
-            self.fullFilePath = '' + self.blob
-          # to retain container in file path use below
-          # self.fullFilePath = '' + self.container + '/' + self.blob  
-        
-
-    def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__,
-                          sort_keys=True, indent=4)
-        
 
+# Split every container into prefix shards using delimiter based discovery
+# Shards above shardDepth only list the blobs sitting directly under their prefix, the deepest shards list recursively
+# Discovery starts from the configured include prefixes so excluded parts of a container are never listed
+# Prefixes are walked shardConcurrency at a time, level by level, and the prefixes still to walk are checkpointed
+# with the shards found so far. Once maxShards shards exist the remaining prefixes become recursive shards
+# Returns False when the invocation ran out of time before discovery was finished
+def discover_shards(blob_service_client, store, blob_filter, run_id, shardDepth, delimiter, maxShards, concurrency, deadline):
+    progress = store.get(run_id, '_discovery')
+    if progress is None:
+        frontier = [[container['name'], prefix or '', 0]
+                    for container in blob_service_client.list_containers(include_metadata=True) if blob_filter.container_matches(container['name'])
+                    for prefix in blob_filter.prefixes]
+        progress = {'frontier': frontier, 'shards': 0}
+    frontier = progress['frontier']
+    count = progress['shards']
+
+    def add_shard(container, prefix, recursive):
+        shard_id = container + '|' + prefix + ('|all' if recursive else '|flat')
+        store.put(run_id, shard_id, {'container': container, 'prefix': prefix, 'recursive': recursive, 'status': 'pending'})
+
+    def walk(unit):
+        container, prefix, depth = unit
+        container_client = blob_service_client.get_container_client(container)
+        return [item.name for item in container_client.walk_blobs(name_starts_with=prefix or None, delimiter=delimiter) if isinstance(item, BlobPrefix)]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while frontier:
+            if time.time() > deadline:
+                store.put(run_id, '_discovery', {'frontier': frontier, 'shards': count})
+                print("Out of time - checkpointed shard discovery, prefixes left: ", len(frontier))
+                return False
+            if count + len(frontier) >= maxShards:
+                for container, prefix, depth in frontier:
+                    add_shard(container, prefix, True)
+                count += len(frontier)
+                frontier = []
+                break
+            batch, frontier = frontier[:concurrency], frontier[concurrency:]
+            walked = [unit for unit in batch if unit[2] < shardDepth]
+            for container, prefix, depth in batch:
+                if depth >= shardDepth:
+                    add_shard(container, prefix, True)
+                    count += 1
+            for (container, prefix, depth), children in zip(walked, pool.map(walk, walked)):
+                add_shard(container, prefix, False)
+                count += 1
+                frontier += [[container, child, depth + 1] for child in children]
+            store.put(run_id, '_discovery', {'frontier': frontier, 'shards': count})
+    store.put(run_id, '_discovered', {'status': 'done', 'shards': count})
+    return True
+
+# List one shard page by page, checkpointing the continuation token after every page
+# Returns False when the invocation ran out of time before the shard was finished
+def list_shard(blob_service_client, dispatcher, store, manifest_store, blob_filter, run_id, shard_id, shard, deadline, values, processStartDate,
+               planner, UseFullFilePath, download_target, large_file_target, delimiter):
+    if time.time() > deadline:
+        return False
+    state = dict(shard)
+    latestdate = to_utc(try_strptime(state.get('latestdate', ''), dt_formats_to_try)) or processStartDate
+    container_client = blob_service_client.get_container_client(state['container'])
+    manifest = manifest_store.open(state['container']) if manifest_store else None
+    if state['recursive']:
+        pager = container_client.list_blobs(name_starts_with=state['prefix'] or None).by_page(continuation_token=state.get('token'))
+    else:
+        pager = container_client.walk_blobs(name_starts_with=state['prefix'] or None, delimiter=delimiter).by_page(continuation_token=state.get('token'))
+    for page in pager:
+        for blob in page:
+            if isinstance(blob, BlobPrefix) or not blob_filter.matches(blob):
+                continue
+            fileTime = blob.last_modified
+            if fileTime > latestdate:
+                latestdate = fileTime
+            if fileTime > processStartDate:
+                if manifest and not manifest.needs_copy(blob):
+                    continue
+                publish_blob(dispatcher, values, state['container'], blob, fileTime, planner, UseFullFilePath, download_target, large_file_target)
+                if manifest:
+                    manifest.record(blob)
+        state['token'] = pager.continuation_token
+        state['latestdate'] = latestdate.strftime(dt_format_code)
+        if not state['token']:
+            break
+        # Only checkpoint once every message of the page has been sent
+        dispatcher.drain()
+        store.put(run_id, shard_id, state)
+        if time.time() > deadline:
+            if manifest:
+                manifest.commit()
+            print("Out of time - checkpointed shard: ", shard_id)
+            return False
+    state['status'] = 'done'
+    state['token'] = None
+    state['latestdate'] = latestdate.strftime(dt_format_code)
+    dispatcher.drain()
+    if manifest:
+        manifest.commit()
+    store.put(run_id, shard_id, state)
+    return True
+
+# Sharded listing mode - shards are listed concurrently and only unfinished shards are picked up by a resumed run
+def find_blobs_sharded(blob_service_client, dispatcher, manifest_store, blob_filter, values, run_id, context, processStartDate, latestdate,
+                       planner, UseFullFilePath, download_target, large_file_target):
+    shardDepth = int(values.get('shardDepth', '1'))
+    shardConcurrency = int(values.get('shardConcurrency', '16'))
+    delimiter = values.get('shardDelimiter', '/')
+    # Stop starting new pages once less than this is left on the Lambda clock
+    safetyMillis = int(values.get('shardSafetyMillis', '120000'))
+    remainingMillis = context.get_remaining_time_in_millis() if hasattr(context, 'get_remaining_time_in_millis') else 900000
+    deadline = time.time() + (remainingMillis - safetyMillis) / 1000
+
+    # Enough shards to keep every listing thread busy, deeper prefixes are not walked
+    maxShards = int(values.get('maxShards', str(shardConcurrency * 16)))
+
+    store = get_checkpoint_store(values)
+    shards = store.list(run_id)
+    if '_discovered' not in shards:
+        if not discover_shards(blob_service_client, store, blob_filter, run_id, shardDepth, delimiter, maxShards, shardConcurrency, deadline):
+            return latestdate, False
+        shards = store.list(run_id)
+    shard_states = {k: v for k, v in shards.items() if not k.startswith('_')}
+    pending = {k: v for k, v in shard_states.items() if v.get('status') != 'done'}
+    print("Run: ", run_id, " shards: ", len(shard_states), " pending: ", len(pending))
+
+    finished = True
+    with ThreadPoolExecutor(max_workers=shardConcurrency) as pool:
+        futures = [
+            pool.submit(list_shard, blob_service_client, dispatcher, store, manifest_store, blob_filter, run_id, shard_id, shard, deadline, values, processStartDate,
+                        planner, UseFullFilePath, download_target, large_file_target, delimiter)
+            for shard_id, shard in pending.items()
+        ]
+        for future in futures:
+            if not future.result():
+                finished = False
+
+    if not finished:
+        return latestdate, False
+    for shard in store.list(run_id).values():
+        shardLatest = to_utc(try_strptime(shard.get('latestdate', ''), dt_formats_to_try))
+        if shardLatest and shardLatest > latestdate:
+            latestdate = shardLatest
+    store.clear(run_id)
+    return latestdate, True
+
+
+# Inventory discovery - streams the newest Azure Blob Inventory report instead of listing the containers
+# Rows are diffed against the inventory manifest (or the begindate without one) and checkpointed every inventoryCheckpointRows rows
+def find_blobs_inventory(blob_service_client, dispatcher, manifest_store, blob_filter, values, run_id, context, processStartDate, latestdate,
+                         planner, UseFullFilePath, download_target, large_file_target):
+    # Only loaded in inventory mode, listing runs never pay for the report parsers
+    from blobcopy_inventory import get_inventory_source, manifest_files, row_to_blob
+    checkpointRows = int(values.get('inventoryCheckpointRows', '50000'))
+    safetyMillis = int(values.get('shardSafetyMillis', '120000'))
+    remainingMillis = context.get_remaining_time_in_millis() if hasattr(context, 'get_remaining_time_in_millis') else 900000
+    deadline = time.time() + (remainingMillis - safetyMillis) / 1000
+
+    source = get_inventory_source(values, blob_service_client)
+    store = get_checkpoint_store(values)
+    progress = store.list(run_id)
+    report = progress.get('_report', {}).get('manifest')
+    if report is None:
+        report = source.latest_manifest()
+        last = store.get('inventory', 'last_report')
+        if report is None or (last and last.get('manifest') == report):
+            print("No new inventory report - latest: ", report)
+            return latestdate, True
+        store.put(run_id, '_report', {'manifest': report})
+    print("Inventory report: ", report, " run: ", run_id)
+
+    manifests = {}
+    def commit(state_key, state):
+        dispatcher.drain()
+        for manifest in manifests.values():
+            manifest.commit()
+        store.put(run_id, state_key, state)
+
+    for name in manifest_files(source.manifest(report), values.get('inventoryContainer', 'inventory')):
+        state = progress.get(name, {'status': 'pending', 'rows': 0})
+        if state.get('status') == 'done':
+            continue
+        fileLatest = to_utc(try_strptime(state.get('latestdate', ''), dt_formats_to_try)) or processStartDate
+        rows = 0
+        for row in source.rows(name):
+            rows += 1
+            if rows <= state['rows']:
+                continue
+            blob = row_to_blob(row, values.get('inventorySourceContainer'))
+            if blob is not None and blob_filter.container_matches(blob.container) and blob_filter.in_prefixes(blob.name) and blob_filter.matches(blob):
+                if blob.last_modified > fileLatest:
+                    fileLatest = blob.last_modified
+                if blob.last_modified > processStartDate:
+                    manifest = None
+                    if manifest_store:
+                        if blob.container not in manifests:
+                            manifests[blob.container] = manifest_store.open(blob.container)
+                        manifest = manifests[blob.container]
+                    if manifest is None or manifest.needs_copy(blob):
+                        publish_blob(dispatcher, values, blob.container, blob, blob.last_modified, planner, UseFullFilePath, download_target, large_file_target)
+                        if manifest:
+                            manifest.record(blob)
+            if rows % checkpointRows == 0:
+                commit(name, {'status': 'pending', 'rows': rows, 'latestdate': fileLatest.strftime(dt_format_code)})
+                if time.time() > deadline:
+                    print("Out of time - checkpointed inventory file: ", name, " rows: ", rows)
+                    return latestdate, False
+        commit(name, {'status': 'done', 'rows': rows, 'latestdate': fileLatest.strftime(dt_format_code)})
+        progress[name] = {'status': 'done', 'latestdate': fileLatest.strftime(dt_format_code)}
+
+    for state in progress.values():
+        fileLatest = to_utc(try_strptime(state.get('latestdate', ''), dt_formats_to_try))
+        if fileLatest and fileLatest > latestdate:
+            latestdate = fileLatest
+    store.put('inventory', 'last_report', {'manifest': report})
+    store.clear(run_id)
+    return latestdate, True
 
 def lambda_handler(event, context):
     # Retrieve the first SNS payload for populating variables
     response = event['Records'][0]['Sns'].get('Message', 'not found')
-    values = json.loads(response)
+    # The launch message refers to the secret, the credentials are resolved here
+    values = resolve_launch(json.loads(response))
+    # The run id of the launcher correlates the messages of a copy run, discovery checkpoints are kept under it
+    values.setdefault('run_id', getattr(context, 'aws_request_id', 'local'))
+    metrics = Metrics('blobcopy-find-blobs', values['run_id'])
+    metrics.set_property('account', values.get('account_name'))
+    record_queue_delay(metrics, event['Records'][0])
 
     # Variables to obtain a secure token from Azure
     active_directory_tenant_id = values.get('tenantid', 'notFound')
@@ -58,77 +260,97 @@ def lambda_handler(event, context):
     oauth_url = values.get('oauth_url', 'notFound')
 
     # Only process blobs > begindate secret
-    processStartDate = try_strptime(values.get('begindate', '1911-01-01 00:00:00'),dt_formats_to_try)
-    latestdate = try_strptime(values.get('begindate', '1911-01-01 00:00:00'),dt_formats_to_try)
+    # Parsed once and compared directly with the timezone aware last modified date of every blob
+    processStartDate = to_utc(try_strptime(values.get('begindate', '1911-01-01 00:00:00'),dt_formats_to_try))
+    latestdate = processStartDate
 
-    # SNS ARN for the 2nd topic that triggers the Download lambda
-    sns_arn_2 = values.get('sns_arn_l2', 'notFound')
-    sns_arn_3 = values.get('sns_arn_l3', 'notFound')
+    # SNS topics (or SQS queues) that trigger the Download and large file lambdas
+    download_target, large_file_target = dispatch_targets(values)
 
     # Pull the ARN of the SecretManager Secret in case we do an update to the beginDate
     secret_arn = values.get('secret_arn', 'secretArnNotFound')
 
-    partitionSize = int(values.get('partitionSize','5242880'))
-    maxPartitionsPerFile = int(values.get('maxPartitions','9999'))
+    # Large file threshold and part sizes, planned per blob
+    planner = PartPlanner(values)
     UseFullFilePath = values.get('UseFullFilePath','True')
 
-    # Retrieve a secure token with the Azure.Identity library
-    token_credential = ClientSecretCredential(
+    # Azure credential and Blob client, cached while the lambda container is warm
+    # Listing requests take tokens of the same account governor as the copies
+    governor = get_governor(values)
+    blob_service_client = get_blob_service_client(
         active_directory_tenant_id,
         active_directory_application_id,
-        active_directory_application_secret
+        active_directory_application_secret,
+        oauth_url,
+        governor
     )
+    client = get_client('sns')
+    dispatcher = get_dispatcher(values)
+    # With an inventory manifest only new or changed blobs (by etag) are dispatched
+    manifest_store = get_manifest_store(values)
+    blob_filter = BlobFilter(values)
+    # Only the newest cost export of every billing period is copied (exportSelection)
+    exports = ExportSelector(values)
 
-    # Create a Blob Client with the Azure.Storage library
-    blob_service_client = BlobServiceClient(
-        account_url=oauth_url,
-        credential=token_credential
-    )
-    client = Client('sns')
-
-    # Gets all Azure Blob Storage containers available to the tenant/application
-    all_containers = blob_service_client.list_containers(include_metadata=True)
-    for container in all_containers:
-        # Get all blobs in the container
-        container_client = blob_service_client.get_container_client(container['name'])
-        for blob in container_client.list_blobs():
-            print(blob.last_modified.strftime(dt_format_code),type(blob.last_modified), processStartDate,type(processStartDate),latestdate,type(latestdate))
-            fileTime = try_strptime(blob.last_modified.strftime(dt_format_code),dt_formats_to_try)
-            size = blob.size
-            partitionSize = partitionSize
-            adaptiveCeiling = partitionSize * maxPartitionsPerFile
-            if fileTime > latestdate:
-                latestdate =fileTime
+    listingMode = values.get('listingMode', 'serial')
+    discoveryMode = values.get('discoveryMode', 'list')
+    if discoveryMode == 'inventory' or listingMode == 'sharded':
+        if exports.enabled:
+            # Exports of a billing period may be split over shards or executions, every one is copied
+            print("exportSelection needs the serial listing - copying every export")
+        # Inventory and sharded listing resume from the checkpoint store and re-trigger themselves until they are done
+        run_id = values['run_id']
+        find_blobs = find_blobs_inventory if discoveryMode == 'inventory' else find_blobs_sharded
+        latestdate, finished = find_blobs(blob_service_client, dispatcher, manifest_store, blob_filter, values, run_id, context, processStartDate, latestdate,
+                                          planner, UseFullFilePath, download_target, large_file_target)
+        dispatcher.close()
+        dispatcher.put_metrics(metrics)
+        if not finished:
+            next_values = dict(values, run_id=run_id)
+            print("Discovery not finished - continuing run: ", run_id)
+            client.publish(
+                TargetArn=values.get('sns_arn_l1', 'notFound'),
+                Message=json.dumps({'default': json.dumps(launch_message(next_values))}),
+                MessageStructure='json'
+            )
+            metrics.flush()
+            return 'batch_complete'
+    else:
+        # Gets all Azure Blob Storage containers available to the tenant/application
+        all_containers = blob_service_client.list_containers(include_metadata=True)
+        for container in all_containers:
+            if not blob_filter.container_matches(container['name']):
+                continue
+            # Get all blobs in the container
+            container_client = blob_service_client.get_container_client(container['name'])
+            manifest = manifest_store.open(container['name']) if manifest_store else None
+            for prefix in blob_filter.prefixes:
+                for blob in container_client.list_blobs(name_starts_with=prefix):
+                    if not blob_filter.matches(blob):
+                        continue
+                    fileTime = blob.last_modified
+                    if fileTime > latestdate:
+                        latestdate =fileTime
 
-            # Send message to SNS for immediate processing
-            if fileTime > processStartDate:
-              
-                # add to list
-                if (size > partitionSize):
-                    if(size > adaptiveCeiling):
-                        # Adjusting the partitionSize for the MPlimits
-                        partitionSize = int(math.ceil(size / adaptiveCeiling))
-                    b = BlobInfo(container['name'], blob.name, UseFullFilePath, fileTime.strftime(dt_format_code), size, partitionSize, values, blob.content_settings)
-                    print("Sent for Large File Processing - blob: ", blob.name)
-                    response = client.publish(
-                        TargetArn=sns_arn_3,
-                        Message=json.dumps({'default': b.toJSON()}),
-                        MessageStructure='json'
-                    )
-                    
-                else:
-                    b = BlobInfo(container['name'], blob.name, UseFullFilePath, fileTime.strftime(dt_format_code), size, partitionSize, values, blob.content_settings)
-                    print("Sent for download - blob: ", blob.name)
-                    response = client.publish(
-                        TargetArn=sns_arn_2,
-                        Message=json.dumps({'default': b.toJSON()}),
-                        MessageStructure='json'
-                    )
+                    # Send message to SNS for immediate processing
+                    # Exports are held back until the container is listed, copied ones still compete for the newest
+                    if fileTime > processStartDate and not exports.hold(container['name'], blob):
+                        publish_new_blob(dispatcher, manifest, values, container['name'], blob, planner, UseFullFilePath, download_target, large_file_target)
+            for blob in exports.release(container['name']):
+                publish_new_blob(dispatcher, manifest, values, container['name'], blob, planner, UseFullFilePath, download_target, large_file_target)
+            if manifest:
+                # Record the container only once its messages are sent
+                dispatcher.drain()
+                manifest.commit()
+        dispatcher.close()
+        dispatcher.put_metrics(metrics)
+        exports.put_metrics(metrics)
     # Adding blobname, lastmodified date to a list for sorting the latest file
     # Updating process date if it is actually bigger
     print("latest", latestdate,"processstart",processStartDate)
-    if latestdate > processStartDate:
-        client = Client('secretsmanager')
+    # The manifest decides what is new, begindate then stays the fixed lower bound of the copy
+    if latestdate > processStartDate and manifest_store is None:
+        client = get_client('secretsmanager')
         response = client.get_secret_value(
             SecretId=secret_arn
         )
@@ -137,4 +359,6 @@ def lambda_handler(event, context):
         secret = secret.replace('"begindate":"' + values.get('begindate', '1911-01-01 00:00:00') + '"', '"begindate":"' + latestdate.strftime(dt_format_code) + '"')
         response['SecretString'] = secret
         client.update_secret(SecretId=secret_arn, SecretString=response['SecretString'])
+    metrics.flush()
+    log_cache_stats('blobcopy-find-blobs')
     return 'success'
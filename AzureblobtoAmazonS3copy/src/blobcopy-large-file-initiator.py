@@ -1,73 +1,161 @@
 import json
 import math
+from datetime import datetime, timezone
 from urllib import parse
-from boto3 import client as Client
 import re
+from blobcopy_checksum import checksum_algorithm, part_checksum, verification_metadata
+from blobcopy_clients import get_client, log_cache_stats
+from blobcopy_compress import SUFFIXES, CompressionRules, compression_metadata
+from blobcopy_message import message_body, resolve_config
+from blobcopy_metrics import Metrics, record_queue_delay
+from blobcopy_planner import PartPlanner, fits
+from blobcopy_tracker import get_upload_tracker
+from blobcopy_uploads import find_resumable, resumed_part_size, uploaded_parts
 
 # Function to initiate a multipart file upload to S3
 def lambda_handler(event, context):
-    response = event['Records'][0]['Sns'].get('Message','not found')
+    # Messages arrive from SNS, or from SQS when the finders use the sqs dispatch backend
+    response = message_body(event)
     values = json.loads(response)
-    # BlobInfo contains the values payload as a property so loading that separately as valuePayload
-    valuePayload = json.loads(json.dumps(values['valuePayload']))
+    run_id = values.get('run_id')
+    metrics = Metrics('blobcopy-large-file-initiator', run_id)
+    record_queue_delay(metrics, event['Records'][0])
+    # The BlobInfo envelope refers to the configuration through config_ref, parts are sent the same reference
+    valuePayload = resolve_config(values)
+    config_ref = valuePayload.get('secret_arn','secretArnNotFound')
     sns_arn_4 = valuePayload.get('sns_arn_l4', 'notFound')
     sns_arn_5 = valuePayload.get('sns_arn_l5', 'notFound')
-    active_directory_tenant_id = valuePayload.get('tenantid','notFound')
-    active_directory_application_id = valuePayload.get('appid','notFound')
-    active_directory_application_secret = valuePayload.get('appsecret','notFound')
-    oauth_url = valuePayload.get('oauth_url','urlNotFound')
     retries_active = valuePayload.get('retiesActive','false')
     bucket_name = valuePayload.get('bucket_name','bucketNotFound')
     containerName = values.get("container","notFound")
     blobName = values.get("blob","notFound")
     fileName = values.get("fileName","notFound")
-    # TODO: if blobSize > someArbituary value: increase lambda specs or perform partition download
     blobSize = values.get("size","notFound")
-    partitionSize = values.get('partitionSize',104857600)
+    # The finder plans the part size of the blob, messages without a valid one are planned again here
+    partitionSize = values.get('partitionSize', 0)
+    if not fits(blobSize, partitionSize):
+        plan = PartPlanner(valuePayload).plan(blobSize)
+        print("Planned part size - blob: ", blobName, 'was: ', partitionSize, 'plan: ', plan)
+        partitionSize = plan.part_size
     blobLastModified = values.get("lastmodified","1900-01-01 00:00:00")
-    s3 = Client('s3')
+    s3 = get_client('s3')
     tags = {"container": containerName,"blobname": re.sub("[^\w.:+=@_/-]", "-",blobName),"size": blobSize, "lastmodified": blobLastModified}
     blobkey = values.get('fullFilePath',''+'/'+fileName)
     
-    mp_upload_id = s3.create_multipart_upload(
-        Bucket=bucket_name,
-        Key=blobkey,
-        Tagging=parse.urlencode(tags)
-        ).get('UploadId','')
+    # Parts are uploaded with an S3 additional checksum, Azure returns the MD5 of every range a part downloads
+    # The parts run in separate functions, the Content-MD5 of the whole blob can not be compared here
+    algorithm = checksum_algorithm(valuePayload)
+    verifyAzureRanges = valuePayload.get('verifyAzureRanges', 'true') == 'true'
+    create_args = {}
+    if algorithm:
+        create_args['ChecksumAlgorithm'] = algorithm
+
+    # Compressed blobs go to <key>.gz / <key>.zst, every part is compressed on its own by the part function
+    compression = CompressionRules(valuePayload)
+    codec = compression.codec_for(blobName, values.get('contentType'), values.get('contentEncoding'))
+    if codec:
+        blobkey = blobkey + SUFFIXES[codec]
+        create_args['ContentEncoding'] = codec
+
+    # An incomplete upload of this blob version is resumed instead of copying the whole blob again
+    # Stored parts of a compressed upload do not have the size of their byte range, those uploads start over
+    resumed = None
+    if valuePayload.get('resumeUploads', 'true') == 'true' and codec is None:
+        lastmodified = datetime.strptime(blobLastModified, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        resumed = find_resumable(s3, bucket_name, blobkey, lastmodified, int(valuePayload.get('reapAfterHours', '72')))
+    stored = {}
+    if resumed is not None:
+        mp_upload_id = resumed['UploadId']
+        # New parts must use the checksum algorithm and part size the upload was started with
+        algorithm = resumed.get('ChecksumAlgorithm')
+        stored = uploaded_parts(s3, bucket_name, blobkey, mp_upload_id)
+        partitionSize = resumed_part_size(stored, blobSize) or partitionSize
+        print("Resuming mpuploadid", mp_upload_id, 'stored parts: ', len(stored), 'part size: ', partitionSize)
+    else:
+        mp_upload_id = s3.create_multipart_upload(
+            Bucket=bucket_name,
+            Key=blobkey,
+            Tagging=parse.urlencode(tags),
+            Metadata=compression_metadata(verification_metadata(None, 'azure-ranges' if verifyAzureRanges else None), codec),
+            **create_args
+            ).get('UploadId','')
     print("mpuploadid",mp_upload_id)
     blob_partitions = int(math.ceil(blobSize / partitionSize))
 
-    client = Client('sns')
+    client = get_client('sns')
+    tracker = get_upload_tracker(valuePayload)
+    published = 0
+    # Handed down to the recombinator, which records the blob as copied in the inventory manifest
+    manifest_entry = {'container': containerName, 'blob': blobName, 'etag': values['etag'], 'size': blobSize, 'lastmodified': blobLastModified} if values.get('etag') else None
 
+    # Stored parts of a resumed upload with the expected size are kept, the tracker learns about all of them before
+    # any missing part is sent so a part finishing early cannot see an incomplete set
+    missing = []
+    completed = False
     for i in range(blob_partitions):
         currentOffset = i * partitionSize
         bytesToDownload = min(partitionSize, blobSize - currentOffset)
-        if(bytesToDownload > 0):
-            inputParams = {
-                'oauth_url': oauth_url,
-                'currentOffset': currentOffset,
-                'bytesToDownload':bytesToDownload,
-                'bucket_name':bucket_name,
-                'blobkey':blobkey,
-                'blobName':blobName,
-                'containerName':containerName,
-                'mp_upload_id':mp_upload_id,
-                'part_number':i+1,
-                'total_parts': blob_partitions ,
-                'active_directory_tenant_id':active_directory_tenant_id,
-                'active_directory_application_id':active_directory_application_id,
-                'active_directory_application_secret':active_directory_application_secret,
-                'retries_active': retries_active,
-                'current_retry_count': 0,
-                'sns_home': sns_arn_4,
-                'sns_destination': sns_arn_5
-             }
-            print("Processing - blob: ", blobName,' part: ', i, 'mp_upload_id: ', mp_upload_id,'blobkey: ',blobkey)
-            response = client.publish(
-                TargetArn=sns_arn_4,
-                Message=json.dumps({'default': json.dumps(inputParams)}),
-                MessageStructure='json'
-            )
+        part = stored.get(i+1)
+        if part is not None and part['Size'] == bytesToDownload:
+            if tracker is not None:
+                completed = tracker.record(mp_upload_id, i+1, part['ETag'], blob_partitions, part_checksum(part, algorithm)) or completed
+            metrics.put('PartsResumed', 1)
+        elif(bytesToDownload > 0):
+            missing.append((i, currentOffset, bytesToDownload))
+
+    for i, currentOffset, bytesToDownload in missing:
+        inputParams = {
+            'config_ref': config_ref,
+            'currentOffset': currentOffset,
+            'bytesToDownload':bytesToDownload,
+            'bucket_name':bucket_name,
+            'blobkey':blobkey,
+            'blobName':blobName,
+            'containerName':containerName,
+            'mp_upload_id':mp_upload_id,
+            'part_number':i+1,
+            'total_parts': blob_partitions ,
+            'checksum_algorithm': algorithm,
+            'validate_content': verifyAzureRanges,
+            'compression': codec,
+            'compression_level': compression.level,
+            'retries_active': retries_active,
+            'current_retry_count': 0,
+            'sns_home': sns_arn_4,
+            'sns_destination': sns_arn_5,
+            'run_id': run_id,
+            'manifest_entry': manifest_entry
+         }
+        print("Processing - blob: ", blobName,' part: ', i, 'mp_upload_id: ', mp_upload_id,'blobkey: ',blobkey)
+        published += 1
+        response = client.publish(
+            TargetArn=sns_arn_4,
+            Message=json.dumps({'default': json.dumps(inputParams)}),
+            MessageStructure='json'
+        )
+
+    # The stored parts completed the upload (the tracker claimed it here), or every part of a resumed upload was
+    # already stored, complete it straight away
+    if completed or (resumed is not None and published == 0):
+        part_output = {
+            "bucket_name": bucket_name ,
+            "blobkey": blobkey ,
+            "UploadId": mp_upload_id ,
+            "PartNumber" : blob_partitions ,
+            "total_parts": blob_partitions ,
+            "config_ref": config_ref ,
+            "run_id": run_id ,
+            "manifest_entry": manifest_entry
+        }
+        response = client.publish(
+            TargetArn=sns_arn_5,
+            Message=json.dumps({'default': json.dumps(part_output)}),
+            MessageStructure='json'
+        )
+    metrics.put('PartsPublished', published)
+    metrics.put('BytesPlanned', blobSize, 'Bytes')
+    metrics.flush()
+    log_cache_stats('blobcopy-large-file-initiator')
     return {
         'statusCode': 200,
         'body': json.dumps(response)
@@ -1,21 +1,56 @@
 import json
-from boto3 import client as Client
-from boto3 import resource as Resource
-from azure.identity import ClientSecretCredential
-from azure.storage.blob import BlobServiceClient
+import time
+from blobcopy_checksum import part_checksum
+from blobcopy_clients import get_blob_service_client, get_client, get_resource, log_cache_stats
+from blobcopy_compress import compress_part
+from blobcopy_governor import get_governor
+from blobcopy_message import message_body, resolve_config
+from blobcopy_metrics import Metrics, record_queue_delay
+from blobcopy_retry import RetryScheduler
+from blobcopy_tracker import get_upload_tracker
+
+# Returns the part already stored in the multipart upload when it has the expected size, None otherwise
+# A single list_parts call starting right before the part number, so the check does not depend on the number of parts
+def uploaded_part(s3, bucket_name, blobkey, mp_upload_id, part_number, bytesToDownload):
+    listed = s3.list_parts(Bucket=bucket_name, Key=blobkey, UploadId=mp_upload_id, PartNumberMarker=part_number - 1, MaxParts=1)
+    for part in listed.get('Parts', []):
+        if part.get('PartNumber') == part_number and part.get('Size') == bytesToDownload:
+            return part
+    return None
 
 # Function to upload large file part to S3
 def lambda_handler(event, context):
-    response = event['Records'][0]['Sns'].get('Message','not found')
+    # First attempts arrive from SNS, delayed retries from the SQS retry queue
+    response = message_body(event)
     values = json.loads(response)
-    retries_active = values.get("retries_active","true")
-    current_retry_count = values.get("current_retry_count","notFound")
-    
-    # Check if retries is active and retry count is less than 4
+    current_retry_count = values.get("current_retry_count",0)
+    metrics = Metrics('blobcopy-large-file-part', values.get('run_id'))
+    record_queue_delay(metrics, event['Records'][0])
+
+    # Part messages carry config_ref instead of the Azure credentials, resolved once per warm container
+    # Messages published before the compact envelope still carry the credentials themselves
+    tracker = None
+    config = {}
+    if 'config_ref' in values:
+        config = resolve_config(values)
+        tracker = get_upload_tracker(config)
+        oauth_url = config.get('oauth_url','urlNotFound')
+        active_directory_tenant_id = config.get('tenantid','notFound')
+        active_directory_application_id = config.get('appid','notFound')
+        active_directory_application_secret = config.get('appsecret','notFound')
+    else:
+        oauth_url = values.get('oauth_url','urlNotFound')
+        active_directory_tenant_id = values.get("active_directory_tenant_id","notFound")
+        active_directory_application_id = values.get("active_directory_application_id","notFound")
+        active_directory_application_secret = values.get("active_directory_application_secret","notFound")
+    scheduler = RetryScheduler(config)
+    # Parts of every upload share the request rate of the storage account
+    governor = get_governor(config)
+
+    # Check the retry count is within the retry budget, exhausted messages went to the dead-letter topic
     print(current_retry_count)
-    if(current_retry_count < 4):    # Else publish to sns topic to retain multipart download and preserve the json
+    if(current_retry_count <= scheduler.max_attempts):
         print('Accessed Download Section')
-        oauth_url = values.get('oauth_url','urlNotFound')
         bucket_name = values.get('bucket_name','bucketNotFound')
         blobName = values.get("blobName","notFound")
         currentOffset = values.get("currentOffset","notFound")
@@ -23,96 +58,106 @@ def lambda_handler(event, context):
         blobkey = values.get("blobkey","notFound")
         containerName = values.get("containerName","notFound")
         mp_upload_id = values.get("mp_upload_id","notFound")
-        part_number = values.get("part_number","notFound")
+        part_number = int(values.get("part_number","notFound"))
         total_parts = values.get("total_parts",0)
-        active_directory_tenant_id = values.get("active_directory_tenant_id","notFound")
-        active_directory_application_id = values.get("active_directory_application_id","notFound")
-        active_directory_application_secret = values.get("active_directory_application_secret","notFound")
         sns_home = values.get("sns_home","notFound")
         sns_destination = values.get("sns_destination","notFound")
-        client = Client('sns')
-
-        token_credential = ClientSecretCredential(
-            active_directory_tenant_id,
-            active_directory_application_id,
-            active_directory_application_secret
-        )
-        blob_service_client = BlobServiceClient(
-            account_url=oauth_url,
-            credential=token_credential
-        )
-        print('credentials auth')
-        blob_client = blob_service_client.get_blob_client(container=containerName, blob=blobName)
-        print('begin download')
-        s3r = Resource('s3')
-        download_stream = blob_client.download_blob(
-            offset=currentOffset,
-            length=bytesToDownload
-        )
-        print(blobkey)
-        multipart_upload_part = s3r.MultipartUploadPart(
-            bucket_name,
-            blobkey,
-            mp_upload_id,
-            part_number)
-        print(multipart_upload_part)
-        mp_part_upload_response = multipart_upload_part.upload(
-            Body=download_stream.readall()
-        )
-        print(mp_part_upload_response)
+        # The part is uploaded with the checksum algorithm of the upload, Azure checks the range when validate_content is set
+        algorithm = values.get("checksum_algorithm")
+        # Parts of a compressed upload are compressed on their own, as consecutive gzip members or zstd frames
+        codec = values.get("compression")
+        client = get_client('sns')
+        s3 = get_client('s3')
 
-        # Check the parts manifest and see if it should trigger recombinator function
-        s3 = Client('s3')
-        rp_parts_list = s3.list_parts(
-            Bucket=bucket_name,
-            Key=blobkey,
-            UploadId=mp_upload_id
-        )
- 
-        # Check to see if the total parts are there and proceed or exit
-        parts = json.loads(json.dumps(rp_parts_list,default=str))
         try:
-            my_part = ([key for key in parts['Parts'] if key['PartNumber'] == int(part_number) ]).pop()
-            if(len(parts['Parts']) == total_parts):
+            # A retried part may have been stored before the failure, it is only downloaded again when missing or incomplete
+            # The stored size of a compressed part is unknown, those parts are always uploaded again
+            stored = uploaded_part(s3, bucket_name, blobkey, mp_upload_id, part_number, bytesToDownload) if current_retry_count > 0 and not codec else None
+            if stored is not None:
+                print("Part already uploaded - blob: ", blobName,' part: ', part_number, 'mp_upload_id: ', mp_upload_id)
+                mp_part_upload_response = stored
+            else:
+                # Cached per warm container - parts of the same upload reuse the AAD token and connections
+                blob_service_client = get_blob_service_client(
+                    active_directory_tenant_id,
+                    active_directory_application_id,
+                    active_directory_application_secret,
+                    oauth_url,
+                    governor
+                )
+                print('credentials auth')
+                blob_client = blob_service_client.get_blob_client(container=containerName, blob=blobName)
+                print('begin download')
+                s3r = get_resource('s3')
+                start = time.perf_counter()
+                with metrics.timer('AzureDownloadTime'):
+                    download_stream = blob_client.download_blob(
+                        offset=currentOffset,
+                        length=bytesToDownload,
+                        validate_content=values.get("validate_content", False)
+                    )
+                    body = download_stream.readall()
+                if codec:
+                    with metrics.timer('CompressTime'):
+                        body = compress_part(body, codec, values.get("compression_level", 6), part_number == total_parts)
+                    metrics.put('CompressedBytes', len(body), 'Bytes')
+                print(blobkey)
+                multipart_upload_part = s3r.MultipartUploadPart(
+                    bucket_name,
+                    blobkey,
+                    mp_upload_id,
+                    part_number)
+                print(multipart_upload_part)
+                upload_args = {'ChecksumAlgorithm': algorithm} if algorithm else {}
+                with metrics.timer('S3UploadTime'):
+                    mp_part_upload_response = multipart_upload_part.upload(
+                        Body=body,
+                        **upload_args
+                    )
+                print(mp_part_upload_response)
+                metrics.transferred(bytesToDownload, time.perf_counter() - start)
+
+            # Record the part in the completion tracker, only the part that completes the upload triggers the recombinator
+            if tracker is not None:
+                completed = tracker.record(mp_upload_id, part_number, mp_part_upload_response['ETag'], total_parts,
+                                           part_checksum(mp_part_upload_response, algorithm))
+            else:
+                # Without a tracker count the uploaded parts, every page of the listing since it stops at 1000 parts
+                paginator = s3.get_paginator('list_parts')
+                uploaded = 0
+                for page in paginator.paginate(Bucket=bucket_name, Key=blobkey, UploadId=mp_upload_id):
+                    uploaded += len(page.get('Parts', []))
+                completed = uploaded == total_parts
+            if completed:
                 part_output = {
                     "bucket_name": bucket_name ,
                     "blobkey": blobkey ,
                     "UploadId": mp_upload_id ,
-                    "ETag" : my_part.get("ETag","") ,
-                    "PartNumber" : my_part.get("PartNumber","")
+                    "ETag" : mp_part_upload_response['ETag'] ,
+                    "PartNumber" : part_number ,
+                    "total_parts": total_parts ,
+                    "run_id": values.get('run_id') ,
+                    "manifest_entry": values.get('manifest_entry')
                 }
+                # The recombinator reads the ETags from the tracker of this configuration
+                if 'config_ref' in values:
+                    part_output['config_ref'] = values['config_ref']
                 response = client.publish(
                     TargetArn=sns_destination,
                     Message=json.dumps({'default': json.dumps(part_output)}),
                     MessageStructure='json'
                 )
-            
-        except:
-            print("Something went wrong - phoning home for retry")
-            print("Failure Downloading - blob: ", blobName,' part: ', part_number, 'mp_upload_id: ', mp_upload_id)
-            inputParams = {
-                        'oauth_url': oauth_url,
-                        'currentOffset': currentOffset,
-                        'bytesToDownload':bytesToDownload,
-                        'bucket_name':bucket_name,
-                        'blobkey':blobkey,
-                        'blobName':blobName,
-                        'containerName':containerName,
-                        'mp_upload_id':mp_upload_id,
-                        'part_number':part_number,
-                        'active_directory_tenant_id':active_directory_tenant_id,
-                        'active_directory_application_id':active_directory_application_id,
-                        'active_directory_application_secret':active_directory_application_secret,
-                        'retries_active': retries_active,
-                        'current_retry_count': current_retry_count+1,
-                        'sns_home': sns_home,
-                        'sns_destination': sns_destination
-                    }
-            response = client.publish(
-                TargetArn=sns_home,
-                Message=json.dumps({'default': json.dumps(inputParams)}),
-                MessageStructure='json'
-            )
+
+        except Exception as error:
+            print("Something went wrong - scheduling a retry")
+            print("Failure Downloading - blob: ", blobName,' part: ', part_number, 'mp_upload_id: ', mp_upload_id, 'run_id: ', values.get('run_id'))
+            # The retry keeps every field of the message (total_parts and run_id included) with the retry count increased
+            response = scheduler.retry(values, 'current_retry_count', sns_home, error)
+            metrics.put('DeadLetters' if response == 'dead_letter' else 'Retries', 1)
+    if governor is not None:
+        governor.put_metrics(metrics)
+    metrics.flush()
+    log_cache_stats('blobcopy-large-file-part')
     return {
         'statusCode': 200,
         'body': json.dumps(response)
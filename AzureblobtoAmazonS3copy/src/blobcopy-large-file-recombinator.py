@@ -1,40 +1,64 @@
 import json
-from boto3 import client as Client
+from blobcopy_clients import get_client, log_cache_stats
+from blobcopy_manifest import record_copied
+from blobcopy_message import resolve_config
+from blobcopy_metrics import Metrics, record_queue_delay
+from blobcopy_tracker import get_upload_tracker
 
 # Function to combine downloaded parts
 def lambda_handler(event, context):
     response = event['Records'][0]['Sns'].get('Message','not found')
     values = json.loads(response)
+    metrics = Metrics('blobcopy-large-file-recombinator', values.get('run_id'))
+    record_queue_delay(metrics, event['Records'][0])
 
-    s3 = Client("s3")
+    s3 = get_client("s3")
 
     bucket_name = values.get("bucket_name","")
     blobkey = values.get("blobkey","")
     mp_upload_id = values.get("UploadId","")
     finalPartNumber = values.get("PartNumber","")
     print("Final part to trigger the recombinator was: ::::: ", finalPartNumber)
-    rp_parts_list = s3.list_parts(
-        Bucket=bucket_name,
-        Key=blobkey,
-        UploadId=mp_upload_id
-    )
-    parts = []
-    parts_raw = json.loads(json.dumps(rp_parts_list,default=str))
-    for item in parts_raw['Parts']:
-        parts.append({
-            "ETag" : item.get('ETag',''),
-            "PartNumber" : item.get("PartNumber")
-        })
+    total_parts = values.get("total_parts", 0)
+    # ETags come from the completion tracker the parts recorded them in, list_parts is only used without one
+    tracker = get_upload_tracker(resolve_config(values)) if 'config_ref' in values else None
+    if tracker is not None:
+        parts = tracker.parts(mp_upload_id)
+    else:
+        parts = []
+        paginator = s3.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=bucket_name, Key=blobkey, UploadId=mp_upload_id):
+            for item in page.get('Parts', []):
+                part = {
+                    "ETag" : item.get('ETag',''),
+                    "PartNumber" : item.get("PartNumber")
+                }
+                # Uploads created with an additional checksum must be completed with the checksum of every part
+                part.update({name: value for name, value in item.items() if name.startswith('Checksum')})
+                parts.append(part)
+    parts.sort(key=lambda part: part['PartNumber'])
 
-    mp_complete_response = s3.complete_multipart_upload(
-            Bucket=bucket_name,
-            Key=blobkey,
-            MultipartUpload={
-                'Parts': parts
-            },
-            UploadId=mp_upload_id
-    
-        )
+    with metrics.timer('CompleteTime'):
+        mp_complete_response = s3.complete_multipart_upload(
+                Bucket=bucket_name,
+                Key=blobkey,
+                MultipartUpload={
+                    'Parts': parts
+                },
+                UploadId=mp_upload_id
+            )
+    if tracker is not None:
+        tracker.clear(mp_upload_id, total_parts)
+    # The blob is in S3, the inventory manifest stops sending it again
+    if values.get('manifest_entry') and 'config_ref' in values:
+        try:
+            record_copied(resolve_config(values), [values['manifest_entry']])
+        except Exception as error:
+            print("Manifest update failed: ", error)
+    metrics.put('UploadsCompleted', 1)
+    metrics.put('PartsCompleted', len(parts))
+    metrics.flush()
+    log_cache_stats('blobcopy-large-file-recombinator')
     return {
         'statusCode': 200,
         'body': json.dumps(response)
@@ -1,5 +1,11 @@
 import json
-from boto3 import client as Client
+import time
+from blobcopy_accounts import LAUNCH_SCOPE, account_changed, account_config, account_entries
+from blobcopy_checkpoint import get_checkpoint_store
+from blobcopy_clients import get_client, log_cache_stats
+from blobcopy_message import launch_message
+from blobcopy_metrics import Metrics
+from blobcopy_uploads import reap
 from datetime import datetime
 from os import environ
 
@@ -21,42 +27,143 @@ def get_first_tag_value_for_secretDescription_for_key(secretDescription, key):
     nameTag = ([tag for tag in tags if tag['Key'] == key ])[0].get('Value')
     return nameTag
 
+# Check if isactive secret is set and the begindate has passed
+def qualifies(secrets):
+    processActive = secrets.get('isactive','notFound')
+    if processActive :
+        # Check if date greater than begindate secret
+        processStartDate = try_strptime(secrets.get('begindate','1911-01-01 00:00:00'),['%d-%b-%y','%m/%d/%Y','%Y-%m-%d %H:%M:%S','%Y%m%d'])
+        return processStartDate < datetime.today()
+    return False
+
+# Create json payload for the finder
+def launch_values(secrets, secret_arn, run_id):
+    secrets['secret_arn'] = secret_arn
+    secrets['oauth_url'] = secrets.get('bloburl','bloburlNotFound')
+    secrets['partitionSize'] = environ['partitionSize']
+    secrets['maxPartitionsPerFile'] = environ['maxPartitionsPerFile']
+    secrets['UseFullFilePath'] = environ['UseFullFilePath']
+    secrets['bucket_name'] = secrets.get('bucket_name','bucketNotFound')
+    # Correlation id of this copy run, every message of the run carries it
+    secrets['run_id'] = run_id
+    return secrets
+
+# The finder gets the secret reference, not the secret, and resolves the credentials itself
+def publish_launch(values):
+    # TODO: If sns_arn not found -> throw exception
+    sns_arn = values.get('sns_arn_l1','notFound')
+    client = get_client('sns')
+    response = client.publish(
+        TargetArn=sns_arn,
+        Message=json.dumps({'default': json.dumps(launch_message(values))}),
+        MessageStructure='json'
+    )
+    return response
+
+# Seconds of the invocation kept for the reaper, plus a safety margin
+def reap_reserve(secrets):
+    if secrets.get('reapIncompleteUploads', 'false') != 'true':
+        return 15.0
+    return 15.0 + float(secrets.get('reapSeconds', '30'))
+
+# One finder per account of the accounts list (see blobcopy_accounts.py), in priority order
+# Starts are spread launchStaggerSeconds apart, within the time left on this invocation once the reaper's time is
+# reserved, so the listings of the accounts do not all hit Azure and the download functions at the same moment
+def launch_accounts(secrets, secret_arn, context, metrics):
+    client = get_client('secretsmanager')
+    store = get_checkpoint_store(secrets)
+    launches = []
+    for entry in account_entries(secrets):
+        try:
+            values = account_launch(client, store, secrets, secret_arn, entry, metrics)
+        except Exception as error:
+            # A missing or unreadable account secret only skips that account, the others are launched
+            print('Account failed - account: ', entry['name'], ' error: ', error)
+            metrics.put('AccountsFailed', 1)
+            continue
+        if values is not None:
+            launches.append((entry, values))
+
+    stagger = float(secrets.get('launchStaggerSeconds', '10'))
+    if len(launches) > 1:
+        available = context.get_remaining_time_in_millis() / 1000.0 - reap_reserve(secrets)
+        stagger = max(0.0, min(stagger, available / (len(launches) - 1)))
+    for index, (entry, values) in enumerate(launches):
+        if index:
+            time.sleep(stagger)
+        # Every account gets its own run id, discovery checkpoints of the finders are kept under it
+        launched = time.time()
+        message = launch_values(values, entry['secret'], secrets['run_id'] + '-' + str(index))
+        try:
+            publish_launch(message)
+            store.put(LAUNCH_SCOPE, entry['name'], {'launched': launched, 'run_id': message['run_id']})
+        except Exception as error:
+            print('Account launch failed - account: ', entry['name'], ' error: ', error)
+            metrics.put('AccountsFailed', 1)
+            continue
+        print('Executing Azure Blob Copy Process - account: ', entry['name'], ' run: ', message['run_id'])
+        metrics.put('AccountsLaunched', 1)
+    return [values for _, values in launches]
+
+# Configuration of an account to launch, None when the account is skipped
+def account_launch(client, store, secrets, secret_arn, entry, metrics):
+    account_secret = json.loads(client.get_secret_value(SecretId=entry['secret'])['SecretString'])
+    if account_secret.get('baseSecret') != secret_arn:
+        # Without it the download and large file functions would not find the shared settings
+        print('Account secret does not name this secret as baseSecret - skipped account: ', entry['name'])
+        metrics.put('AccountsSkipped', 1)
+        return None
+    values = account_config(secrets, entry, account_secret)
+    if not qualifies(values):
+        print('Azure Blob Copy Process is disabled or no data to process - account: ', entry['name'])
+        return None
+    state = store.get(LAUNCH_SCOPE, entry['name']) or {}
+    if not account_changed(values, state.get('launched')):
+        print('No changes since the last launch - skipped account: ', entry['name'])
+        metrics.put('AccountsSkipped', 1)
+        return None
+    return values
+
+# Abort multipart uploads left behind by failed copies, within the time left on this invocation
+# Opt-in (the stack bucket aborts them with a lifecycle rule), only uploads under reapPrefix (default keyPrefix) of
+# the buckets copied to are aborted
+def reap_buckets(context, secrets, configs, metrics):
+    if secrets.get('reapIncompleteUploads', 'false') == 'true':
+        deadline = time.time() + context.get_remaining_time_in_millis() / 1000.0 - 15
+        # Accounts may copy to buckets (and prefixes) of their own
+        targets = dict.fromkeys((config.get('bucket_name', 'bucketNotFound'), config.get('reapPrefix', config.get('keyPrefix', ''))) for config in configs)
+        for bucket_name, prefix in targets:
+            aborted = reap(get_client('s3'), bucket_name, int(secrets.get('reapAfterHours', '72')), prefix, deadline=deadline)
+            print('Aborted incomplete multipart uploads: ', aborted, ' bucket: ', bucket_name, ' prefix: ', prefix)
+            metrics.put('UploadsReaped', aborted)
+
 def lambda_handler(event, context):
     secret_arn = environ['secret']
-    client = Client('secretsmanager')
+    client = get_client('secretsmanager')
     response = client.get_secret_value(
         SecretId = secret_arn
     )
     secrets = json.loads(response['SecretString'])
-    # Check if isactive secret equals True
-    processActive = secrets.get('isactive','notFound')
+    run_id = getattr(context, 'aws_request_id', 'local')
 
-    if processActive :
-        # Check if date greater than begindate secret 
-        processStartDate = try_strptime(secrets.get('begindate','1911-01-01 00:00:00'),['%d-%b-%y','%m/%d/%Y','%Y-%m-%d %H:%M:%S','%Y%m%d'])
-        # Create json payload
-        if processStartDate < datetime.today():
-            description = client.describe_secret(
-                SecretId = secret_arn
-            )
-            # TODO: If sns_arn not found -> throw exception
-            sns_arn = secrets.get('sns_arn_l1','notFound')
-            secrets['secret_arn'] = secret_arn
-            secrets['oauth_url'] = secrets.get('bloburl','bloburlNotFound')
-            secrets['partitionSize'] = environ['partitionSize']
-            secrets['maxPartitionsPerFile'] = environ['maxPartitionsPerFile']
-            secrets['UseFullFilePath'] = environ['UseFullFilePath']
-            secrets['bucket_name'] = secrets.get('bucket_name','bucketNotFound')
-
-            message = secrets
-            client = Client('sns')
-            response = client.publish(
-                TargetArn=sns_arn,
-                Message=json.dumps({'default': json.dumps(message)}),
-                MessageStructure='json'
-            )
-            print('Executing Azure Blob Copy Process')
-
-        else :
-            print('Azure Blob Copy Process is disabled or no data to process')
+    if secrets.get('accounts'):
+        secrets = launch_values(secrets, secret_arn, run_id)
+        metrics = Metrics('blobcopy-launch-qualification', run_id)
+        metrics.put('RunsStarted', 1)
+        launched = launch_accounts(secrets, secret_arn, context, metrics)
+        reap_buckets(context, secrets, [secrets] + launched, metrics)
+        metrics.flush()
+    elif qualifies(secrets):
+        secrets = launch_values(secrets, secret_arn, run_id)
+        metrics = Metrics('blobcopy-launch-qualification', run_id)
+        metrics.put('RunsStarted', 1)
+
+        publish_launch(secrets)
+        print('Executing Azure Blob Copy Process')
+        reap_buckets(context, secrets, [secrets], metrics)
+        metrics.flush()
+
+    else :
+        print('Azure Blob Copy Process is disabled or no data to process')
+    log_cache_stats('blobcopy-launch-qualification')
     return 'SUCCESS'
@@ -0,0 +1,82 @@
+import json
+from datetime import datetime, timedelta, timezone
+from blobcopy_clients import get_blob_service_client
+
+# Several storage accounts (or containers of them) scheduled by one launcher
+# The launcher secret lists the accounts under 'accounts', a json list (or json text) of entries:
+#   name        - account name used in logs, metrics and the launch state, defaults to the secret
+#   secret      - ARN of the account secret with the Azure credentials (tenantid, appid, appsecret, bloburl) and begindate
+#   priority    - accounts with a higher priority are launched first, default 0
+#   maxRequestRate - ceiling of the Azure requests/s of the account (governorMaxRate), needs the governor
+#                    a rate, not a cap on the functions copying the account at once
+#   containers  - containers to copy, lists or comma separated strings, default all containers
+#   changeCheck - changefeed skips the account when its change feed has no log written since the last launch,
+#                 none (default) launches the account on every run
+#   settings    - any other configuration values of this account (e.g. includePrefixes, bucket_name)
+# Account secrets name the launcher secret as baseSecret and inherit its settings, so the download and large file
+# functions resolve the same configuration from the config_ref of their messages
+
+LAUNCH_SCOPE = 'launcher-accounts'
+# Launcher values that are not inherited by the accounts
+BASE_ONLY = ('accounts', 'secret_arn', 'oauth_url')
+
+def account_entries(values):
+    entries = values.get('accounts') or []
+    if isinstance(entries, str):
+        entries = json.loads(entries)
+    for entry in entries:
+        entry.setdefault('name', entry['secret'])
+    # sorted() is stable, accounts of the same priority keep the order of the secret
+    return sorted(entries, key=lambda entry: -int(entry.get('priority', 0)))
+
+def account_entry(values, secret_arn):
+    for entry in account_entries(values):
+        if entry['secret'] == secret_arn:
+            return entry
+    return {'secret': secret_arn, 'name': secret_arn}
+
+# Configuration of one account: launcher secret < account secret < account entry
+def account_config(base, entry, account_secret):
+    config = {key: value for key, value in base.items() if key not in BASE_ONLY}
+    config.update(account_secret)
+    config.update(entry.get('settings', {}))
+    if entry.get('containers'):
+        config['includeContainers'] = entry['containers']
+    if entry.get('maxRequestRate'):
+        rate = float(entry['maxRequestRate'])
+        config['governorMaxRate'] = str(rate)
+        config['governorRate'] = str(min(rate, float(config.get('governorRate', '500'))))
+    if entry.get('changeCheck'):
+        config['changeCheck'] = entry['changeCheck']
+    config['account_name'] = entry['name']
+    return config
+
+# True when the account may have changed since the launch time (epoch seconds), the change feed of the account is
+# checked for log files written since then. Accounts without a change feed always count as changed
+def account_changed(values, launched, max_days=7):
+    if values.get('changeCheck', 'none') != 'changefeed' or launched is None:
+        return True
+    since = datetime.fromtimestamp(launched, timezone.utc)
+    today = datetime.now(timezone.utc)
+    if today - since > timedelta(days=max_days):
+        return True
+    from azure.core.exceptions import ResourceNotFoundError
+    blob_service_client = get_blob_service_client(
+        values.get('tenantid', 'notFound'),
+        values.get('appid', 'notFound'),
+        values.get('appsecret', 'notFound'),
+        values.get('oauth_url', values.get('bloburl', 'notFound'))
+    )
+    feed = blob_service_client.get_container_client('$blobchangefeed')
+    day = since.date()
+    try:
+        # Change feed logs are written under log/00/YYYY/MM/DD/hhmm/, only the days since the launch are listed
+        while day <= today.date():
+            for blob in feed.list_blobs(name_starts_with='log/00/' + day.strftime('%Y/%m/%d/')):
+                if blob.last_modified > since:
+                    return True
+            day += timedelta(days=1)
+    except ResourceNotFoundError:
+        print("No change feed - account: ", values.get('account_name'))
+        return True
+    return False
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import threading
+from blobcopy_clients import get_client
+
+# Checkpoint stores used by the finders to resume a listing run after a timeout
+# A checkpoint is a small json document (dict) saved under a scope (e.g. the run id) and a key (e.g. a shard id)
+
+# Durable store: one json object per scope in the target (or a dedicated) S3 bucket
+class S3CheckpointStore:
+
+    def __init__(self, bucket_name, prefix='_azs3copy/checkpoints/'):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.s3 = get_client('s3')
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def objectKey(self, scope):
+        return self.prefix + scope + '.json'
+
+    def list(self, scope):
+        with self.lock:
+            if scope not in self.cache:
+                try:
+                    body = self.s3.get_object(Bucket=self.bucket_name, Key=self.objectKey(scope))['Body'].read()
+                    self.cache[scope] = json.loads(body)
+                except self.s3.exceptions.NoSuchKey:
+                    self.cache[scope] = {}
+            return dict(self.cache[scope])
+
+    def get(self, scope, key):
+        return self.list(scope).get(key)
+
+    def put(self, scope, key, state):
+        self.list(scope)
+        with self.lock:
+            self.cache[scope][key] = state
+            # The whole scope document is rewritten, the lock keeps concurrent shard workers from losing updates
+            self.s3.put_object(
+                Bucket=self.bucket_name,
+                Key=self.objectKey(scope),
+                Body=json.dumps(self.cache[scope]).encode('utf-8'),
+                ContentType='application/json'
+            )
+
+    def clear(self, scope):
+        with self.lock:
+            self.cache.pop(scope, None)
+            self.s3.delete_object(Bucket=self.bucket_name, Key=self.objectKey(scope))
+
+# Local store backed by SQLite, used for local runs and tests
+class SqliteCheckpointStore:
+
+    def __init__(self, path='/tmp/azs3copy-checkpoints.db'):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS checkpoints (scope TEXT, key TEXT, state TEXT, PRIMARY KEY (scope, key))')
+
+    def list(self, scope):
+        with self.lock:
+            rows = self.conn.execute('SELECT key, state FROM checkpoints WHERE scope = ?', (scope,)).fetchall()
+        return {key: json.loads(state) for key, state in rows}
+
+    def get(self, scope, key):
+        with self.lock:
+            row = self.conn.execute('SELECT state FROM checkpoints WHERE scope = ? AND key = ?', (scope, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, scope, key, state):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO checkpoints (scope, key, state) VALUES (?, ?, ?)', (scope, key, json.dumps(state)))
+
+    def clear(self, scope):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM checkpoints WHERE scope = ?', (scope,))
+
+# Checkpoint scope of a finder launch, the secret and its begindate. A launch started again before its run finished
+# (a retried launch or the next schedule) resumes the checkpoints instead of listing from the start
+def launch_scope(values):
+    launch = values.get('secret_arn', 'secretArnNotFound') + '|' + values.get('begindate', '1911-01-01 00:00:00')
+    return 'launch-' + hashlib.sha256(launch.encode('utf-8')).hexdigest()[:32]
+
+# Pick the checkpoint backend from the SNS payload values (secret + launch settings)
+def get_checkpoint_store(values):
+    store = values.get('checkpointStore', 's3')
+    if store == 'sqlite':
+        return SqliteCheckpointStore(values.get('checkpointPath', os.path.join('/tmp', 'azs3copy-checkpoints.db')))
+    return S3CheckpointStore(
+        values.get('checkpointBucket', values.get('bucket_name', 'bucketNotFound')),
+        values.get('checkpointPrefix', '_azs3copy/checkpoints/')
+    )
@@ -0,0 +1,77 @@
+import base64
+import hashlib
+import threading
+
+# End to end integrity checks computed while the blob data streams through the copy functions
+#   S3 side    - parts are uploaded with an S3 additional checksum (checksumAlgorithm), S3 checks every part on receipt
+#                and keeps the composite checksum of the object
+#   Azure side - a streamed copy is hashed as it downloads and compared with the Content-MD5 of the blob, so is
+#                the parallel copy of the download function (ranges are hashed in blob order). The parts of the
+#                large file functions ask Azure for the MD5 of every range it returns (verifyAzureRanges)
+# The result is written as object metadata when the upload is created, the upload fails (and is aborted) on a mismatch
+
+# S3 additional checksum algorithm from the configuration, None when disabled
+def checksum_algorithm(values):
+    algorithm = values.get('checksumAlgorithm', 'SHA256').upper()
+    return None if algorithm == 'NONE' else algorithm
+
+# The checksum of an uploaded part, in the form CompleteMultipartUpload expects it
+def part_checksum(response, algorithm):
+    if algorithm is None:
+        return {}
+    return {'Checksum' + algorithm: response['Checksum' + algorithm]}
+
+# Base64 Content-MD5 of a blob (content settings of list_blobs, download properties or an inventory row)
+def content_md5(content_settings):
+    md5 = getattr(content_settings, 'content_md5', None)
+    return base64.b64encode(bytes(md5)).decode('ascii') if md5 else None
+
+# Object metadata recording what the copy verified, md5 is only given when the copy compares it with the blob
+def verification_metadata(md5, verified):
+    metadata = {}
+    if md5:
+        metadata['azure-content-md5'] = md5
+    if verified:
+        metadata['azs3copy-verified'] = verified
+    return metadata
+
+# Hashes the chunks of a streamed copy and compares the digest with the Content-MD5 of the blob at the end
+class Md5Verifier:
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.md5 = hashlib.md5(usedforsecurity=False)
+
+    def update(self, chunk):
+        self.md5.update(chunk)
+
+    def finish(self):
+        actual = base64.b64encode(self.md5.digest()).decode('ascii')
+        if actual != self.expected:
+            raise RuntimeError('Content-MD5 mismatch: azure ' + self.expected + ' copied ' + actual)
+
+# Hashes the ranges of a parallel copy in blob order while several threads download them. A thread waits until the
+# ranges before its own are hashed, so only the ranges in flight are held in memory. A failed range releases the
+# waiting threads
+class OrderedMd5Verifier(Md5Verifier):
+
+    def __init__(self, expected):
+        super().__init__(expected)
+        self.condition = threading.Condition()
+        self.next_part = 1
+        self.failed = False
+
+    def update_part(self, number, chunk):
+        with self.condition:
+            while self.next_part != number and not self.failed:
+                self.condition.wait()
+            if self.failed:
+                raise RuntimeError('Content-MD5 not verified: an earlier range failed')
+            self.md5.update(chunk)
+            self.next_part += 1
+            self.condition.notify_all()
+
+    def fail(self):
+        with self.condition:
+            self.failed = True
+            self.condition.notify_all()
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import threading
+import time
+from boto3 import client as Client
+from boto3 import resource as Resource
+
+# Module level cache of credentials and SDK clients, kept for the life of a warm lambda container
+# Azure clients are keyed on tenant/application/account url so every invocation (and every part of a large file)
+# reuses the same AAD token and pooled HTTPS connections instead of opening new ones
+
+TOKEN_REFRESH_MARGIN = 300
+
+cache_lock = threading.Lock()
+clients = {}
+cache_stats = {'client_hits': 0, 'client_misses': 0, 'token_hits': 0, 'token_requests': 0}
+
+def count(stat):
+    with cache_lock:
+        cache_stats[stat] += 1
+
+# Token credential wrapper that hands out the cached AAD token until it is close to expiry
+class CachedTokenCredential:
+
+    def __init__(self, credential):
+        self.credential = credential
+        self.lock = threading.Lock()
+        self.tokens = {}
+
+    def get_token(self, *scopes, **kwargs):
+        key = scopes + tuple(sorted(kwargs.items()))
+        with self.lock:
+            token = self.tokens.get(key)
+            if token is not None and token.expires_on - TOKEN_REFRESH_MARGIN > time.time():
+                count('token_hits')
+                return token
+            token = self.credential.get_token(*scopes, **kwargs)
+            self.tokens[key] = token
+            count('token_requests')
+            return token
+
+    def close(self):
+        self.credential.close()
+
+# The factory runs without the lock since it may build other cached clients (the governor store builds its
+# DynamoDB client), when two threads build the same client at once the first one stored is kept
+def cached(key, factory):
+    with cache_lock:
+        value = clients.get(key)
+        if value is not None:
+            cache_stats['client_hits'] += 1
+            return value
+        cache_stats['client_misses'] += 1
+    value = factory()
+    with cache_lock:
+        return clients.setdefault(key, value)
+
+def get_client(service):
+    return cached(('boto3', service), lambda: Client(service))
+
+def get_resource(service):
+    return cached(('boto3-resource', service), lambda: Resource(service))
+
+# The secret is part of the key (hashed) so a rotated application secret gets a new credential
+# With a governor (see blobcopy_governor.py) every request attempt of the client waits for a token of the account
+def get_blob_service_client(tenant_id, application_id, application_secret, account_url, governor=None):
+    # Azure SDKs are only needed by the functions that talk to Azure
+    from azure.identity import ClientSecretCredential
+    from azure.storage.blob import BlobServiceClient
+    secret_hash = hashlib.sha256(application_secret.encode('utf-8')).hexdigest()
+    hooks = {}
+    if governor is not None:
+        hooks = {'raw_request_hook': governor.before_request, 'raw_response_hook': governor.after_response}
+    return cached(
+        ('azure', tenant_id, application_id, secret_hash, account_url, governor is not None),
+        lambda: BlobServiceClient(
+            account_url=account_url,
+            credential=CachedTokenCredential(ClientSecretCredential(tenant_id, application_id, application_secret)),
+            **hooks
+        )
+    )
+
+# One json log line per invocation, hit counts grow while the container stays warm
+def log_cache_stats(function_name):
+    with cache_lock:
+        stats = dict(cache_stats)
+    stats['function'] = function_name
+    print(json.dumps({'clientCache': stats}))
@@ -0,0 +1,114 @@
+import io
+import struct
+import zlib
+from blobcopy_filter import compile_patterns, rule_list
+from blobcopy_planner import MIN_PART_SIZE
+
+# Optional compression of blobs while they are copied
+#   compression          - gzip or zstd, none (default) copies every blob as it is
+#   compressPatterns     - blob names to compress, glob patterns or regular expressions prefixed with 're:'
+#   compressContentTypes - content types to compress, e.g. text/csv, a trailing * matches a prefix (text/*)
+#   compressLevel        - codec level, default 6 for gzip and 3 for zstd
+# Without patterns or content types every blob is compressed. Blobs that Azure reports with a content encoding or
+# that have the suffix of a compressed format are always copied as they are.
+# The object gets the codec suffix (.gz, .zst) and Content-Encoding. Parts of the large file copy are compressed
+# on their own and stored as consecutive gzip members or zstd frames, which decompress to the whole blob
+
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+COMPRESSED_SUFFIXES = ('.gz', '.gzip', '.zst', '.zip', '.bz2', '.xz', '.snappy', '.parquet', '.orc', '.avro')
+# zstd skippable frame, decoders ignore its payload
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+
+def zstd_module():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('zstd compression needs the zstandard package in the lambda layer')
+    return zstandard
+
+class CompressionRules:
+
+    def __init__(self, values):
+        codec = values.get('compression', 'none')
+        if codec != 'none' and codec not in SUFFIXES:
+            raise ValueError('compression must be none, gzip or zstd, not ' + codec)
+        self.codec = codec if codec in SUFFIXES else None
+        self.patterns = compile_patterns(rule_list(values.get('compressPatterns')))
+        self.content_types = [content_type.lower() for content_type in rule_list(values.get('compressContentTypes'))]
+        self.level = int(values.get('compressLevel', str(DEFAULT_LEVELS.get(self.codec, 0))))
+
+    def content_type_matches(self, content_type):
+        content_type = (content_type or '').split(';')[0].strip().lower()
+        for rule in self.content_types:
+            if content_type == rule or (rule.endswith('*') and content_type.startswith(rule[:-1])):
+                return True
+        return False
+
+    # Codec of a blob, None when it is copied as it is
+    def codec_for(self, name, content_type=None, content_encoding=None):
+        if self.codec is None or content_encoding or name.lower().endswith(COMPRESSED_SUFFIXES):
+            return None
+        if self.patterns is None and not self.content_types:
+            return self.codec
+        if self.patterns is not None and self.patterns.match(name):
+            return self.codec
+        if self.content_type_matches(content_type):
+            return self.codec
+        return None
+
+def compressor(codec, level):
+    if codec == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    return zstd_module().ZstdCompressor(level=level).compressobj()
+
+# File like object that compresses a readable source as it is read, for upload_fileobj
+class CompressingReader(io.RawIOBase):
+
+    def __init__(self, source, codec, level, chunk_size=1048576):
+        self.source = source
+        self.compressor = compressor(codec, level)
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self.buffer and self.compressor is not None:
+            data = self.source.read(self.chunk_size)
+            if data:
+                self.bytes_in += len(data)
+                self.buffer = self.compressor.compress(data)
+            else:
+                self.buffer = self.compressor.flush()
+                self.compressor = None
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        self.bytes_out += size
+        return size
+
+def open_compressed(source, codec, level, buffer_size=1048576):
+    return io.BufferedReader(CompressingReader(source, codec, level), buffer_size=buffer_size)
+
+# Compress one part of a multipart copy, parts other than the last one must stay at least MIN_PART_SIZE
+def compress_part(data, codec, level, last):
+    part_compressor = compressor(codec, level)
+    body = part_compressor.compress(data) + part_compressor.flush()
+    if last or len(body) >= MIN_PART_SIZE:
+        return body
+    if codec == 'gzip':
+        # Stored deflate blocks are never smaller than the part itself
+        stored = zlib.compressobj(0, zlib.DEFLATED, 31)
+        return stored.compress(data) + stored.flush()
+    padding = max(0, MIN_PART_SIZE - len(body) - 8)
+    return body + struct.pack('<II', ZSTD_SKIPPABLE_MAGIC, padding) + bytes(padding)
+
+# Object metadata of a compressed copy, on top of the verification metadata
+def compression_metadata(metadata, codec):
+    if codec:
+        metadata = dict(metadata, **{'azs3copy-compression': codec})
+    return metadata
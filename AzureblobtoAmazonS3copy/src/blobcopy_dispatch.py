@@ -0,0 +1,225 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from blobcopy_clients import get_client
+from blobcopy_message import BlobInfo, pack_messages
+
+# Batched dispatch of finder messages through SNS PublishBatch or SQS SendMessageBatch
+# Messages are buffered per target, flushed in groups of 10 on a small thread pool and only failed entries are retried
+# Messages of small blobs can also be packed several to a message, so one download invocation copies all of them
+
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 262144
+DT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class SnsBatchBackend:
+
+    def __init__(self):
+        self.client = get_client('sns')
+
+    # Bytes of a message in the batch request, SNS counts the escaped json of the message structure
+    def entry_size(self, message):
+        return len(json.dumps({'default': message}).encode('utf-8'))
+
+    # Returns the ids of the entries that failed with a retryable error
+    def send(self, target, entries):
+        response = self.client.publish_batch(
+            TopicArn=target,
+            PublishBatchRequestEntries=[
+                {'Id': entry_id, 'Message': json.dumps({'default': message}), 'MessageStructure': 'json'}
+                for entry_id, message in entries
+            ]
+        )
+        return failed_entries(response)
+
+class SqsBatchBackend:
+
+    def __init__(self):
+        self.client = get_client('sqs')
+
+    def entry_size(self, message):
+        return len(message.encode('utf-8'))
+
+    def send(self, target, entries):
+        response = self.client.send_message_batch(
+            QueueUrl=target,
+            Entries=[{'Id': entry_id, 'MessageBody': message} for entry_id, message in entries]
+        )
+        return failed_entries(response)
+
+# Sender faults (bad message, missing topic) will fail again, they are reported instead of retried
+def failed_entries(response):
+    retry = []
+    for failure in response.get('Failed', []):
+        if failure.get('SenderFault'):
+            print("Dispatch rejected - id: ", failure.get('Id'), ' code: ', failure.get('Code'), ' message: ', failure.get('Message'))
+            raise RuntimeError('Dispatch rejected: ' + str(failure.get('Code')))
+        retry.append(failure.get('Id'))
+    return retry
+
+class BatchDispatcher:
+
+    def __init__(self, backend, concurrency=4, max_attempts=5, pack_size=1, pack_max_size=0):
+        self.backend = backend
+        self.max_attempts = max_attempts
+        self.pack_size = pack_size
+        self.pack_max_size = pack_max_size
+        self.pack_lock = threading.Lock()
+        self.packs = {}
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        # Bound the number of batches waiting on the pool so a fast listing cannot buffer the whole inventory
+        self.slots = threading.BoundedSemaphore(concurrency * 4)
+        self.lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.buffers = {}
+        self.buffer_bytes = {}
+        # Batches handed to the pool and not finished yet, drain waits on the condition until none is left
+        self.pending = 0
+        self.idle = threading.Condition(threading.Lock())
+        self.errors = []
+        self.sent = 0
+        self.calls = 0
+        self.blobs = 0
+        self.bytes = 0
+
+    # Blobs and bytes handed to the dispatcher, for the metrics of the finders
+    def count_blob(self, size):
+        with self.stats_lock:
+            self.blobs += 1
+            self.bytes += size
+
+    def add(self, target, message):
+        entry_size = self.backend.entry_size(message)
+        with self.lock:
+            buffer = self.buffers.setdefault(target, [])
+            if buffer and self.buffer_bytes[target] + entry_size > MAX_BATCH_BYTES:
+                self.submit(target, self.pop_buffer(target))
+                buffer = self.buffers.setdefault(target, [])
+            buffer.append(message)
+            self.buffer_bytes[target] = self.buffer_bytes.get(target, 0) + entry_size
+            if len(buffer) >= MAX_BATCH_ENTRIES:
+                self.submit(target, self.pop_buffer(target))
+
+    # Called with the lock held
+    def pop_buffer(self, target):
+        self.buffer_bytes.pop(target, None)
+        return self.buffers.pop(target)
+
+    # Blobs up to pack_max_size bytes are packed pack_size to a message, larger ones are sent on their own
+    def add_packed(self, target, message, size):
+        if self.pack_size <= 1 or size > self.pack_max_size:
+            self.add(target, message)
+            return
+        with self.pack_lock:
+            pack = self.packs.setdefault(target, [])
+            pack.append(message)
+            if len(pack) >= self.pack_size:
+                self.add(target, pack_messages(self.packs.pop(target)))
+
+    def flush_packs(self):
+        with self.pack_lock:
+            for target in list(self.packs):
+                self.add(target, pack_messages(self.packs.pop(target)))
+
+    # Called with the lock held
+    def submit(self, target, messages):
+        self.slots.acquire()
+        with self.idle:
+            self.pending += 1
+        self.pool.submit(self.send_batch, target, messages)
+
+    # Errors are kept for every later drain, messages of the failed batch are lost
+    def send_batch(self, target, messages):
+        try:
+            self.send(target, messages)
+        except Exception as error:
+            with self.idle:
+                self.errors.append(error)
+        finally:
+            self.slots.release()
+            with self.idle:
+                self.pending -= 1
+                if self.pending == 0:
+                    self.idle.notify_all()
+
+    def send(self, target, messages):
+        pending = {str(i): message for i, message in enumerate(messages)}
+        for attempt in range(self.max_attempts):
+            failed = self.backend.send(target, list(pending.items()))
+            with self.stats_lock:
+                self.calls += 1
+                self.sent += len(pending) - len(failed)
+            pending = {entry_id: pending[entry_id] for entry_id in failed}
+            if not pending:
+                return
+            # Exponential backoff with full jitter before retrying the failed entries only
+            time.sleep(random.uniform(0, min(5, 0.1 * (2 ** attempt))))
+        raise RuntimeError('Dispatch failed after ' + str(self.max_attempts) + ' attempts for ' + str(len(pending)) + ' messages to ' + target)
+
+    # Flush every buffer and wait until all messages handed to the dispatcher so far are sent
+    # Every caller waits for all batches in flight, including the ones another thread submitted
+    def drain(self):
+        self.flush_packs()
+        with self.lock:
+            for target in list(self.buffers):
+                self.submit(target, self.pop_buffer(target))
+        with self.idle:
+            self.idle.wait_for(lambda: self.pending == 0)
+            if self.errors:
+                raise self.errors[0]
+
+    def put_metrics(self, metrics):
+        metrics.put('BlobsDispatched', self.blobs)
+        metrics.put('BytesDispatched', self.bytes, 'Bytes')
+        metrics.put('MessagesSent', self.sent)
+        metrics.put('BatchCalls', self.calls)
+
+    def close(self):
+        self.drain()
+        self.pool.shutdown()
+        print("Dispatched messages: ", self.sent, " batch calls: ", self.calls)
+
+# Pick the dispatch backend from the SNS payload values
+def get_dispatcher(values):
+    backend = SqsBatchBackend() if values.get('dispatchBackend', 'sns') == 'sqs' else SnsBatchBackend()
+    return BatchDispatcher(
+        backend,
+        concurrency=int(values.get('dispatchConcurrency', '4')),
+        max_attempts=int(values.get('dispatchMaxAttempts', '5')),
+        pack_size=int(values.get('packBlobs', '25')),
+        pack_max_size=int(values.get('packMaxSize', '1048576'))
+    )
+
+# SNS topics that trigger the download and large file functions, or their queues with the SQS dispatch backend
+def dispatch_targets(values):
+    if values.get('dispatchBackend', 'sns') == 'sqs':
+        return values.get('sqs_url_l2', 'notFound'), values.get('sqs_url_l3', 'notFound')
+    return values.get('sns_arn_l2', 'notFound'), values.get('sns_arn_l3', 'notFound')
+
+# Queue a single blob for the download target or, when it needs the multipart fan-out, for the large file target
+# The part size is planned per blob and never carries over to the next one
+def publish_blob(dispatcher, values, containerName, blob, fileTime, planner, UseFullFilePath, download_target, large_file_target):
+    size = blob.size
+    dispatcher.count_blob(size)
+    if planner.is_large(size):
+        b = BlobInfo.fromBlob(containerName, blob.name, UseFullFilePath, fileTime.strftime(DT_FORMAT), size, planner.plan(size).part_size, values.get('secret_arn', 'secretArnNotFound'), blob.content_settings, values.get('run_id'), blob.etag,
+                              values.get('keyPrefix', ''))
+        print("Sent for Large File Processing - blob: ", blob.name)
+        dispatcher.add(large_file_target, b.toJSON())
+        return
+    b = BlobInfo.fromBlob(containerName, blob.name, UseFullFilePath, fileTime.strftime(DT_FORMAT), size, planner.partition_size, values.get('secret_arn', 'secretArnNotFound'), blob.content_settings, values.get('run_id'), blob.etag,
+                          values.get('keyPrefix', ''))
+    print("Sent for download - blob: ", blob.name)
+    # Small blobs are packed several to a message (packBlobs, packMaxSize)
+    dispatcher.add_packed(download_target, b.toJSON(), size)
+
+# Queue a blob unless the inventory manifest (None without one) already has it, True when it was queued
+def publish_new_blob(dispatcher, manifest, values, containerName, blob, planner, UseFullFilePath, download_target, large_file_target):
+    if manifest and not manifest.needs_copy(blob):
+        return False
+    publish_blob(dispatcher, values, containerName, blob, blob.last_modified, planner, UseFullFilePath, download_target, large_file_target)
+    if manifest:
+        manifest.record(blob)
+    return True
@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+from urllib.parse import unquote, urlparse
+from blobcopy_accounts import account_entries
+from blobcopy_clients import get_client
+from blobcopy_message import resolve_config
+
+# Azure Event Grid blob events, relayed from the Event Grid webhook to the blob events function through a queue
+# Both the Event Grid schema (eventType) and the CloudEvents 1.0 schema (type) are accepted
+#   eventQueue     - sqs (default, sqs_url_events) or sqlite (at eventQueuePath) for local runs and tests
+
+BLOB_CREATED = 'Microsoft.Storage.BlobCreated'
+BLOB_DELETED = 'Microsoft.Storage.BlobDeleted'
+SUBSCRIPTION_VALIDATION = 'Microsoft.EventGrid.SubscriptionValidationEvent'
+BLOB_EVENTS = (BLOB_CREATED, BLOB_DELETED)
+MAX_BATCH_ENTRIES = 10
+
+def event_type(event):
+    return event.get('eventType', event.get('type'))
+
+# Account url, container and blob name of a blob event, from data.url (https://<account>.blob.core.windows.net/c/b)
+def blob_location(event):
+    url = urlparse(event['data']['url'])
+    container, _, blob = url.path.lstrip('/').partition('/')
+    return account_key(url.scheme + '://' + url.netloc), unquote(container), unquote(blob)
+
+def account_key(url):
+    return url.rstrip('/').lower()
+
+# Milliseconds between the event in Azure and now, None when the event has no time
+def event_age_ms(event):
+    event_time = event.get('eventTime', event.get('time'))
+    if not event_time:
+        return None
+    return max(0.0, (datetime.now().astimezone() - datetime.fromisoformat(event_time)).total_seconds() * 1000)
+
+# Configuration of every storage account the events may come from, by account url
+# With an accounts list (see blobcopy_accounts.py) every account resolves its merged configuration
+def event_configs(values):
+    configs = {}
+    entries = account_entries(values)
+    if not entries:
+        configs[account_key(values.get('oauth_url', values.get('bloburl', 'bloburlNotFound')))] = values
+    for entry in entries:
+        config = resolve_config({'config_ref': entry['secret']})
+        configs[account_key(config['oauth_url'])] = config
+    return configs
+
+class SqsEventQueue:
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.sqs = get_client('sqs')
+
+    def send(self, events):
+        for start in range(0, len(events), MAX_BATCH_ENTRIES):
+            batch = events[start:start + MAX_BATCH_ENTRIES]
+            response = self.sqs.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(index), 'MessageBody': json.dumps(event)} for index, event in enumerate(batch)]
+            )
+            if response.get('Failed'):
+                # Event Grid retries the whole delivery, duplicates are copied again which is harmless
+                raise RuntimeError('Relay failed for ' + str(len(response['Failed'])) + ' events')
+
+# Local stand-in of the event queue, receive returns SQS shaped records for the blob events function
+class SqliteEventQueue:
+
+    def __init__(self, path='/tmp/azs3copy-events.db'):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT)')
+
+    def send(self, events):
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT INTO events (body) VALUES (?)', [(json.dumps(event),) for event in events])
+
+    def receive(self, limit=MAX_BATCH_ENTRIES):
+        with self.lock, self.conn:
+            rows = self.conn.execute('SELECT id, body FROM events ORDER BY id LIMIT ?', (limit,)).fetchall()
+            self.conn.executemany('DELETE FROM events WHERE id = ?', [(row[0],) for row in rows])
+        return [{'messageId': str(uuid.uuid4()), 'body': body} for _, body in rows]
+
+def get_event_queue(values):
+    if values.get('eventQueue', 'sqs') == 'sqlite':
+        return SqliteEventQueue(values.get('eventQueuePath', os.path.join('/tmp', 'azs3copy-events.db')))
+    return SqsEventQueue(values.get('sqs_url_events', 'queueNotFound'))
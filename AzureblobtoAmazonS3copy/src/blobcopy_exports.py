@@ -0,0 +1,89 @@
+import base64
+import re
+from datetime import timezone
+
+# Selection of Azure Cost Management exports, only the newest export of every billing period is copied
+#   exportSelection - latest copies the newest export of every billing period folder, none (default) copies every blob
+# Exports write a new cumulative month to date export every day under the folder of the billing period:
+#   <directory>/<export>/<YYYYMMDD-YYYYMMDD>/<export>_<guid>.csv                  one file per export
+#   <directory>/<export>/<YYYYMMDD-YYYYMMDD>/<run id>/part_0_0001.csv, manifest.json   one folder per export run
+# The export with the latest last modified date wins, the others are superseded and skipped. Blobs outside such
+# folders are copied as usual
+
+PERIOD = re.compile(r'^\d{8}-\d{8}$')
+
+# Billing period folder and export (file or run folder) of a blob, None when the blob is not in an export layout
+def export_location(name):
+    segments = name.split('/')
+    for index in range(len(segments) - 2, -1, -1):
+        if PERIOD.match(segments[index]):
+            period = '/'.join(segments[:index + 1])
+            if index == len(segments) - 2:
+                return period, name
+            return period, '/'.join(segments[:index + 2])
+    return None
+
+class ExportSelector:
+
+    def __init__(self, values):
+        self.enabled = values.get('exportSelection', 'none') == 'latest'
+        self.periods = {}
+        self.superseded = 0
+
+    # True when the blob belongs to an export and is held back until its container is listed
+    def hold(self, container, blob):
+        if not self.enabled:
+            return False
+        location = export_location(blob.name)
+        if location is None:
+            return False
+        period, export = location
+        exports = self.periods.setdefault((container, period), {})
+        latest, blobs = exports.setdefault(export, [blob.last_modified, []])
+        if blob.last_modified > latest:
+            exports[export][0] = blob.last_modified
+        blobs.append(blob)
+        return True
+
+    # Held blobs of a container as inventory rows, checkpointed when the listing of the container is handed over
+    # to the next execution
+    def save(self, container):
+        rows = []
+        for key, exports in self.periods.items():
+            if key[0] != container:
+                continue
+            for _, blobs in exports.values():
+                for blob in blobs:
+                    settings = blob.content_settings
+                    rows.append({
+                        'Name': blob.name,
+                        'Content-Length': blob.size,
+                        'Etag': blob.etag,
+                        'Last-Modified': blob.last_modified.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                        'Content-Type': settings.content_type,
+                        'Content-Encoding': settings.content_encoding,
+                        'Content-Language': settings.content_language,
+                        'Content-MD5': base64.b64encode(settings.content_md5).decode('ascii') if settings.content_md5 else None
+                    })
+        return rows
+
+    # Hold the blobs saved by the previous execution again
+    def restore(self, container, rows):
+        from blobcopy_inventory import row_to_blob
+        for row in rows:
+            self.hold(container, row_to_blob(row, container))
+
+    # Blobs of the newest export of every billing period of the container
+    def release(self, container):
+        for key in [key for key in self.periods if key[0] == container]:
+            exports = self.periods.pop(key)
+            newest = max(exports, key=lambda export: (exports[export][0], export))
+            for export, (_, blobs) in exports.items():
+                if export != newest:
+                    print("Superseded export skipped - container: ", container, ' export: ', export)
+                    self.superseded += len(blobs)
+            yield from exports[newest][1]
+
+    def put_metrics(self, metrics):
+        if self.enabled:
+            metrics.put('ExportsSuperseded', self.superseded)
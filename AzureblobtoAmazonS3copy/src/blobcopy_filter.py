@@ -0,0 +1,57 @@
+import fnmatch
+import re
+from datetime import timezone
+
+# Blob filter rules compiled once per invocation from the SNS payload values
+#   includePrefixes  - prefixes passed to list_blobs(name_starts_with=...) so Azure only returns matching blobs
+#   includePatterns  - blob names to keep, glob patterns or regular expressions prefixed with 're:'
+#   excludePatterns  - blob names to skip, same syntax, applied after includePatterns
+#   minSize/maxSize  - blob size limits in bytes
+#   includeContainers - containers to list, default every container the application can read
+# Rules are lists or comma separated strings, since the secret only holds strings
+
+# Make a datetime timezone aware, Azure returns UTC datetimes and the begindate secret is UTC
+def to_utc(dt):
+    if dt is None or dt.tzinfo is not None:
+        return dt
+    return dt.replace(tzinfo=timezone.utc)
+
+def rule_list(value):
+    if not value:
+        return []
+    if isinstance(value, list):
+        return value
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def compile_patterns(patterns):
+    if not patterns:
+        return None
+    sources = [p[3:] if p.startswith('re:') else fnmatch.translate(p) for p in patterns]
+    return re.compile('|'.join('(?:' + source + ')' for source in sources))
+
+class BlobFilter:
+
+    def __init__(self, values):
+        self.prefixes = rule_list(values.get('includePrefixes')) or [None]
+        self.include = compile_patterns(rule_list(values.get('includePatterns')))
+        self.exclude = compile_patterns(rule_list(values.get('excludePatterns')))
+        self.minSize = int(values.get('minSize', '0'))
+        maxSize = values.get('maxSize')
+        self.maxSize = int(maxSize) if maxSize else None
+        self.containers = set(rule_list(values.get('includeContainers')))
+
+    def container_matches(self, name):
+        return not self.containers or name in self.containers
+
+    # Prefix check for blobs that were not listed with name_starts_with (e.g. inventory reports)
+    def in_prefixes(self, name):
+        return any(prefix is None or name.startswith(prefix) for prefix in self.prefixes)
+
+    def matches(self, blob):
+        if blob.size < self.minSize or (self.maxSize is not None and blob.size > self.maxSize):
+            return False
+        if self.include is not None and not self.include.match(blob.name):
+            return False
+        if self.exclude is not None and self.exclude.match(blob.name):
+            return False
+        return True
@@ -0,0 +1,239 @@
+import os
+import random
+import threading
+import time
+from blobcopy_clients import cached, get_client
+
+# Adaptive rate governor shared by every function that reads from the same storage account
+# A token bucket per account url sits in a shared store. Every Azure request (SDK retries and download chunks
+# included) takes a token first, and containers lease a few tokens at a time so the store is not called per request.
+# The refill rate adapts itself:
+#   throttled - a 503 ServerBusy, 500 OperationTimedOut or 429 response cuts the rate by governorBackoff (default 0.5),
+#               at most once per governorCooldownSeconds, and drops the local lease so the next requests wait
+#   succeeded - every successful response raises the rate by governorRampStep requests/s once the cooldown is over
+# so the fan-out settles close to the account limits instead of swinging between overload and a burst of retries
+
+THROTTLE_CODES = ('ServerBusy', 'OperationTimedOut')
+# Conditional writes of one bucket item before the store gives up on a contended update
+MAX_UPDATE_ATTEMPTS = 8
+
+class GovernorContended(Exception):
+    pass
+
+class BucketState:
+
+    def __init__(self, tokens, rate, updated, throttled=0.0, version=0):
+        self.tokens = tokens
+        self.rate = rate
+        self.updated = updated
+        self.throttled = throttled
+        self.version = version
+
+class TokenBucket:
+
+    def __init__(self, rate, burst, min_rate, max_rate, ramp_step, backoff, cooldown):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.ramp_step = ramp_step
+        self.backoff = backoff
+        self.cooldown = cooldown
+
+    def initial(self, now):
+        return BucketState(self.burst, self.rate, now)
+
+    # Refill, apply the successes reported since the last call, then grant up to count tokens
+    # Returns the new state, the tokens granted and the seconds to wait when none could be granted
+    def take(self, state, now, count, successes):
+        if successes and now - state.throttled > self.cooldown:
+            state.rate = min(self.max_rate, state.rate + self.ramp_step * successes)
+        state.tokens = min(self.burst, state.tokens + (now - state.updated) * state.rate)
+        state.updated = now
+        # A refill that lands a rounding error short of a whole token still grants it, instead of waiting for nanoseconds
+        granted = min(count, int(state.tokens + 1e-9))
+        state.tokens -= granted
+        wait = 0.0 if granted else (1 - state.tokens) / state.rate
+        return state, granted, wait
+
+    def throttle(self, state, now):
+        if now - state.throttled > self.cooldown:
+            state.rate = max(self.min_rate, state.rate * self.backoff)
+            state.throttled = now
+            # Tokens already in the bucket were refilled at the old rate
+            state.tokens = min(state.tokens, 0.0)
+        return state
+
+# Shared store: DynamoDB table with bucket (hash), updated with a version condition so concurrent containers never
+# hand out the same tokens twice
+class DynamoDBGovernorStore:
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.dynamodb = get_client('dynamodb')
+
+    def update(self, key, bucket, change):
+        for attempt in range(MAX_UPDATE_ATTEMPTS):
+            item = self.dynamodb.get_item(TableName=self.table_name, Key={'bucket': {'S': key}}, ConsistentRead=True).get('Item')
+            now = time.time()
+            if item is None:
+                state = bucket.initial(now)
+                condition = {'ConditionExpression': 'attribute_not_exists(bucket)'}
+            else:
+                state = BucketState(float(item['tokens']['N']), float(item['rate']['N']), float(item['updated']['N']),
+                                    float(item['throttled']['N']), int(item['version']['N']))
+                condition = {'ConditionExpression': 'version = :version', 'ExpressionAttributeValues': {':version': {'N': str(state.version)}}}
+            state, result = change(state, now)
+            try:
+                self.dynamodb.put_item(
+                    TableName=self.table_name,
+                    Item={
+                        'bucket': {'S': key},
+                        'tokens': {'N': repr(state.tokens)},
+                        'rate': {'N': repr(state.rate)},
+                        'updated': {'N': repr(state.updated)},
+                        'throttled': {'N': repr(state.throttled)},
+                        'version': {'N': str(state.version + 1)}
+                    },
+                    **condition
+                )
+                return state, result
+            except self.dynamodb.exceptions.ConditionalCheckFailedException:
+                # Another container updated the item first, back off with full jitter before reading it again
+                time.sleep(random.uniform(0, min(1.0, 0.02 * (2 ** attempt))))
+        raise GovernorContended('Governor bucket ' + key + ' contended after ' + str(MAX_UPDATE_ATTEMPTS) + ' attempts')
+
+# Local store backed by SQLite, used for local runs, tests and the pipeline benchmark
+class SqliteGovernorStore:
+
+    def __init__(self, path='/tmp/azs3copy-governor.db', busy_timeout=5.0):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.locked = sqlite3.OperationalError
+        self.conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS buckets (bucket TEXT PRIMARY KEY, tokens REAL, rate REAL, updated REAL, throttled REAL, version INTEGER)')
+
+    def update(self, key, bucket, change):
+        with self.lock:
+            # BEGIN IMMEDIATE serializes processes sharing the database file
+            try:
+                self.conn.execute('BEGIN IMMEDIATE')
+            except self.locked as error:
+                # Another process held the database for the whole busy timeout
+                raise GovernorContended('Governor bucket ' + key + ' contended: ' + str(error))
+            try:
+                row = self.conn.execute('SELECT tokens, rate, updated, throttled, version FROM buckets WHERE bucket = ?', (key,)).fetchone()
+                now = time.time()
+                state = BucketState(*row) if row else bucket.initial(now)
+                state, result = change(state, now)
+                self.conn.execute('INSERT OR REPLACE INTO buckets (bucket, tokens, rate, updated, throttled, version) VALUES (?, ?, ?, ?, ?, ?)',
+                                  (key, state.tokens, state.rate, state.updated, state.throttled, state.version + 1))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return state, result
+
+# Governor of one storage account in a warm container, its hooks are attached to the Blob client of the account
+class AzureGovernor:
+
+    def __init__(self, store, key, bucket, lease=10, max_wait=60):
+        self.store = store
+        self.key = key
+        self.bucket = bucket
+        self.lease = lease
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.leased = 0
+        self.successes = 0
+        self.stats = {'requests': 0, 'throttled': 0, 'waited_seconds': 0.0}
+
+    # raw_request_hook, called before every attempt of every Azure request
+    def before_request(self, request):
+        with self.lock:
+            self.stats['requests'] += 1
+            if self.leased > 0:
+                self.leased -= 1
+                return
+        # The lock is not held while waiting, threads that still have leased tokens go ahead
+        granted = self.acquire()
+        with self.lock:
+            self.leased += granted - 1
+
+    # Waits until the shared bucket grants at least one token
+    def acquire(self):
+        deadline = time.time() + self.max_wait
+        while True:
+            with self.lock:
+                successes, self.successes = self.successes, 0
+            try:
+                state, (granted, wait) = self.store.update(self.key, self.bucket, lambda state, now: self.take(state, now, successes))
+            except GovernorContended as error:
+                # Never block a copy for good on a contended bucket, the request goes ahead
+                print("Governor update failed - account: ", self.key, ' error: ', error)
+                return 1
+            if granted:
+                return granted
+            if time.time() + wait > deadline:
+                # Never block a copy for good on a misconfigured bucket, the request goes ahead
+                print("Governor wait exceeded - account: ", self.key, ' rate: ', state.rate)
+                return 1
+            with self.lock:
+                self.stats['waited_seconds'] += wait
+            time.sleep(wait)
+
+    def take(self, state, now, successes):
+        state, granted, wait = self.bucket.take(state, now, self.lease, successes)
+        return state, (granted, wait)
+
+    # raw_response_hook, called with the response of every attempt
+    def after_response(self, response):
+        http_response = response.http_response
+        status = http_response.status_code
+        code = http_response.headers.get('x-ms-error-code', '')
+        if status == 429 or status == 503 or (status == 500 and code in THROTTLE_CODES):
+            with self.lock:
+                self.stats['throttled'] += 1
+                self.leased = 0
+            try:
+                state, _ = self.store.update(self.key, self.bucket, lambda state, now: (self.bucket.throttle(state, now), None))
+            except GovernorContended as error:
+                # Another container is updating the bucket, it sees the same throttling
+                print("Governor update failed - account: ", self.key, ' error: ', error)
+                return
+            print("Azure throttled - account: ", self.key, ' status: ', status, ' code: ', code, ' rate: ', round(state.rate, 1))
+        elif status < 400:
+            with self.lock:
+                self.successes += 1
+
+    # Throttles and waits since the last call
+    def put_metrics(self, metrics):
+        with self.lock:
+            stats, self.stats = self.stats, {'requests': 0, 'throttled': 0, 'waited_seconds': 0.0}
+        metrics.put('AzureThrottled', stats['throttled'])
+        metrics.put('GovernorWait', stats['waited_seconds'] * 1000, 'Milliseconds')
+
+# Governor of the storage account, cached per warm container like the clients, None when no store is configured
+def get_governor(values):
+    store = values.get('governorStore', 'dynamodb' if 'governorTable' in values else 'none')
+    if store == 'none':
+        return None
+    key = values.get('oauth_url', values.get('bloburl', 'urlNotFound'))
+    def governor():
+        if store == 'sqlite':
+            backend = SqliteGovernorStore(values.get('governorPath', os.path.join('/tmp', 'azs3copy-governor.db')))
+        else:
+            backend = DynamoDBGovernorStore(values.get('governorTable', 'tableNotFound'))
+        rate = float(values.get('governorRate', '500'))
+        bucket = TokenBucket(
+            rate,
+            float(values.get('governorBurst', str(rate))),
+            float(values.get('governorMinRate', '10')),
+            float(values.get('governorMaxRate', '20000')),
+            float(values.get('governorRampStep', '0.05')),
+            float(values.get('governorBackoff', '0.5')),
+            float(values.get('governorCooldownSeconds', '10'))
+        )
+        return AzureGovernor(backend, key, bucket, int(values.get('governorLease', '10')), float(values.get('governorMaxWaitSeconds', '60')))
+    return cached(('governor', store, key), governor)
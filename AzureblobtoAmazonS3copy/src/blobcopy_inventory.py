@@ -0,0 +1,147 @@
+import base64
+import csv
+import glob
+import io
+import json
+import os
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from blobcopy_stream import open_download
+
+# Azure Storage Blob Inventory reports as a discovery source for the finder
+# A report run writes <rule>-manifest.json next to one or more CSV or Parquet files with a row per blob
+# Rows are streamed and turned into InventoryBlob records that look like the BlobProperties returned by list_blobs
+
+class InventoryContentSettings:
+    __slots__ = ('content_type', 'content_encoding', 'content_language', 'content_md5')
+
+    def __init__(self, content_type, content_encoding, content_language, content_md5=None):
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.content_language = content_language
+        self.content_md5 = content_md5
+
+class InventoryBlob:
+    __slots__ = ('container', 'name', 'size', 'etag', 'last_modified', 'content_settings')
+
+    def __init__(self, container, name, size, etag, last_modified, content_settings):
+        self.container = container
+        self.name = name
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_settings = content_settings
+
+# Inventory dates are ISO 8601 with up to 7 fraction digits, RFC 1123 or (Parquet) datetimes
+def parse_inventory_date(value):
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    value = str(value).strip()
+    if value[:4].isdigit():
+        date, _, fraction = value.rstrip('Z').partition('.')
+        return datetime.strptime(date, '%Y-%m-%dT%H:%M:%S').replace(microsecond=int((fraction + '000000')[:6]), tzinfo=timezone.utc)
+    return parsedate_to_datetime(value)
+
+# Turn one report row (a dict keyed by the inventory field names) into an InventoryBlob
+# Without a container column the container is the first segment of Name
+def row_to_blob(row, container=None):
+    name = row.get('Name')
+    if container is None:
+        container, _, name = name.partition('/')
+    # Directory placeholders of hierarchical namespace accounts are not copied
+    if row.get('hdi_isfolder') in ('true', True):
+        return None
+    return InventoryBlob(
+        container,
+        name,
+        int(row.get('Content-Length') or 0),
+        row.get('Etag'),
+        parse_inventory_date(row.get('Last-Modified')),
+        InventoryContentSettings(row.get('Content-Type') or None, row.get('Content-Encoding') or None, row.get('Content-Language') or None,
+                                 base64.b64decode(row['Content-MD5']) if row.get('Content-MD5') else None)
+    )
+
+def read_csv(stream):
+    for row in csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline='')):
+        yield row
+
+# Parquet needs random access, the report file is spooled to /tmp first and read in record batches
+def read_parquet(path):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('Parquet inventory reports need pyarrow in the lambda layer')
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=10000):
+        for row in batch.to_pylist():
+            yield row
+
+# Reports written by Azure to the inventory destination container of the storage account
+class AzureInventorySource:
+
+    def __init__(self, blob_service_client, container, rule):
+        self.container_client = blob_service_client.get_container_client(container)
+        self.rule = rule
+
+    # The newest report run, its manifest path starts with the yyyy/mm/dd/hh-mm-ss run folder
+    def latest_manifest(self):
+        latest = None
+        for blob in self.container_client.list_blobs():
+            if blob.name.endswith(self.rule + '-manifest.json') and (latest is None or blob.name > latest):
+                latest = blob.name
+        return latest
+
+    def manifest(self, name):
+        return json.loads(self.container_client.download_blob(name).readall())
+
+    def rows(self, name):
+        download = self.container_client.download_blob(name)
+        if name.endswith('.parquet'):
+            path = os.path.join('/tmp', os.path.basename(name))
+            with open(path, 'wb') as report:
+                download.readinto(report)
+            try:
+                yield from read_parquet(path)
+            finally:
+                os.remove(path)
+        else:
+            yield from read_csv(open_download(download))
+
+# Reports copied to a local folder, for local runs and tests
+class LocalInventorySource:
+
+    def __init__(self, path, rule):
+        self.path = path
+        self.rule = rule
+
+    def latest_manifest(self):
+        manifests = sorted(glob.glob(os.path.join(self.path, '**', self.rule + '-manifest.json'), recursive=True))
+        return os.path.relpath(manifests[-1], self.path) if manifests else None
+
+    def manifest(self, name):
+        with open(os.path.join(self.path, name)) as manifest:
+            return json.load(manifest)
+
+    def rows(self, name):
+        path = os.path.join(self.path, name)
+        if name.endswith('.parquet'):
+            yield from read_parquet(path)
+        else:
+            with open(path, 'rb') as report:
+                yield from read_csv(report)
+
+# Report files listed by a manifest, paths in the manifest include the inventory container name
+def manifest_files(manifest, container):
+    files = []
+    for item in manifest.get('files', []):
+        name = item.get('blob', '')
+        if name.startswith(container + '/'):
+            name = name[len(container) + 1:]
+        files.append(name)
+    return files
+
+def get_inventory_source(values, blob_service_client):
+    rule = values.get('inventoryRule', 'azs3copy')
+    path = values.get('inventoryPath')
+    if path:
+        return LocalInventorySource(path, rule)
+    return AzureInventorySource(blob_service_client, values.get('inventoryContainer', 'inventory'), rule)
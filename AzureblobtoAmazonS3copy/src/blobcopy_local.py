@@ -0,0 +1,112 @@
+import importlib.util
+import json
+import os
+import threading
+import time
+import uuid
+from blobcopy_retry import backoff_seconds
+
+# In-process runs of the lambda handlers, shared by blobcopy-backfill.py and ../benchmarks/bench_pipeline.py
+# The handlers are loaded from their files, invoked with a lambda like context and publish to an in-memory bus that
+# stands in for the SNS topics between the functions
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+
+# stage, handler (None is the finder picked by the run), topic of the stage and memory of its function (CFN)
+STAGES = [
+    ('find', None, 'sns_arn_l1', 2560),
+    ('download', 'blobcopy-download', 'sns_arn_l2', 5120),
+    ('initiate', 'blobcopy-large-file-initiator', 'sns_arn_l3', 1024),
+    ('part', 'blobcopy-large-file-part', 'sns_arn_l4', 2056),
+    ('recombine', 'blobcopy-large-file-recombinator', 'sns_arn_l5', 1024),
+]
+
+def load_handler(name):
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(SRC, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class LambdaContext:
+
+    def __init__(self, memory_mb, timeout_seconds=900):
+        self.memory_limit_in_mb = memory_mb
+        self.aws_request_id = str(uuid.uuid4())
+        self.deadline = time.time() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+# In-memory stand-in of the SNS topics, installed in the client cache so the handlers publish to it
+# Retried messages (current_retry_count, attempt) are held back for the backoff of their attempt, messages to the
+# dead letter topic are kept aside. on_call is called with the name of every SNS call made (request counts),
+# on_publish with the topic and the message of every message published
+class MessageBus:
+
+    def __init__(self, dead_letter_topic=None, on_call=None, on_publish=None):
+        self.dead_letter_topic = dead_letter_topic
+        self.on_call = on_call
+        self.on_publish = on_publish
+        self.condition = threading.Condition()
+        self.ready = {}
+        self.delayed = []
+        self.dead_letters = []
+
+    def deliver(self, topic, message, structure):
+        if structure == 'json':
+            message = json.loads(message)['default']
+        if self.on_publish:
+            self.on_publish(topic, message)
+        if topic == self.dead_letter_topic:
+            print("Dead letter: ", message)
+            with self.condition:
+                self.dead_letters.append(message)
+            return
+        values = json.loads(message)
+        attempt = values.get('current_retry_count', values.get('attempt', 0))
+        with self.condition:
+            if attempt:
+                self.delayed.append((time.time() + backoff_seconds(attempt), topic, message))
+            else:
+                self.ready.setdefault(topic, []).append(message)
+            self.condition.notify_all()
+
+    def publish(self, TargetArn, Message, MessageStructure=None, **kwargs):
+        if self.on_call:
+            self.on_call('sns.Publish')
+        self.deliver(TargetArn, Message, MessageStructure)
+        return {'MessageId': str(uuid.uuid4())}
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        if self.on_call:
+            self.on_call('sns.PublishBatch')
+        for entry in PublishBatchRequestEntries:
+            self.deliver(TopicArn, entry['Message'], entry.get('MessageStructure'))
+        return {'Successful': [{'Id': entry['Id']} for entry in PublishBatchRequestEntries], 'Failed': []}
+
+    # Up to limit (default all) messages of a topic, delayed retries that are due are moved to their topic first
+    def take(self, topic, limit=None):
+        with self.condition:
+            now = time.time()
+            due = [item for item in self.delayed if item[0] <= now]
+            if due:
+                self.delayed = [item for item in self.delayed if item[0] > now]
+                for _, due_topic, message in due:
+                    self.ready.setdefault(due_topic, []).append(message)
+            messages = self.ready.get(topic, [])
+            if limit is None:
+                limit = len(messages)
+            taken, self.ready[topic] = messages[:limit], messages[limit:]
+            return taken
+
+    def wait(self, timeout):
+        with self.condition:
+            self.condition.wait(timeout)
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def pending(self):
+        with self.condition:
+            return sum(len(messages) for messages in self.ready.values()) + len(self.delayed)
@@ -0,0 +1,230 @@
+import gzip
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from blobcopy_clients import get_client
+
+# Inventory manifest of the blobs sent for copy: container, name, etag, size, last_modified, copy state and the time
+# of the state. The finder dispatches blobs that are missing from the manifest or whose etag changed, and sends
+# again the blobs still 'dispatched' after manifestResendHours (the copy never reported back)
+# The finder records 'dispatched', the download function and the recombinator record 'copied' once a blob is in S3
+# Manifests are scoped to a container in every listing and discovery mode
+
+DISPATCHED = 'dispatched'
+COPIED = 'copied'
+
+# A completion of an etag wins over a later dispatch of the same etag, the finder may commit after the copy finished
+def merge_entry(old, new):
+    if old is not None and old[0] == new[0] and old[3] == COPIED and new[3] == DISPATCHED:
+        return old
+    return new
+
+def blob_entry(blob, state):
+    return [blob.etag, blob.size, blob.last_modified.isoformat(), state, int(time.time())]
+
+def merge_entries(entries, updates):
+    for name, entry in updates.items():
+        entries[name] = merge_entry(entries.get(name), entry)
+
+class Manifest:
+
+    def __init__(self, store, scope, entries):
+        self.store = store
+        self.scope = scope
+        # name -> [etag, size, last_modified, state, updated]
+        self.entries = entries
+        self.updates = {}
+
+    def lookup(self, name):
+        return self.entries.get(name)
+
+    def needs_copy(self, blob):
+        entry = self.updates.get(blob.name) or self.lookup(blob.name)
+        if entry is None or entry[0] != blob.etag:
+            return True
+        # Entries written before the state time was kept are not sent again
+        return entry[3] == DISPATCHED and len(entry) > 4 and time.time() - entry[4] > self.store.resend_seconds
+
+    def record(self, blob, state=DISPATCHED):
+        self.updates[blob.name] = blob_entry(blob, state)
+
+    # Only the entries recorded since the last commit are written
+    def commit(self):
+        if self.updates:
+            self.store.append(self.scope, self.updates)
+            self.updates = {}
+
+# Durable manifest in the target (or a dedicated, manifestBucket) S3 bucket, every commit writes a gzipped json lines
+# delta object under <manifestPrefix><container>/ instead of rewriting the whole manifest. The deltas are read
+# concurrently and merged in key (time) order over the base object when the manifest is opened, and folded into
+# the base once there are manifestCompactDeltas of them
+class S3ManifestStore:
+
+    def __init__(self, bucket_name, prefix='_azs3copy/manifest/', resend_seconds=86400, compact_deltas=64, read_concurrency=16):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.resend_seconds = resend_seconds
+        self.compact_deltas = compact_deltas
+        self.read_concurrency = read_concurrency
+        self.s3 = get_client('s3')
+        # Shards of a container share the entries loaded once per invocation
+        self.lock = threading.Lock()
+        self.scopes = {}
+        self.last_delta = 0
+
+    def scopePrefix(self, scope):
+        return self.prefix + scope + '/'
+
+    def baseKey(self, scope):
+        return self.scopePrefix(scope) + 'base.jsonl.gz'
+
+    def read(self, key):
+        body = self.s3.get_object(Bucket=self.bucket_name, Key=key)['Body'].read()
+        updates = {}
+        for line in gzip.decompress(body).splitlines():
+            item = json.loads(line)
+            updates[item[0]] = item[1:]
+        return updates
+
+    def write(self, key, entries):
+        lines = '\n'.join(json.dumps([name] + entry, separators=(',', ':')) for name, entry in entries.items())
+        self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=gzip.compress(lines.encode('utf-8')))
+
+    def load(self, scope):
+        keys = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.scopePrefix(scope)):
+            keys += [item['Key'] for item in page.get('Contents', [])]
+        entries = {}
+        # base.jsonl.gz sorts before the delta-<epoch ms>-<id>.jsonl.gz objects, map keeps that order
+        with ThreadPoolExecutor(max_workers=self.read_concurrency) as executor:
+            for updates in executor.map(self.read, sorted(keys)):
+                merge_entries(entries, updates)
+        deltas = [key for key in keys if key != self.baseKey(scope)]
+        if len(deltas) >= self.compact_deltas:
+            # Deltas written while compacting are newer than the base and stay in place
+            self.write(self.baseKey(scope), entries)
+            for start in range(0, len(deltas), 1000):
+                self.s3.delete_objects(Bucket=self.bucket_name, Delete={'Objects': [{'Key': key} for key in deltas[start:start + 1000]], 'Quiet': True})
+            print("Compacted manifest - container: ", scope, ' deltas: ', len(deltas))
+        return entries
+
+    def open(self, scope):
+        with self.lock:
+            if scope not in self.scopes:
+                self.scopes[scope] = self.load(scope)
+            return Manifest(self, scope, self.scopes[scope])
+
+    def append(self, scope, updates):
+        # Deltas of one store sort in commit order, even when committed in the same millisecond
+        with self.lock:
+            self.last_delta = max(int(time.time() * 1000), self.last_delta + 1)
+            key = self.scopePrefix(scope) + 'delta-%013d-%s.jsonl.gz' % (self.last_delta, uuid.uuid4().hex)
+        self.write(key, updates)
+        with self.lock:
+            if scope in self.scopes:
+                merge_entries(self.scopes[scope], updates)
+
+# Local manifest backed by SQLite, entries are looked up row by row instead of being loaded in memory
+class SqliteManifest(Manifest):
+
+    def lookup(self, name):
+        with self.store.lock:
+            row = self.store.conn.execute('SELECT etag, size, last_modified, state, updated FROM manifest WHERE scope = ? AND name = ?',
+                                          (self.scope, name)).fetchone()
+        if row is None:
+            return None
+        return list(row) if row[4] is not None else list(row[:4])
+
+class SqliteManifestStore:
+
+    def __init__(self, path='/tmp/azs3copy-manifest.db', resend_seconds=86400):
+        import sqlite3
+        self.resend_seconds = resend_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS manifest (scope TEXT, name TEXT, etag TEXT, size INTEGER, last_modified TEXT, state TEXT, updated INTEGER, PRIMARY KEY (scope, name))')
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(manifest)')]
+            if 'updated' not in columns:
+                self.conn.execute('ALTER TABLE manifest ADD COLUMN updated INTEGER')
+
+    def open(self, scope):
+        return SqliteManifest(self, scope, {})
+
+    def append(self, scope, updates):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT INTO manifest (scope, name, etag, size, last_modified, state, updated) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (scope, name) DO UPDATE SET etag = excluded.etag, size = excluded.size, last_modified = excluded.last_modified, '
+                'state = excluded.state, updated = excluded.updated '
+                "WHERE NOT (manifest.etag = excluded.etag AND manifest.state = '" + COPIED + "' AND excluded.state = '" + DISPATCHED + "')",
+                [(scope, name) + tuple(entry) for name, entry in updates.items()]
+            )
+
+# Pick the manifest backend from the SNS payload values, None keeps the begindate watermark behaviour
+def get_manifest_store(values):
+    store = values.get('manifestStore', 'none')
+    resend_seconds = float(values.get('manifestResendHours', '24')) * 3600
+    if store == 'sqlite':
+        return SqliteManifestStore(values.get('manifestPath', os.path.join('/tmp', 'azs3copy-manifest.db')), resend_seconds)
+    if store == 's3':
+        return S3ManifestStore(
+            values.get('manifestBucket', values.get('bucket_name', 'bucketNotFound')),
+            values.get('manifestPrefix', '_azs3copy/manifest/'),
+            resend_seconds,
+            int(values.get('manifestCompactDeltas', '64')),
+            int(values.get('manifestReadConcurrency', '16'))
+        )
+    return None
+
+# Copied entries waiting for their S3 delta, kept in the warm container per manifest location
+copied_lock = threading.Lock()
+copied_buffer = {}
+
+# Record the blobs of BlobInfo values (container, blob, etag, size, lastmodified) as copied, one write per container
+# Blobs without an etag (messages of the previous finders) are skipped. With the S3 store the entries of several
+# invocations are written as one delta, once there are manifestFlushEntries of them or the oldest waited
+# manifestFlushSeconds. Entries lost with a container that is not invoked again stay dispatched and are sent again
+# after manifestResendHours
+def record_copied(values, items):
+    store = get_manifest_store(values)
+    if store is None:
+        return
+    containers = {}
+    for item in items:
+        if item.get('etag'):
+            last_modified = datetime.strptime(item['lastmodified'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).isoformat()
+            entry = [item['etag'], item['size'], last_modified, COPIED, int(time.time())]
+            containers.setdefault(item['container'], {})[item['blob']] = entry
+    if not isinstance(store, S3ManifestStore):
+        for container, updates in containers.items():
+            store.append(container, updates)
+        return
+    location = (store.bucket_name, store.prefix)
+    with copied_lock:
+        buffer = copied_buffer.setdefault(location, {'since': time.time(), 'count': 0, 'containers': {}})
+        buffer['store'] = store
+        for container, updates in containers.items():
+            merge_entries(buffer['containers'].setdefault(container, {}), updates)
+            buffer['count'] += len(updates)
+        if buffer['count'] < int(values.get('manifestFlushEntries', '500')) and time.time() - buffer['since'] < float(values.get('manifestFlushSeconds', '60')):
+            return
+        copied_buffer.pop(location)
+    write_copied(buffer)
+
+def write_copied(buffer):
+    for container, updates in buffer['containers'].items():
+        buffer['store'].append(container, updates)
+
+# Write every buffered entry, at the end of a run outside lambda (blobcopy-backfill.py)
+def flush_copied():
+    with copied_lock:
+        buffers = list(copied_buffer.values())
+        copied_buffer.clear()
+    for buffer in buffers:
+        write_copied(buffer)
@@ -0,0 +1,114 @@
+import json
+import os
+import time
+from dataclasses import dataclass, fields
+from blobcopy_accounts import account_config, account_entry
+from blobcopy_checksum import content_md5
+from blobcopy_clients import get_client
+
+# Compact message envelope exchanged between the copy lambdas
+# Messages only carry blob specific fields plus config_ref (the Secrets Manager secret ARN),
+# consumers resolve the configuration once per warm container instead of receiving credentials in every message
+
+ENVELOPE_VERSION = 1
+
+# S3 key of a blob, keyPrefix (e.g. azurecidraw/ of the Cloud Intelligence Dashboard) is put in front of full paths
+def object_key(blob, useFullFilePath, keyPrefix=''):
+    if useFullFilePath == 'true':
+        # to retain container in file path use keyPrefix + container + '/' + blob
+        return keyPrefix + blob
+    return os.path.basename(blob)
+
+@dataclass(slots=True)
+class BlobInfo:
+    container: str
+    blob: str
+    fileName: str
+    fullFilePath: str
+    lastmodified: str
+    size: int
+    partitionSize: int
+    contentType: str = None
+    contentEncoding: str = None
+    contentLanguage: str = None
+    contentMD5: str = None
+    config_ref: str = None
+    # Correlation id of the copy run, set by the launcher
+    run_id: str = None
+    # Etag of the blob version, recorded in the inventory manifest once the copy is done
+    etag: str = None
+
+    @classmethod
+    def fromBlob(cls, container, blob, useFullFilePath, lastmodified, size, partitionSize, config_ref, contentSettings, run_id=None, etag=None, keyPrefix=''):
+        fileName = os.path.basename(blob)
+        fullFilePath = object_key(blob, useFullFilePath, keyPrefix)
+        return cls(container, blob, fileName, fullFilePath, lastmodified, size, partitionSize,
+                   contentSettings.content_type, contentSettings.content_encoding, contentSettings.content_language,
+                   content_md5(contentSettings), config_ref, run_id, etag)
+
+    def toJSON(self):
+        message = {'v': ENVELOPE_VERSION}
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if value is not None:
+                message[field.name] = value
+        return json.dumps(message, separators=(',', ':'))
+
+# Read the message body of the first record, delivered by SNS or by SQS
+def message_body(event):
+    return record_body(event['Records'][0])
+
+def record_body(record):
+    return record['Sns'].get('Message','not found') if 'Sns' in record else record.get('body','not found')
+
+# Several BlobInfo messages of small blobs packed in one message, joined as json text without parsing them again
+def pack_messages(messages):
+    return '{"v":' + str(ENVELOPE_VERSION) + ',"batch":[' + ','.join(messages) + ']}'
+
+# The BlobInfo values of a message, one for a single blob message or every blob of a packed message
+def unpack_message(values):
+    return values['batch'] if 'batch' in values else [values]
+
+config_cache = {}
+
+# Resolve the configuration a message refers to, cached for configCacheSeconds in a warm container
+def resolve_config(values):
+    # Messages published before the compact envelope embed the whole configuration
+    if 'valuePayload' in values:
+        return values['valuePayload']
+    config_ref = values.get('config_ref', 'secretArnNotFound')
+    cached = config_cache.get(config_ref)
+    if cached and cached[0] > time.time():
+        return cached[1]
+    client = get_client('secretsmanager')
+    config = json.loads(client.get_secret_value(SecretId=config_ref)['SecretString'])
+    # Account secrets of a multi account launcher inherit the settings of the launcher secret
+    if 'baseSecret' in config:
+        base = resolve_config({'config_ref': config['baseSecret']})
+        config = account_config(base, account_entry(base, config_ref), config)
+    config['secret_arn'] = config_ref
+    config.setdefault('oauth_url', config.get('bloburl','bloburlNotFound'))
+    config_cache[config_ref] = (time.time() + int(config.get('configCacheSeconds', '300')), config)
+    return config
+
+# Settings of the launcher (its environment and the run) sent to the finders along with the secret reference
+LAUNCH_SETTINGS = ('partitionSize', 'maxPartitionsPerFile', 'UseFullFilePath', 'run_id', 'container_name')
+
+# Message that starts or continues a finder, the finder resolves the secret (credentials included) from config_ref
+def launch_message(values):
+    message = {key: values[key] for key in LAUNCH_SETTINGS if key in values}
+    message['config_ref'] = values.get('secret_arn', 'secretArnNotFound')
+    return message
+
+# Configuration of a finder from its launch message, read fresh since the finder writes begindate back to the secret
+# A configuration pinned in the cache for the whole run (no expiry, blobcopy-backfill.py) is kept, continuations
+# of the finder then stay on it. Launch messages published before config_ref embed the whole secret
+def resolve_launch(message):
+    if 'config_ref' not in message:
+        return message
+    cached = config_cache.get(message['config_ref'])
+    if cached is None or cached[0] != float('inf'):
+        config_cache.pop(message['config_ref'], None)
+    values = dict(resolve_config(message))
+    values.update((key, value) for key, value in message.items() if key != 'config_ref')
+    return values
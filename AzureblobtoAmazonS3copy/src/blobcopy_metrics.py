@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Structured metrics of the copy lambdas in the CloudWatch embedded metric format (EMF)
+# Every invocation prints one json log line that CloudWatch turns into metrics of the azs3copy namespace, with the
+# function as the only dimension. The run_id set by the launcher travels through every message (finder, download,
+# initiator, parts, recombinator) and is logged as a property, so a Logs Insights query on run_id follows one run
+
+NAMESPACE = 'azs3copy'
+# EMF accepts at most 100 values per metric in a log line
+MAX_VALUES = 100
+# Units that are added up over an invocation, the others keep every sample
+SUMMED_UNITS = ('Count', 'Bytes')
+
+class Metrics:
+
+    def __init__(self, function_name, run_id=None, namespace=NAMESPACE):
+        self.function_name = function_name
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.values = {}
+        self.units = {}
+        self.properties = {}
+        if run_id:
+            self.properties['run_id'] = run_id
+
+    # Thread safe, the download and parallel copies record from their worker threads
+    def put(self, name, value, unit='Count'):
+        with self.lock:
+            self.units[name] = unit
+            self.values.setdefault(name, []).append(value)
+
+    def set_property(self, name, value):
+        if value is not None:
+            with self.lock:
+                self.properties.setdefault(name, value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.put(name, (time.perf_counter() - start) * 1000, 'Milliseconds')
+
+    # Bytes and the transfer rate of one copy
+    def transferred(self, size, seconds):
+        self.put('BytesTransferred', size, 'Bytes')
+        if seconds > 0:
+            self.put('Throughput', size / seconds, 'Bytes/Second')
+
+    def flush(self):
+        with self.lock:
+            values, units, properties = self.values, self.units, dict(self.properties)
+            self.values, self.units = {}, {}
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['function']],
+                    'Metrics': [{'Name': name, 'Unit': units[name]} for name in values]
+                }]
+            },
+            'function': self.function_name
+        }
+        document.update(properties)
+        for name, samples in values.items():
+            if units[name] in SUMMED_UNITS:
+                document[name] = sum(samples)
+            else:
+                document[name] = [round(sample, 2) for sample in samples[:MAX_VALUES]]
+        print(json.dumps(document))
+
+# Milliseconds a record waited between its publish (SNS) or send (SQS) and this invocation, None when unknown
+def queue_delay_ms(record):
+    if 'Sns' in record and 'Timestamp' in record['Sns']:
+        sent = datetime.strptime(record['Sns']['Timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc).timestamp()
+    elif 'SentTimestamp' in record.get('attributes', {}):
+        sent = int(record['attributes']['SentTimestamp']) / 1000.0
+    else:
+        return None
+    return max(0.0, (time.time() - sent) * 1000)
+
+def record_queue_delay(metrics, record):
+    delay = queue_delay_ms(record)
+    if delay is not None:
+        metrics.put('QueueDelay', delay, 'Milliseconds')
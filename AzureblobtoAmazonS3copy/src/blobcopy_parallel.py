@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from blobcopy_checksum import OrderedMd5Verifier, part_checksum
+from blobcopy_planner import plan_parts, part_ranges
+
+# In-invocation multipart copy for mid-sized blobs
+# Byte ranges of the blob are downloaded from Azure and uploaded as S3 parts by a pool of threads,
+# so one invocation does the work of the initiator -> part -> recombinator fan-out without the SNS hops
+
+# Copy a blob with concurrent ranged downloads and part uploads, at most concurrency parts are held in memory
+# Parts carry the checksum_algorithm S3 checksum, validate_content has Azure return the MD5 of every range it sends
+# With content_md5 (base64 Content-MD5 of the blob) the ranges are hashed in order and the upload is only completed
+# when the hash matches, it is aborted otherwise
+def copy_in_parts(blob_client, s3, bucket_name, key, size, part_size, concurrency, tagging, checksum_algorithm=None, metadata=None, validate_content=False, memory_mb=5120, metrics=None,
+                  content_md5=None):
+    # The configured part size is the target, raised when needed to stay within the S3 limits, threads share the
+    # memory of the function
+    plan = plan_parts(size, min_part_size=part_size, max_concurrency=concurrency, target_part_size=part_size, shared_memory=True, memory_mb=memory_mb)
+    part_size, concurrency = plan.part_size, plan.concurrency
+    create_args = {'Bucket': bucket_name, 'Key': key, 'Tagging': tagging, 'Metadata': metadata or {}}
+    upload_args = {}
+    if checksum_algorithm:
+        create_args['ChecksumAlgorithm'] = upload_args['ChecksumAlgorithm'] = checksum_algorithm
+    upload_id = s3.create_multipart_upload(**create_args)['UploadId']
+    verifier = OrderedMd5Verifier(content_md5) if content_md5 else None
+
+    def copy_part(part):
+        number, offset, length = part
+        try:
+            # Azure and S3 time of every part are recorded separately when metrics are given
+            with metrics.timer('AzureDownloadTime') if metrics else nullcontext():
+                body = blob_client.download_blob(offset=offset, length=length, validate_content=validate_content).readall()
+            if verifier:
+                verifier.update_part(number, body)
+            with metrics.timer('S3UploadTime') if metrics else nullcontext():
+                response = s3.upload_part(Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumber=number, Body=body, **upload_args)
+        except Exception:
+            if verifier:
+                verifier.fail()
+            raise
+        return dict({'ETag': response['ETag'], 'PartNumber': number}, **part_checksum(response, checksum_algorithm))
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            parts = list(executor.map(copy_part, part_ranges(size, part_size)))
+        if verifier:
+            verifier.finish()
+        s3.complete_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except Exception:
+        # Do not leave an incomplete upload (and its stored parts) behind, the message is retried as a whole
+        s3.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+        raise
+    print("Copied in parts - key: ", key, 'parts: ', len(parts), 'mp_upload_id: ', upload_id)
+    return len(parts)
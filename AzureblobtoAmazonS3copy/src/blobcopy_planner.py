@@ -0,0 +1,85 @@
+import math
+from dataclasses import dataclass
+
+# Part size planner for the multipart copies
+# The part size of a blob is picked from its size, the S3 multipart limits, the memory of the function that holds
+# a part and the measured transfer throughput of one part:
+#   lower bound - enough parts to stay within the S3 part count limit of 10,000
+#   upper bound - a part fits in memoryFraction of the function memory and transfers in timeoutFraction of its timeout
+#   target      - parts large enough that the fixed cost of a part (invocation, SNS hop, requests) stays below
+#                 overheadFraction of its transfer time, which keeps the per GB request overhead low, and few enough
+#                 to stay within maxPartitionsPerFile
+# maxPartitionsPerFile is a preference, the part count goes up to 10,000 before a part outgrows the upper bound.
+# A blob that needs larger parts than the upper bound allows is rejected
+
+MIB = 1024 * 1024
+MIN_PART_SIZE = 5 * MIB
+MAX_PART_SIZE = 5 * 1024 * MIB
+MAX_PARTS = 10000
+MAX_OBJECT_SIZE = 5 * 1024 * 1024 * MIB
+
+@dataclass(slots=True)
+class PartPlan:
+    part_size: int
+    part_count: int
+    concurrency: int
+    # Estimated transfer time with concurrency parts in flight
+    seconds: float
+
+# target_part_size replaces the target derived from the part overhead, e.g. the configured part size of a copy
+def plan_parts(size, memory_mb=2048, throughput_mbps=50.0, overhead_seconds=1.0, timeout_seconds=900,
+               max_parts=MAX_PARTS, max_concurrency=1000, min_part_size=MIN_PART_SIZE, shared_memory=False,
+               overhead_fraction=0.1, memory_fraction=0.5, timeout_fraction=0.5, target_part_size=None):
+    if size > MAX_OBJECT_SIZE:
+        raise ValueError('blob of ' + str(size) + ' bytes is larger than the S3 object size limit')
+    throughput = throughput_mbps * MIB
+    lower = max(MIN_PART_SIZE, min_part_size, int(math.ceil(size / MAX_PARTS)))
+    memory = int(memory_mb * MIB * memory_fraction)
+    upper = min(MAX_PART_SIZE, memory, int(throughput * timeout_seconds * timeout_fraction))
+    if lower > upper:
+        raise ValueError('blob of ' + str(size) + ' bytes needs parts of ' + str(lower) + ' bytes, parts of ' +
+                         str(upper) + ' bytes at most fit in the memory and timeout of the part function')
+    if target_part_size is None:
+        target_part_size = int(throughput * overhead_seconds * (1 - overhead_fraction) / overhead_fraction)
+    preferred = int(math.ceil(size / max(1, min(max_parts, MAX_PARTS))))
+    part_size = max(lower, min(max(target_part_size, preferred), upper))
+    # Whole MiB parts unless that crosses the upper bound
+    rounded = int(math.ceil(part_size / MIB)) * MIB
+    part_size = rounded if rounded <= upper else max(lower, upper // MIB * MIB)
+    part_count = max(1, int(math.ceil(size / part_size)))
+    concurrency = min(part_count, max_concurrency)
+    # Parts copied by one function share its memory
+    if shared_memory:
+        concurrency = max(1, min(concurrency, memory // part_size))
+    waves = int(math.ceil(part_count / concurrency))
+    return PartPlan(part_size, part_count, concurrency, round(waves * (overhead_seconds + part_size / throughput), 2))
+
+# True when a part size is within the S3 multipart limits for a blob of this size
+def fits(size, part_size):
+    return MIN_PART_SIZE <= part_size <= MAX_PART_SIZE and math.ceil(size / part_size) <= MAX_PARTS
+
+# (part number, offset, length) of every part of a blob
+def part_ranges(size, part_size):
+    return [(number + 1, offset, min(part_size, size - offset)) for number, offset in enumerate(range(0, size, part_size))]
+
+# Planner settings read once from the configuration, partitionSize is both the large file threshold and the smallest part
+class PartPlanner:
+
+    def __init__(self, values):
+        self.partition_size = int(values.get('partitionSize', '5242880'))
+        self.max_parts = int(values.get('maxPartitionsPerFile', values.get('maxPartitions', str(MAX_PARTS))))
+        self.memory_mb = int(values.get('partMemoryMB', '2048'))
+        self.throughput_mbps = float(values.get('partThroughputMBps', '50'))
+        self.overhead_seconds = float(values.get('partOverheadSeconds', '1'))
+        self.timeout_seconds = int(values.get('partTimeoutSeconds', '900'))
+        self.max_concurrency = int(values.get('maxPartConcurrency', '1000'))
+        # Blobs up to parallelCopyMaxSize are copied in parts by a single download invocation
+        self.parallel_copy_max_size = int(values.get('parallelCopyMaxSize', '2147483648'))
+
+    # Blobs that go through the initiator, part and recombinator fan-out
+    def is_large(self, size):
+        return size > self.partition_size and size > self.parallel_copy_max_size
+
+    def plan(self, size):
+        return plan_parts(size, self.memory_mb, self.throughput_mbps, self.overhead_seconds, self.timeout_seconds,
+                          self.max_parts, self.max_concurrency, min(self.partition_size, MAX_PART_SIZE))
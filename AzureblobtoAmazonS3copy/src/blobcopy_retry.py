@@ -0,0 +1,50 @@
+import json
+import random
+from blobcopy_clients import get_client
+
+# Retry scheduling for failed work items (large file parts, blobs of the download function)
+# A failed item is sent back with an exponential backoff and full jitter, as a delayed SQS message (at most 15 minutes),
+# so a burst of throttled parts spreads out instead of hitting Azure again at once.
+# Items that used all their attempts go to the dead-letter topic with the last error
+
+MAX_DELAY_SECONDS = 900
+
+# Full jitter: a random delay between 0 and base * 2^attempt, capped
+def backoff_seconds(attempt, base_seconds=2, max_seconds=MAX_DELAY_SECONDS):
+    return random.uniform(0, min(max_seconds, base_seconds * (2 ** attempt)))
+
+class RetryScheduler:
+
+    # queue_key names the retry queue in the configuration, None always republishes to the home topic
+    def __init__(self, values, queue_key='sqs_url_l4_retry'):
+        self.queue_url = values.get(queue_key) if queue_key else None
+        self.dead_letter_arn = values.get('sns_arn_dlq')
+        self.max_attempts = int(values.get('retryMaxAttempts', '4'))
+        self.base_seconds = float(values.get('retryBaseSeconds', '10'))
+        self.max_seconds = min(MAX_DELAY_SECONDS, float(values.get('retryMaxSeconds', str(MAX_DELAY_SECONDS))))
+
+    # Schedule the next attempt of a message, home is the topic used when no retry queue is configured
+    def retry(self, message, attempt_key, home, error):
+        attempt = message.get(attempt_key, 0) + 1
+        message = dict(message, **{attempt_key: attempt})
+        if attempt > self.max_attempts:
+            self.dead_letter(message, error)
+            return 'dead_letter'
+        if self.queue_url:
+            delay = int(backoff_seconds(attempt, self.base_seconds, self.max_seconds))
+            print("Retry scheduled - attempt: ", attempt, ' delay: ', delay, ' error: ', error)
+            get_client('sqs').send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(message), DelaySeconds=delay)
+        else:
+            # Without a retry queue the message goes straight back to its topic, as before
+            print("Retry published - attempt: ", attempt, ' error: ', error)
+            get_client('sns').publish(TargetArn=home, Message=json.dumps({'default': json.dumps(message)}), MessageStructure='json')
+        return 'retry'
+
+    def dead_letter(self, message, error):
+        print("Retries exhausted - sending to dead letter: ", error)
+        if self.dead_letter_arn:
+            get_client('sns').publish(
+                TargetArn=self.dead_letter_arn,
+                Message=json.dumps({'default': json.dumps({'error': str(error), 'message': message})}),
+                MessageStructure='json'
+            )
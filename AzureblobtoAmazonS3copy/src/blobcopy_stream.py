@@ -0,0 +1,41 @@
+import io
+import time
+
+# Streaming helpers shared by the functions that move blob data without spooling it to /tmp
+
+# File like object over the chunks of an Azure download stream, reads return as soon as a chunk arrives
+class ChunkReader(io.RawIOBase):
+
+    def __init__(self, chunks, verifier=None):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        # Optional checksum verifier fed with every chunk, checked once the last chunk has been read
+        self.verifier = verifier
+        # Seconds spent waiting on Azure for the next chunk
+        self.wait_seconds = 0.0
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self.buffer:
+            start = time.perf_counter()
+            try:
+                self.buffer = next(self.chunks)
+            except StopIteration:
+                if self.verifier is not None:
+                    verifier, self.verifier = self.verifier, None
+                    verifier.finish()
+                return 0
+            finally:
+                self.wait_seconds += time.perf_counter() - start
+            if self.verifier is not None:
+                self.verifier.update(self.buffer)
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+# Buffered reader over an Azure download stream, read(n) returns n bytes except at the end of the blob
+def open_download(download_stream, buffer_size=1048576, verifier=None):
+    return io.BufferedReader(ChunkReader(download_stream.chunks(), verifier), buffer_size=buffer_size)
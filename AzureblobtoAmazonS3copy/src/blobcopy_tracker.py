@@ -0,0 +1,107 @@
+import json
+import os
+import threading
+import time
+from blobcopy_clients import get_client
+
+# Completion tracker of the large file multipart uploads
+# Every part records its ETag and adds its part number to the set of finished parts of the upload in one atomic
+# update, so finishing a part costs O(1) calls whatever the number of parts. The part that completes the set
+# claims the upload, which triggers the recombinator exactly once even when parts finish at the same moment
+# or a part is delivered twice. The recombinator reads the ETags (and part checksums) back instead of listing the parts
+
+# Durable tracker: DynamoDB table with upload_id (hash) and part (range, 0 holds the set of finished parts)
+class DynamoDBUploadTracker:
+
+    def __init__(self, table_name, ttl_days=7):
+        self.table_name = table_name
+        self.ttl_seconds = ttl_days * 86400
+        self.dynamodb = get_client('dynamodb')
+
+    def record(self, upload_id, part_number, etag, total_parts, checksum=None):
+        expires = str(int(time.time()) + self.ttl_seconds)
+        item = {'upload_id': {'S': upload_id}, 'part': {'N': str(part_number)}, 'etag': {'S': etag}, 'expires': {'N': expires}}
+        if checksum:
+            item['checksum'] = {'M': {name: {'S': value} for name, value in checksum.items()}}
+        self.dynamodb.put_item(TableName=self.table_name, Item=item)
+        # Adding to a set (instead of incrementing a counter) keeps redelivered parts from being counted twice
+        done = self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key={'upload_id': {'S': upload_id}, 'part': {'N': '0'}},
+            UpdateExpression='ADD done :part SET total_parts = :total, expires = :expires',
+            ExpressionAttributeValues={':part': {'NS': [str(part_number)]}, ':total': {'N': str(total_parts)}, ':expires': {'N': expires}},
+            ReturnValues='UPDATED_NEW'
+        )['Attributes']['done']['NS']
+        if len(done) < total_parts:
+            return False
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={'upload_id': {'S': upload_id}, 'part': {'N': '0'}},
+                UpdateExpression='SET completed = :true',
+                ConditionExpression='attribute_not_exists(completed)',
+                ExpressionAttributeValues={':true': {'BOOL': True}}
+            )
+            return True
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def parts(self, upload_id):
+        parts = []
+        paginator = self.dynamodb.get_paginator('query')
+        for page in paginator.paginate(
+                TableName=self.table_name,
+                KeyConditionExpression='upload_id = :upload_id AND part > :zero',
+                ExpressionAttributeValues={':upload_id': {'S': upload_id}, ':zero': {'N': '0'}},
+                ConsistentRead=True):
+            for item in page['Items']:
+                part = {'ETag': item['etag']['S'], 'PartNumber': int(item['part']['N'])}
+                part.update({name: value['S'] for name, value in item.get('checksum', {}).get('M', {}).items()})
+                parts.append(part)
+        return parts
+
+    def clear(self, upload_id, total_parts):
+        keys = [{'DeleteRequest': {'Key': {'upload_id': {'S': upload_id}, 'part': {'N': str(part)}}}} for part in range(total_parts + 1)]
+        for start in range(0, len(keys), 25):
+            request = {self.table_name: keys[start:start + 25]}
+            while request:
+                request = self.dynamodb.batch_write_item(RequestItems=request).get('UnprocessedItems')
+
+# Local tracker backed by SQLite, used for local runs and tests
+class SqliteUploadTracker:
+
+    def __init__(self, path='/tmp/azs3copy-uploads.db'):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS upload_parts (upload_id TEXT, part INTEGER, etag TEXT, checksum TEXT, PRIMARY KEY (upload_id, part))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS uploads (upload_id TEXT PRIMARY KEY, completed INTEGER)')
+
+    def record(self, upload_id, part_number, etag, total_parts, checksum=None):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO upload_parts (upload_id, part, etag, checksum) VALUES (?, ?, ?, ?)',
+                              (upload_id, part_number, etag, json.dumps(checksum or {})))
+            done = self.conn.execute('SELECT COUNT(*) FROM upload_parts WHERE upload_id = ?', (upload_id,)).fetchone()[0]
+            if done < total_parts:
+                return False
+            return self.conn.execute('INSERT OR IGNORE INTO uploads (upload_id, completed) VALUES (?, 1)', (upload_id,)).rowcount == 1
+
+    def parts(self, upload_id):
+        with self.lock:
+            rows = self.conn.execute('SELECT part, etag, checksum FROM upload_parts WHERE upload_id = ? ORDER BY part', (upload_id,)).fetchall()
+        return [dict({'ETag': etag, 'PartNumber': part}, **json.loads(checksum)) for part, etag, checksum in rows]
+
+    def clear(self, upload_id, total_parts):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM upload_parts WHERE upload_id = ?', (upload_id,))
+            self.conn.execute('DELETE FROM uploads WHERE upload_id = ?', (upload_id,))
+
+# Pick the tracker backend from the configuration, None keeps the list_parts completion check
+def get_upload_tracker(values):
+    store = values.get('trackerStore', 'dynamodb' if 'trackerTable' in values else 'none')
+    if store == 'sqlite':
+        return SqliteUploadTracker(values.get('trackerPath', os.path.join('/tmp', 'azs3copy-uploads.db')))
+    if store == 'dynamodb':
+        return DynamoDBUploadTracker(values.get('trackerTable', 'tableNotFound'), int(values.get('trackerTtlDays', '7')))
+    return None
@@ -0,0 +1,63 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+# Incomplete multipart uploads of the target bucket
+#   resume - the initiator continues the newest upload of a key that started after the blob was last modified,
+#            only the parts it is missing are copied again
+#   reaper - opt-in (reapIncompleteUploads), the launcher aborts uploads under reapPrefix that are stale (older than
+#            reapAfterHours), so their stored parts stop being billed. The stack bucket has a lifecycle rule instead
+# Only stale uploads are aborted, a newer upload of the same key may belong to a copy that is still running
+
+def incomplete_uploads(s3, bucket_name, prefix=''):
+    paginator = s3.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for upload in page.get('Uploads', []):
+            yield upload
+
+# Parts already stored in an upload, by part number
+def uploaded_parts(s3, bucket_name, key, upload_id):
+    parts = {}
+    paginator = s3.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=bucket_name, Key=key, UploadId=upload_id):
+        for part in page.get('Parts', []):
+            parts[part['PartNumber']] = part
+    return parts
+
+def abort(s3, bucket_name, upload, reason):
+    print("Aborting multipart upload - key: ", upload['Key'], ' mp_upload_id: ', upload['UploadId'], ' reason: ', reason)
+    s3.abort_multipart_upload(Bucket=bucket_name, Key=upload['Key'], UploadId=upload['UploadId'])
+
+def stale_before(max_age_hours):
+    return datetime.now(timezone.utc) - timedelta(hours=max_age_hours)
+
+# Newest upload of the key started after the blob was last modified, the other stale uploads of the key are aborted
+def find_resumable(s3, bucket_name, key, last_modified, max_age_hours=72):
+    oldest = stale_before(max_age_hours)
+    uploads = sorted((upload for upload in incomplete_uploads(s3, bucket_name, key) if upload['Key'] == key),
+                     key=lambda upload: upload['Initiated'], reverse=True)
+    resumable = None
+    for upload in uploads:
+        if upload['Initiated'] < oldest:
+            abort(s3, bucket_name, upload, 'stale')
+        elif resumable is None and upload['Initiated'] > last_modified:
+            resumable = upload
+    return resumable
+
+# Part size an upload was started with, taken from a stored part that is not the last part of the blob
+def resumed_part_size(parts, size):
+    for number, part in sorted(parts.items()):
+        if number * part['Size'] < size:
+            return part['Size']
+    return None
+
+# Abort stale uploads, stops listing at the deadline (epoch seconds) and returns the number aborted
+def reap(s3, bucket_name, max_age_hours, prefix='', deadline=None):
+    oldest = stale_before(max_age_hours)
+    aborted = 0
+    for upload in incomplete_uploads(s3, bucket_name, prefix):
+        if deadline is not None and time.time() > deadline:
+            break
+        if upload['Initiated'] < oldest:
+            abort(s3, bucket_name, upload, 'stale')
+            aborted += 1
+    return aborted
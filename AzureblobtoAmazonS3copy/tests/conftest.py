@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The functions and shared modules are flat files in src, as they are packaged in the lambda zips
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
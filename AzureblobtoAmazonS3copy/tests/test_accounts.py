@@ -0,0 +1,100 @@
+import importlib.util
+import json
+import os
+import pytest
+
+pytest.importorskip('boto3')
+from blobcopy_accounts import account_config, account_entries
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+def test_entries_in_priority_order():
+    values = {'accounts': json.dumps([{'secret': 'arn:a'}, {'secret': 'arn:b', 'priority': 5}, {'secret': 'arn:c', 'name': 'c'}])}
+    assert [entry['name'] for entry in account_entries(values)] == ['arn:b', 'arn:a', 'c']
+
+def test_max_request_rate_caps_the_governor_of_the_account():
+    base = {'accounts': '[]', 'secret_arn': 'arn:base', 'governorRate': '500', 'bucket_name': 'shared'}
+    entry = {'secret': 'arn:a', 'name': 'a', 'maxRequestRate': 300, 'containers': 'raw', 'settings': {'bucket_name': 'a-bucket'}}
+    config = account_config(base, entry, {'bloburl': 'https://a', 'baseSecret': 'arn:base'})
+    assert config['governorMaxRate'] == '300.0'
+    assert config['governorRate'] == '300.0'
+    assert config['includeContainers'] == 'raw'
+    assert config['bucket_name'] == 'a-bucket'
+    assert 'accounts' not in config and 'secret_arn' not in config
+
+class SecretsManager:
+
+    def __init__(self, secrets):
+        self.secrets = secrets
+
+    def get_secret_value(self, SecretId):
+        secret = self.secrets[SecretId]
+        if isinstance(secret, Exception):
+            raise secret
+        return {'SecretString': json.dumps(secret)}
+
+class Sns:
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.launched = []
+
+    def publish(self, TargetArn, Message, MessageStructure=None):
+        message = json.loads(json.loads(Message)['default'])
+        if message['config_ref'] in self.failing:
+            raise RuntimeError('Throttling')
+        self.launched.append(message['config_ref'])
+
+class Context:
+
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+class Metrics:
+
+    def __init__(self):
+        self.values = {}
+
+    def put(self, name, value, unit='Count'):
+        self.values[name] = self.values.get(name, 0) + value
+
+ACCOUNT = {'baseSecret': 'arn:base', 'bloburl': 'https://account', 'isactive': 'True', 'begindate': '2020-01-01 00:00:00'}
+
+@pytest.fixture
+def launcher(monkeypatch, tmp_path):
+    from blobcopy_clients import clients
+    spec = importlib.util.spec_from_file_location('blobcopy_launch_qualification', os.path.join(SRC, 'blobcopy-launch-qualification.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for name, value in (('partitionSize', '104857600'), ('maxPartitionsPerFile', '10000'), ('UseFullFilePath', 'true')):
+        monkeypatch.setenv(name, value)
+    secrets = {'accounts': [{'secret': 'arn:a', 'priority': 3}, {'secret': 'arn:missing', 'priority': 2}, {'secret': 'arn:b', 'priority': 1}],
+               'run_id': 'run', 'sns_arn_l1': 'l1', 'launchStaggerSeconds': '0', 'checkpointStore': 'sqlite',
+               'checkpointPath': str(tmp_path / 'checkpoints.db')}
+    monkeypatch.setitem(clients, ('boto3', 'secretsmanager'), SecretsManager({
+        'arn:a': ACCOUNT, 'arn:b': ACCOUNT, 'arn:missing': RuntimeError('ResourceNotFoundException')}))
+    return module, secrets
+
+def test_a_failing_account_secret_does_not_stop_the_other_accounts(launcher, monkeypatch):
+    module, secrets = launcher
+    from blobcopy_clients import clients
+    sns = Sns()
+    monkeypatch.setitem(clients, ('boto3', 'sns'), sns)
+    metrics = Metrics()
+    launched = module.launch_accounts(secrets, 'arn:base', Context(), metrics)
+    assert sns.launched == ['arn:a', 'arn:b']
+    assert [values['secret_arn'] for values in launched] == ['arn:a', 'arn:b']
+    assert metrics.values == {'AccountsFailed': 1, 'AccountsLaunched': 2}
+
+def test_a_failing_launch_does_not_stop_the_other_accounts(launcher, monkeypatch):
+    module, secrets = launcher
+    from blobcopy_checkpoint import get_checkpoint_store
+    from blobcopy_clients import clients
+    sns = Sns(failing=('arn:a',))
+    monkeypatch.setitem(clients, ('boto3', 'sns'), sns)
+    metrics = Metrics()
+    module.launch_accounts(secrets, 'arn:base', Context(), metrics)
+    assert sns.launched == ['arn:b']
+    assert metrics.values == {'AccountsFailed': 2, 'AccountsLaunched': 1}
+    # Only the launched account records its launch, the change check of the failed one stays open
+    assert set(get_checkpoint_store(secrets).list('launcher-accounts')) == {'arn:b'}
@@ -0,0 +1,114 @@
+import importlib.util
+import json
+import os
+import types
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# Secret of a deployed stack, with the queues, topics and retry queue of the lambdas
+SECRET = {'bloburl': 'https://account.blob.core.windows.net', 'bucket_name': 'target', 'dispatchBackend': 'sqs',
+          'sqs_url_l2': 'https://sqs/l2', 'sqs_url_l3': 'https://sqs/l3', 'sqs_url_l4_retry': 'https://sqs/retry',
+          'sns_arn_l1': 'arn:l1', 'sns_arn_l2': 'arn:l2', 'sns_arn_l3': 'arn:l3', 'sns_arn_l4': 'arn:l4', 'sns_arn_l5': 'arn:l5'}
+
+class SecretsManager:
+
+    def __init__(self):
+        self.reads = 0
+
+    def get_secret_value(self, SecretId):
+        self.reads += 1
+        return {'SecretString': json.dumps(SECRET)}
+
+@pytest.fixture
+def backfill(monkeypatch):
+    pytest.importorskip('boto3')
+    import blobcopy_local
+    from blobcopy_clients import clients
+    from blobcopy_message import config_cache
+    spec = importlib.util.spec_from_file_location('blobcopy_backfill', os.path.join(SRC, 'blobcopy-backfill.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(module, 'load_handler', lambda name: None)
+    monkeypatch.setattr(blobcopy_local, 'backoff_seconds', lambda attempt: 0)
+    monkeypatch.setitem(clients, ('boto3', 'secretsmanager'), SecretsManager())
+    yield module
+    clients.pop(('boto3', 'sns'), None)
+    config_cache.clear()
+
+def run(backfill, handlers):
+    args = types.SimpleNamespace(secret='arn:secret', config=None, set=None, finder='blobcopy-find-blobs', find_workers=1, download_workers=2,
+                                 initiate_workers=1, part_workers=2, memory_mb=1024, timeout=900, progress_seconds=60,
+                                 partition_size='104857600', max_partitions='10000', use_full_file_path='true')
+    values = backfill.run_values(args)
+    queue = backfill.MessageBus(values['sns_arn_dlq'])
+    backfill.install_run(values, queue)
+    runner = backfill.Runner(args, values, queue)
+    runner.handlers = handlers
+    return runner, runner.run()
+
+def publish(topic, message):
+    from blobcopy_clients import get_client
+    get_client('sns').publish(TargetArn=topic, Message=json.dumps({'default': json.dumps(message)}), MessageStructure='json')
+
+# The finder hands off to itself once, like a sharded or inventory run, and publishes a blob in each invocation
+class Finder:
+
+    def __init__(self):
+        self.seen = []
+
+    def lambda_handler(self, event, context):
+        from blobcopy_message import launch_message, resolve_launch
+        values = resolve_launch(json.loads(event['Records'][0]['Sns']['Message']))
+        self.seen.append(values)
+        publish(values['sns_arn_l2'], {'container': 'c', 'blob': str(len(self.seen)), 'size': 100, 'config_ref': values['secret_arn']})
+        if len(self.seen) == 1:
+            publish(values['sns_arn_l1'], launch_message(values))
+
+class Download:
+
+    def __init__(self):
+        self.attempts = {}
+
+    def lambda_handler(self, event, context):
+        from blobcopy_message import resolve_config
+        from blobcopy_retry import RetryScheduler
+        values = json.loads(event['Records'][0]['Sns']['Message'])
+        config = resolve_config(values)
+        self.attempts[values['blob']] = self.attempts.get(values['blob'], 0) + 1
+        # The first blob fails once and is sent back by the retry scheduler of the download function
+        if values['blob'] == '1' and not values.get('attempt'):
+            RetryScheduler(config, None).retry(values, 'attempt', config['sns_arn_l2'], 'throttled')
+
+def test_finder_continuation_keeps_the_run_configuration(backfill):
+    finder, download = Finder(), Download()
+    runner, finished = run(backfill, {'find': finder, 'download': download})
+    assert finished
+    assert len(finder.seen) == 2
+    for values in finder.seen:
+        assert values['dispatchBackend'] == 'sns'
+        assert 'sqs_url_l4_retry' not in values
+    assert finder.seen[1]['run_id'] == finder.seen[0]['run_id']
+    # The secret is read once by the runner, the continuation does not read it again
+    from blobcopy_clients import clients
+    assert clients[('boto3', 'secretsmanager')].reads == 1
+    assert download.attempts == {'1': 2, '2': 1}
+    assert runner.progress.counts == {'find': 2, 'download': 3}
+
+def test_bytes_come_from_the_bus(backfill):
+    finder, download = Finder(), Download()
+    runner, _ = run(backfill, {'find': finder, 'download': download})
+    # The failed attempt of blob 1 does not count, its retry does
+    assert runner.progress.bytes == 200
+
+def test_copied_bytes_of_messages_sent_back(backfill):
+    batch = {'batch': [{'container': 'c', 'blob': 'a', 'size': 10}, {'container': 'c', 'blob': 'b', 'size': 20}]}
+    retry = json.dumps({'batch': [{'container': 'c', 'blob': 'b', 'size': 20}], 'attempt': 1})
+    assert backfill.copied_bytes('download', batch, [], 'l2', 'dlq') == 30
+    assert backfill.copied_bytes('download', batch, [('l2', retry)], 'l2', 'dlq') == 10
+    dead = json.dumps({'error': 'x', 'message': {'container': 'c', 'blob': 'a', 'size': 10}})
+    assert backfill.copied_bytes('download', batch, [('dlq', dead)], 'l2', 'dlq') == 20
+    part = {'part_number': 1, 'bytesToDownload': 50}
+    assert backfill.copied_bytes('part', part, [('l5', '{}')], 'l4', 'dlq') == 50
+    assert backfill.copied_bytes('part', part, [('l4', json.dumps(dict(part, current_retry_count=1)))], 'l4', 'dlq') == 0
+    assert backfill.copied_bytes('recombine', {}, [], 'l5', 'dlq') == 0
@@ -0,0 +1,196 @@
+import importlib.util
+import json
+import os
+from datetime import datetime, timezone
+import pytest
+
+pytest.importorskip('boto3')
+from blobcopy_checkpoint import SqliteCheckpointStore, get_checkpoint_store, launch_scope
+from blobcopy_exports import ExportSelector
+from blobcopy_inventory import InventoryBlob, InventoryContentSettings
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+def test_sqlite_checkpoints_are_kept_per_scope(tmp_path):
+    store = SqliteCheckpointStore(str(tmp_path / 'checkpoints.db'))
+    store.put('run-a', 'container', {'status': 'pending', 'token': 't1'})
+    store.put('run-a', 'other', {'status': 'done', 'token': None})
+    store.put('run-b', 'container', {'status': 'pending', 'token': 'x'})
+    assert store.get('run-a', 'container') == {'status': 'pending', 'token': 't1'}
+    assert store.get('run-a', 'missing') is None
+    assert store.list('run-a') == {'container': {'status': 'pending', 'token': 't1'}, 'other': {'status': 'done', 'token': None}}
+    # A newer checkpoint of a key replaces the old one
+    store.put('run-a', 'container', {'status': 'pending', 'token': 't2'})
+    assert store.get('run-a', 'container')['token'] == 't2'
+    store.clear('run-a')
+    assert store.list('run-a') == {}
+    assert store.get('run-b', 'container') == {'status': 'pending', 'token': 'x'}
+
+def test_sqlite_checkpoints_survive_the_store(tmp_path):
+    values = {'checkpointStore': 'sqlite', 'checkpointPath': str(tmp_path / 'checkpoints.db')}
+    get_checkpoint_store(values).put('run', 'container', {'token': 't'})
+    store = get_checkpoint_store(values)
+    assert isinstance(store, SqliteCheckpointStore)
+    assert store.list('run') == {'container': {'token': 't'}}
+
+def test_launch_scope_follows_the_secret_and_begindate():
+    values = {'secret_arn': 'arn:secret', 'begindate': '2024-01-01 00:00:00', 'run_id': 'request-1'}
+    assert launch_scope(values) == launch_scope(dict(values, run_id='request-2'))
+    assert launch_scope(values) != launch_scope(dict(values, begindate='2024-02-01 00:00:00'))
+    assert launch_scope(values) != launch_scope(dict(values, secret_arn='arn:other'))
+
+def blob(name, minute, md5=None):
+    return InventoryBlob('costs', name, 100, '0x' + name[-1], datetime(2024, 3, 1, 10, minute, tzinfo=timezone.utc),
+                         InventoryContentSettings('text/csv', None, None, md5))
+
+def test_held_exports_are_saved_and_restored():
+    first = ExportSelector({'exportSelection': 'latest'})
+    assert first.hold('costs', blob('daily/20240301-20240331/run1/part_0_0001.csv', 1, b'0123456789abcdef'))
+    assert first.hold('costs', blob('daily/20240301-20240331/run2/part_0_0001.csv', 5))
+    rows = json.loads(json.dumps(first.save('costs')))
+    assert first.save('other') == []
+    # The next execution compares the saved exports with the ones it lists
+    second = ExportSelector({'exportSelection': 'latest'})
+    second.restore('costs', rows)
+    second.hold('costs', blob('daily/20240301-20240331/run2/part_0_0002.csv', 6))
+    released = list(second.release('costs'))
+    assert [item.name for item in released] == ['daily/20240301-20240331/run2/part_0_0001.csv', 'daily/20240301-20240331/run2/part_0_0002.csv']
+    assert released[0].last_modified == datetime(2024, 3, 1, 10, 5, tzinfo=timezone.utc)
+    assert second.superseded == 1
+    restored = ExportSelector({'exportSelection': 'latest'})
+    restored.restore('costs', rows[:1])
+    assert next(restored.release('costs')).content_settings.content_md5 == b'0123456789abcdef'
+
+# Pages of list_blobs, the continuation token is the index of the next page
+class Pager:
+
+    def __init__(self, pages, token):
+        self.pages = pages
+        self.start = int(token or 0)
+        self.continuation_token = None
+
+    def __iter__(self):
+        for index in range(self.start, len(self.pages)):
+            self.continuation_token = str(index + 1) if index + 1 < len(self.pages) else None
+            yield self.pages[index]
+
+class Listing:
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def by_page(self, continuation_token=None):
+        return Pager(self.pages, continuation_token)
+
+class BlobService:
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def list_containers(self, include_metadata=False):
+        return [{'name': 'costs'}]
+
+    def get_container_client(self, name):
+        service = self
+
+        class ContainerClient:
+            def list_blobs(self, name_starts_with=None, results_per_page=None):
+                return Listing(service.pages)
+        return ContainerClient()
+
+class Dispatcher:
+
+    def __init__(self, sent):
+        self.sent = sent
+
+    def count_blob(self, size):
+        pass
+
+    def add(self, target, message):
+        self.sent.append(json.loads(message)['blob'])
+
+    def add_packed(self, target, message, size):
+        self.add(target, message)
+
+    def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    def put_metrics(self, metrics):
+        pass
+
+class Topic:
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TargetArn, Message, MessageStructure=None):
+        self.messages.append(json.loads(json.loads(Message)['default']))
+
+class Secret:
+
+    def get_secret_value(self, SecretId):
+        return {'SecretString': '{"begindate":"1911-01-01 00:00:00"}'}
+
+    def update_secret(self, SecretId, SecretString):
+        self.updated = SecretString
+
+class Context:
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+@pytest.fixture
+def optimized(monkeypatch):
+    pytest.importorskip('azure.storage.blob')
+    from blobcopy_clients import clients
+    spec = importlib.util.spec_from_file_location('blobcopy_find_blobs_optimized', os.path.join(SRC, 'blobcopy-find-blobs-optimized.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setitem(clients, ('boto3', 'sns'), Topic())
+    monkeypatch.setitem(clients, ('boto3', 'secretsmanager'), Secret())
+    yield module
+    # Continuations resolved the secret of their config_ref
+    from blobcopy_message import config_cache
+    config_cache.pop('arn:secret', None)
+
+# Runs the optimized finder and its continuations until the run is done, returns the executions and the blobs sent
+def run_finder(optimized, monkeypatch, pages, tmp_path, **settings):
+    from blobcopy_clients import clients
+    sent = []
+    monkeypatch.setattr(optimized, 'get_blob_service_client', lambda *args: BlobService(pages))
+    monkeypatch.setattr(optimized, 'get_dispatcher', lambda values: Dispatcher(sent))
+    values = dict(settings, secret_arn='arn:secret', sns_arn_l1='l1', checkpointStore='sqlite', checkpointPath=str(tmp_path / 'checkpoints.db'))
+    message = values
+    for executions in range(1, 10):
+        result = optimized.lambda_handler({'Records': [{'Sns': {'Message': json.dumps(message)}}]}, Context())
+        if result == 'success':
+            return executions, sent
+        # The continuation message carries the settings of the launch, as launch_message does
+        message = dict(values, **clients[('boto3', 'sns')].messages[-1])
+    raise AssertionError('the run did not finish')
+
+PAGES = [[blob('a/1.csv', 1), blob('a/2.csv', 2)], [blob('b/3.csv', 3)], [blob('c/4.csv', 4)]]
+
+def test_optimized_finder_hands_over_at_the_deadline(optimized, monkeypatch, tmp_path):
+    # No time left after the first page of every execution
+    executions, sent = run_finder(optimized, monkeypatch, PAGES, tmp_path, shardSafetyMillis='900000')
+    assert executions == 3
+    assert sent == ['a/1.csv', 'a/2.csv', 'b/3.csv', 'c/4.csv']
+    assert SqliteCheckpointStore(str(tmp_path / 'checkpoints.db')).list(launch_scope({'secret_arn': 'arn:secret'})) == {}
+
+def test_optimized_finder_hands_over_a_batch(optimized, monkeypatch, tmp_path):
+    executions, sent = run_finder(optimized, monkeypatch, PAGES, tmp_path, batch_size='2')
+    assert executions == 2
+    assert sent == ['a/1.csv', 'a/2.csv', 'b/3.csv', 'c/4.csv']
+
+def test_optimized_finder_hands_over_held_exports(optimized, monkeypatch, tmp_path):
+    pages = [[blob('daily/20240301-20240331/run1/part_0_0001.csv', 1), blob('daily/20240301-20240331/run1/part_0_0002.csv', 2)],
+             [blob('daily/20240301-20240331/run2/part_0_0001.csv', 5)],
+             [blob('daily/20240301-20240331/run3/part_0_0001.csv', 3), blob('other.csv', 4)]]
+    executions, sent = run_finder(optimized, monkeypatch, pages, tmp_path, shardSafetyMillis='900000', exportSelection='latest')
+    # The container is handed over with the held exports, the newest export wins over all executions
+    assert executions == 3
+    assert sent == ['other.csv', 'daily/20240301-20240331/run2/part_0_0001.csv']
@@ -0,0 +1,161 @@
+import json
+import threading
+import types
+import pytest
+
+pytest.importorskip('boto3')
+import blobcopy_dispatch
+from blobcopy_dispatch import MAX_BATCH_BYTES, BatchDispatcher, SnsBatchBackend, SqsBatchBackend, get_dispatcher
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(blobcopy_dispatch, 'time', types.SimpleNamespace(sleep=lambda seconds: None))
+
+# Backend that fails the entries of failures (message -> attempts to fail) with a throttling error
+class Backend:
+
+    def __init__(self, failures=None, sender_fault=()):
+        self.lock = threading.Lock()
+        self.failures = dict(failures or {})
+        self.sender_fault = sender_fault
+        self.batches = []
+        self.sent = []
+
+    def entry_size(self, message):
+        return len(message.encode('utf-8'))
+
+    def send(self, target, entries):
+        with self.lock:
+            self.batches.append((target, [message for _, message in entries]))
+            failed = []
+            for entry_id, message in entries:
+                if message in self.sender_fault:
+                    failed.append({'Id': entry_id, 'Code': 'InvalidParameter', 'SenderFault': True})
+                elif self.failures.get(message, 0) > 0:
+                    self.failures[message] -= 1
+                    failed.append({'Id': entry_id, 'Code': 'Throttled', 'SenderFault': False})
+                else:
+                    self.sent.append((target, message))
+        return blobcopy_dispatch.failed_entries({'Failed': failed})
+
+    def delivered(self, target):
+        return sorted(message for sent_target, message in self.sent if sent_target == target)
+
+def messages(count, size=10):
+    return ['%0*d' % (size, number) for number in range(count)]
+
+def test_batches_of_ten_per_target():
+    backend = Backend()
+    dispatcher = BatchDispatcher(backend)
+    for message in messages(25):
+        dispatcher.add('download', message)
+    dispatcher.add('large', 'x')
+    dispatcher.close()
+    assert sorted(len(batch) for target, batch in backend.batches if target == 'download') == [5, 10, 10]
+    assert backend.delivered('large') == ['x']
+    assert dispatcher.sent == 26
+
+def test_only_failed_entries_are_retried():
+    backend = Backend({'0000000003': 2})
+    dispatcher = BatchDispatcher(backend)
+    for message in messages(10):
+        dispatcher.add('download', message)
+    dispatcher.close()
+    assert [len(batch) for _, batch in backend.batches] == [10, 1, 1]
+    assert backend.batches[1][1] == ['0000000003']
+    assert dispatcher.sent == 10
+    assert dispatcher.calls == 3
+
+def test_entries_failing_every_attempt_are_surfaced_by_drain():
+    backend = Backend({'0000000003': 10})
+    dispatcher = BatchDispatcher(backend, max_attempts=3)
+    for message in messages(10):
+        dispatcher.add('download', message)
+    with pytest.raises(RuntimeError, match='after 3 attempts for 1 messages'):
+        dispatcher.drain()
+    assert dispatcher.sent == 9
+    # The error stays for every later drain, the finder does not checkpoint past lost messages
+    with pytest.raises(RuntimeError):
+        dispatcher.close()
+
+def test_sender_faults_are_not_retried():
+    backend = Backend(sender_fault=('0000000001',))
+    dispatcher = BatchDispatcher(backend)
+    for message in messages(2):
+        dispatcher.add('download', message)
+    with pytest.raises(RuntimeError, match='Dispatch rejected: InvalidParameter'):
+        dispatcher.drain()
+    assert len(backend.batches) == 1
+
+def test_batches_stay_under_the_request_size():
+    backend = Backend()
+    dispatcher = BatchDispatcher(backend)
+    size = MAX_BATCH_BYTES // 3 + 1
+    for message in messages(7, size):
+        dispatcher.add('download', message)
+    dispatcher.close()
+    assert [len(batch) for _, batch in backend.batches] == [2, 2, 2, 1]
+    assert all(sum(len(message) for message in batch) <= MAX_BATCH_BYTES for _, batch in backend.batches)
+    # A message of the maximum size is sent on its own
+    backend = Backend()
+    dispatcher = BatchDispatcher(backend)
+    dispatcher.add('download', 'a')
+    dispatcher.add('download', 'b' * MAX_BATCH_BYTES)
+    dispatcher.add('download', 'c')
+    dispatcher.close()
+    assert [batch for _, batch in backend.batches] == [['a'], ['b' * MAX_BATCH_BYTES], ['c']]
+
+def test_sns_size_counts_the_escaped_message():
+    message = json.dumps({'blob': 'a"b'})
+    assert SnsBatchBackend.entry_size(None, message) == len(json.dumps({'default': message}))
+    assert SnsBatchBackend.entry_size(None, message) > SqsBatchBackend.entry_size(None, message)
+
+def test_drain_sends_partial_packs_and_waits_for_every_batch():
+    backend = Backend()
+    dispatcher = BatchDispatcher(backend, pack_size=3, pack_max_size=100)
+    for number in range(4):
+        dispatcher.add_packed('download', json.dumps({'blob': str(number)}), 10)
+    dispatcher.add_packed('download', json.dumps({'blob': 'large'}), 1000)
+    assert len(backend.batches) == 0
+    dispatcher.drain()
+    sent = [json.loads(message) for _, batch in backend.batches for message in batch]
+    assert sorted(len(message.get('batch', [message])) for message in sent) == [1, 1, 3]
+    # A drain with nothing buffered returns at once, the dispatcher keeps working after it
+    dispatcher.drain()
+    dispatcher.add('download', 'next')
+    dispatcher.close()
+    assert 'next' in backend.delivered('download')
+
+def test_concurrent_producers_drain_every_message():
+    backend = Backend({'0000000005': 1, '0000000050': 1})
+    dispatcher = BatchDispatcher(backend, concurrency=2)
+    batches = [messages(100)[start::4] for start in range(4)]
+    threads = [threading.Thread(target=lambda batch=batch: [dispatcher.add('download', message) for message in batch]) for batch in batches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    dispatcher.drain()
+    assert backend.delivered('download') == messages(100)
+    dispatcher.close()
+
+class Sqs:
+
+    def __init__(self):
+        self.requests = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.requests.append((QueueUrl, Entries))
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+def test_sqs_backend_sends_to_the_queues_of_the_secret(monkeypatch):
+    from blobcopy_clients import clients
+    sqs = Sqs()
+    monkeypatch.setitem(clients, ('boto3', 'sqs'), sqs)
+    values = {'dispatchBackend': 'sqs', 'sqs_url_l2': 'https://sqs/download', 'sqs_url_l3': 'https://sqs/init', 'packBlobs': '1'}
+    dispatcher = get_dispatcher(values)
+    download, large = blobcopy_dispatch.dispatch_targets(values)
+    dispatcher.add(download, '{"blob":"a"}')
+    dispatcher.add(large, '{"blob":"b"}')
+    dispatcher.close()
+    assert sorted((url, entries[0]['MessageBody']) for url, entries in sqs.requests) == [('https://sqs/download', '{"blob":"a"}'), ('https://sqs/init', '{"blob":"b"}')]
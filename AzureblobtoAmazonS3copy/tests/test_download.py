@@ -0,0 +1,80 @@
+import importlib.util
+import json
+import os
+import pytest
+
+pytest.importorskip('boto3')
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+class Sqs:
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds):
+        self.sent.append((QueueUrl, json.loads(MessageBody), DelaySeconds))
+
+class Sns:
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, TargetArn, Message, MessageStructure=None):
+        self.published.append((TargetArn, json.loads(json.loads(Message)['default'])))
+
+@pytest.fixture
+def download(monkeypatch):
+    pytest.importorskip('azure.storage.blob')
+    from blobcopy_clients import clients
+    from blobcopy_message import config_cache
+    spec = importlib.util.spec_from_file_location('blobcopy_download', os.path.join(SRC, 'blobcopy-download.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    def copy_blob(values, context, metrics):
+        if values['blob'].startswith('fail'):
+            raise RuntimeError('ServerBusy')
+    monkeypatch.setattr(module, 'copy_blob', copy_blob)
+    monkeypatch.setitem(clients, ('boto3', 'sqs'), Sqs())
+    monkeypatch.setitem(clients, ('boto3', 'sns'), Sns())
+    config = {'sqs_url_l2': 'https://sqs/download', 'sns_arn_l2': 'arn:l2', 'sns_arn_dlq': 'arn:dlq'}
+    config_cache['arn:download'] = (float('inf'), config)
+    yield module, config
+    config_cache.pop('arn:download', None)
+
+def sns_record(message):
+    return {'EventSource': 'aws:sns', 'Sns': {'Message': json.dumps(message)}}
+
+def blob(name):
+    return {'container': 'c', 'blob': name, 'size': 10, 'config_ref': 'arn:download'}
+
+def test_failed_blobs_of_an_sns_record_go_through_the_download_queue(download):
+    module, _ = download
+    from blobcopy_clients import clients
+    message = {'v': 1, 'batch': [blob('a.csv'), blob('fail-1.csv'), blob('fail-2.csv')]}
+    result = module.lambda_handler({'Records': [sns_record(message)]}, None)
+    assert json.loads(result['body']) == {'copied': 1, 'failed': 2}
+    [(queue, retry, delay)] = clients[('boto3', 'sqs')].sent
+    assert queue == 'https://sqs/download'
+    assert [item['blob'] for item in retry['batch']] == ['fail-1.csv', 'fail-2.csv']
+    assert retry['attempt'] == 1
+    assert 0 <= delay <= 900
+    assert clients[('boto3', 'sns')].published == []
+
+def test_retries_are_published_to_the_topic_without_a_download_queue(download):
+    module, config = download
+    from blobcopy_clients import clients
+    del config['sqs_url_l2']
+    module.lambda_handler({'Records': [sns_record(blob('fail.csv'))]}, None)
+    assert clients[('boto3', 'sns')].published == [('arn:l2', dict(blob('fail.csv'), attempt=1))]
+    assert clients[('boto3', 'sqs')].sent == []
+
+def test_exhausted_retries_go_to_the_dead_letter_topic(download):
+    module, _ = download
+    from blobcopy_clients import clients
+    module.lambda_handler({'Records': [sns_record(dict(blob('fail.csv'), attempt=4))]}, None)
+    [(topic, dead)] = clients[('boto3', 'sns')].published
+    assert topic == 'arn:dlq'
+    assert dead['error'] == 'ServerBusy'
+    assert clients[('boto3', 'sqs')].sent == []
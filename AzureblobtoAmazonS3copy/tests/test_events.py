@@ -0,0 +1,226 @@
+import base64
+import importlib.util
+import json
+import os
+from datetime import datetime, timezone
+import pytest
+
+pytest.importorskip('boto3')
+from blobcopy_events import SqliteEventQueue
+from blobcopy_inventory import InventoryBlob, InventoryContentSettings
+from blobcopy_manifest import SqliteManifestStore
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+ACCOUNT = 'https://account.blob.core.windows.net'
+
+def load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SRC, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Sample deliveries of an Event Grid subscription on a storage account
+def blob_event(event_type, container, name, account=ACCOUNT):
+    return {
+        'topic': '/subscriptions/0000/resourceGroups/rg/providers/Microsoft.Storage/storageAccounts/account',
+        'subject': '/blobServices/default/containers/' + container + '/blobs/' + name,
+        'eventType': event_type,
+        'eventTime': '2024-03-01T10:00:00.1234567Z',
+        'id': container + '/' + name,
+        'data': {'api': 'PutBlob', 'contentType': 'text/csv', 'contentLength': 100, 'blobType': 'BlockBlob',
+                 'url': account + '/' + container + '/' + name},
+        'dataVersion': '',
+        'metadataVersion': '1'
+    }
+
+VALIDATION = {
+    'id': '2d1781af-3a4c-4d7c-bd0c-e34b19da4e66',
+    'topic': '/subscriptions/0000/resourceGroups/rg/providers/Microsoft.Storage/storageAccounts/account',
+    'subject': '',
+    'data': {'validationCode': '512d38b6-c7b8-40c8-89fe-f46f9e9622b6',
+             'validationUrl': 'https://rp-eastus2.eventgrid.azure.net:553/eventsubscriptions/sub/validate?id=512d38b6'},
+    'eventType': 'Microsoft.EventGrid.SubscriptionValidationEvent',
+    'eventTime': '2024-03-01T10:00:00.1234567Z',
+    'metadataVersion': '1',
+    'dataVersion': '1'
+}
+
+# Lambda function URL request (payload format 2.0)
+def request(body, key='secret-key', method='POST', headers=None, encoded=False):
+    body = json.dumps(body)
+    return {
+        'version': '2.0',
+        'rawPath': '/',
+        'queryStringParameters': {'key': key} if key is not None else None,
+        'headers': headers or {'content-type': 'application/json', 'aeg-event-type': 'Notification'},
+        'requestContext': {'http': {'method': method}},
+        'body': base64.b64encode(body.encode('utf-8')).decode('ascii') if encoded else body,
+        'isBase64Encoded': encoded
+    }
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    from blobcopy_message import config_cache
+    config = {'eventGridKey': 'secret-key', 'eventQueue': 'sqlite', 'eventQueuePath': str(tmp_path / 'events.db'),
+              'bloburl': ACCOUNT, 'oauth_url': ACCOUNT, 'secret_arn': 'arn:events', 'bucket_name': 'target',
+              'sns_arn_l2': 'l2', 'sns_arn_l3': 'l3', 'includeContainers': 'costs', 'manifestStore': 'sqlite',
+              'manifestPath': str(tmp_path / 'manifest.db')}
+    config_cache['arn:events'] = (float('inf'), config)
+    monkeypatch.setenv('secret', 'arn:events')
+    monkeypatch.setenv('partitionSize', '104857600')
+    monkeypatch.setenv('maxPartitionsPerFile', '10000')
+    monkeypatch.setenv('UseFullFilePath', 'true')
+    yield config
+    config_cache.pop('arn:events', None)
+
+@pytest.fixture
+def relay(config):
+    return load('blobcopy_event_relay', 'blobcopy-event-relay.py')
+
+def queued(config):
+    return SqliteEventQueue(config['eventQueuePath']).receive(100)
+
+def test_subscription_validation_handshake(relay, config):
+    result = relay.lambda_handler(request([VALIDATION]), None)
+    assert result['statusCode'] == 200
+    assert json.loads(result['body']) == {'validationResponse': '512d38b6-c7b8-40c8-89fe-f46f9e9622b6'}
+    assert queued(config) == []
+
+def test_cloudevents_validation_handshake(relay):
+    result = relay.lambda_handler(request(None, method='OPTIONS', headers={'WebHook-Request-Origin': 'eventgrid.azure.net'}), None)
+    assert result['statusCode'] == 200
+    assert result['headers']['WebHook-Allowed-Origin'] == 'eventgrid.azure.net'
+
+@pytest.mark.parametrize('key', [None, '', 'wrong-key', 'secret-key-2'])
+def test_deliveries_without_the_event_grid_key_are_rejected(relay, config, key):
+    # The function URL has no AWS authentication, the key is the only check, handshakes included
+    for body in ([VALIDATION], [blob_event('Microsoft.Storage.BlobCreated', 'costs', 'a.csv')]):
+        result = relay.lambda_handler(request(body, key=key), None)
+        assert result['statusCode'] == 403
+    assert queued(config) == []
+
+def test_every_delivery_is_rejected_until_the_key_is_set(relay, config):
+    del config['eventGridKey']
+    assert relay.lambda_handler(request([VALIDATION], key=''), None)['statusCode'] == 403
+
+def test_only_blob_events_are_relayed(relay, config):
+    events = [blob_event('Microsoft.Storage.BlobCreated', 'costs', 'daily/a.csv'),
+              blob_event('Microsoft.Storage.BlobTierChanged', 'costs', 'daily/a.csv'),
+              blob_event('Microsoft.Storage.BlobDeleted', 'costs', 'daily/b.csv')]
+    result = relay.lambda_handler(request(events, encoded=True), None)
+    assert json.loads(result['body']) == {'relayed': 2}
+    assert [json.loads(record['body'])['id'] for record in queued(config)] == ['costs/daily/a.csv', 'costs/daily/b.csv']
+
+def test_single_cloudevent_is_relayed(relay, config):
+    event = {'specversion': '1.0', 'type': 'Microsoft.Storage.BlobCreated', 'source': '/subscriptions/0000', 'id': '1',
+             'time': '2024-03-01T10:00:00Z', 'subject': '/blobServices/default/containers/costs/blobs/a.csv',
+             'data': {'url': ACCOUNT + '/costs/a.csv', 'contentLength': 100}}
+    assert json.loads(relay.lambda_handler(request(event), None)['body']) == {'relayed': 1}
+    assert json.loads(queued(config)[0]['body'])['type'] == 'Microsoft.Storage.BlobCreated'
+
+class Dispatcher:
+
+    def __init__(self, fail=False):
+        self.sent = []
+        self.fail = fail
+
+    def count_blob(self, size):
+        pass
+
+    def add(self, target, message):
+        self.sent.append((target, json.loads(message)['blob']))
+
+    def add_packed(self, target, message, size):
+        self.add(target, message)
+
+    def close(self):
+        if self.fail:
+            raise RuntimeError('publish failed')
+
+    def put_metrics(self, metrics):
+        pass
+
+class BlobService:
+
+    def __init__(self, module, sizes):
+        self.module = module
+        self.sizes = sizes
+
+    def get_blob_client(self, container, name):
+        service = self
+
+        class BlobClient:
+            def get_blob_properties(self):
+                size = service.sizes.get(name)
+                if size is None:
+                    raise service.module.ResourceNotFoundError('The specified blob does not exist.')
+                if size < 0:
+                    raise RuntimeError('connection reset')
+                return InventoryBlob(container, name, size, '0x1', datetime(2024, 3, 1, 10, 0, tzinfo=timezone.utc),
+                                     InventoryContentSettings('text/csv', None, None, None))
+        return BlobClient()
+
+class S3:
+
+    def __init__(self):
+        self.deleted = []
+
+    def delete_objects(self, Bucket, Delete):
+        self.deleted += [item['Key'] for item in Delete['Objects']]
+
+@pytest.fixture
+def blob_events(config, monkeypatch):
+    pytest.importorskip('azure.core')
+    from blobcopy_clients import clients
+    module = load('blobcopy_blob_events', 'blobcopy-blob-events.py')
+    sizes = {'daily/a.csv': 100, 'daily/b.csv': -1}
+    monkeypatch.setattr(module, 'get_blob_service_client', lambda *args: BlobService(module, sizes))
+    monkeypatch.setitem(clients, ('boto3', 's3'), S3())
+    return module
+
+def manifest(config):
+    store = SqliteManifestStore(config['manifestPath'])
+    return store.conn.execute('SELECT scope, name, state FROM manifest').fetchall()
+
+def relayed_records(relay, config, events):
+    relay.lambda_handler(request(events), None)
+    return queued(config)
+
+def test_blob_events_are_copied_and_failures_reported(relay, blob_events, config, monkeypatch):
+    dispatcher = Dispatcher()
+    monkeypatch.setattr(blob_events, 'get_dispatcher', lambda values: dispatcher)
+    records = relayed_records(relay, config, [
+        blob_event('Microsoft.Storage.BlobCreated', 'costs', 'daily/a.csv'),
+        # Failed properties call, the event is delivered again
+        blob_event('Microsoft.Storage.BlobCreated', 'costs', 'daily/b.csv'),
+        # Deleted before the copy
+        blob_event('Microsoft.Storage.BlobCreated', 'costs', 'daily/c.csv'),
+        # Container and account outside of the copy
+        blob_event('Microsoft.Storage.BlobCreated', 'logs', 'daily/a.csv'),
+        blob_event('Microsoft.Storage.BlobCreated', 'costs', 'daily/a.csv', 'https://other.blob.core.windows.net'),
+        # Deletes are ignored by default
+        blob_event('Microsoft.Storage.BlobDeleted', 'costs', 'daily/d.csv')])
+    result = blob_events.lambda_handler({'Records': records}, None)
+    assert result == {'batchItemFailures': [{'itemIdentifier': records[1]['messageId']}]}
+    assert dispatcher.sent == [('l2', 'daily/a.csv')]
+    from blobcopy_clients import clients
+    assert clients[('boto3', 's3')].deleted == []
+    # The dispatched blob is in the manifest, the listing skips it
+    assert manifest(config) == [('costs', 'daily/a.csv', 'dispatched')]
+
+def test_deleted_blob_removes_its_copy(relay, blob_events, config, monkeypatch):
+    config['eventDeletes'] = 'delete'
+    monkeypatch.setattr(blob_events, 'get_dispatcher', lambda values: Dispatcher())
+    records = relayed_records(relay, config, [blob_event('Microsoft.Storage.BlobDeleted', 'costs', 'daily/d.csv')])
+    assert blob_events.lambda_handler({'Records': records}, None) == {'batchItemFailures': []}
+    from blobcopy_clients import clients
+    assert clients[('boto3', 's3')].deleted == ['daily/d.csv']
+
+def test_failed_dispatch_reports_every_dispatched_event(relay, blob_events, config, monkeypatch):
+    monkeypatch.setattr(blob_events, 'get_dispatcher', lambda values: Dispatcher(fail=True))
+    records = relayed_records(relay, config, [blob_event('Microsoft.Storage.BlobCreated', 'costs', 'daily/a.csv'),
+                                              blob_event('Microsoft.Storage.BlobCreated', 'logs', 'daily/a.csv')])
+    result = blob_events.lambda_handler({'Records': records}, None)
+    assert result == {'batchItemFailures': [{'itemIdentifier': records[0]['messageId']}]}
+    # Nothing is recorded, the redelivered event copies the blob
+    assert manifest(config) == []
@@ -0,0 +1,98 @@
+import sqlite3
+import types
+import pytest
+
+pytest.importorskip('boto3')
+import blobcopy_governor
+from blobcopy_governor import AzureGovernor, GovernorContended, SqliteGovernorStore, TokenBucket
+
+# Clock of the governor, sleeping moves it forward
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(blobcopy_governor, 'time', types.SimpleNamespace(time=clock.time, sleep=clock.sleep))
+    return clock
+
+def governor(tmp_path, rate=10.0, lease=10, max_wait=60, **store):
+    bucket = TokenBucket(rate, rate, 1.0, 1000.0, 1.0, 0.5, 10.0)
+    return AzureGovernor(SqliteGovernorStore(str(tmp_path / 'governor.db'), **store), 'account', bucket, lease, max_wait)
+
+def requests(governor, count):
+    for _ in range(count):
+        governor.before_request(None)
+
+def test_bucket_refills_at_the_rate(clock, tmp_path):
+    azure = governor(tmp_path)
+    # The burst is granted without waiting, leased in one store call
+    requests(azure, 10)
+    assert clock.slept == 0
+    clock.now += 0.5
+    requests(azure, 1)
+    assert clock.slept == 0
+    assert azure.leased == 4
+    # The next 40 requests wait for the refill at 10 requests/s
+    requests(azure, 4 + 40)
+    assert clock.slept == pytest.approx(4.0, abs=0.05)
+    assert azure.stats['requests'] == 55
+
+def test_buckets_are_shared_through_the_database(clock, tmp_path):
+    first, second = governor(tmp_path, lease=5), governor(tmp_path, lease=5)
+    requests(first, 5)
+    requests(second, 5)
+    # Both containers took from the same burst of 10
+    requests(second, 1)
+    assert clock.slept == pytest.approx(0.1, abs=0.01)
+
+class Response:
+
+    def __init__(self, status, code=''):
+        self.http_response = types.SimpleNamespace(status_code=status, headers={'x-ms-error-code': code})
+
+def test_throttling_halves_the_rate(clock, tmp_path):
+    azure = governor(tmp_path)
+    requests(azure, 10)
+    azure.after_response(Response(503, 'ServerBusy'))
+    assert azure.leased == 0
+    requests(azure, 10)
+    assert clock.slept == pytest.approx(2.0, abs=0.05)
+
+def test_wait_longer_than_the_max_wait_lets_the_request_go(clock, tmp_path):
+    azure = governor(tmp_path, rate=0.01, lease=1, max_wait=5)
+    requests(azure, 1)
+    # The next token is 100s away, the request goes ahead without waiting
+    requests(azure, 3)
+    assert clock.slept == 0
+    assert azure.leased == 0
+    assert azure.stats['requests'] == 4
+
+def test_locked_database_is_contended(tmp_path):
+    store = SqliteGovernorStore(str(tmp_path / 'governor.db'), busy_timeout=0.05)
+    holder = sqlite3.connect(str(tmp_path / 'governor.db'), isolation_level=None)
+    holder.execute('BEGIN IMMEDIATE')
+    try:
+        bucket = TokenBucket(10.0, 10.0, 1.0, 1000.0, 1.0, 0.5, 10.0)
+        with pytest.raises(GovernorContended):
+            store.update('account', bucket, lambda state, now: (state, None))
+        # The governor does not block the request on a contended bucket
+        azure = AzureGovernor(store, 'account', bucket)
+        azure.before_request(None)
+        azure.after_response(Response(503, 'ServerBusy'))
+        assert azure.stats == {'requests': 1, 'throttled': 1, 'waited_seconds': 0.0}
+    finally:
+        holder.execute('ROLLBACK')
+    # The store works again once the database is released
+    state, _ = store.update('account', bucket, lambda state, now: (state, None))
+    assert state.rate == 10.0
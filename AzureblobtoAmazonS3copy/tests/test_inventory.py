@@ -0,0 +1,156 @@
+import base64
+import csv
+import importlib.util
+import json
+import os
+from datetime import datetime, timezone
+import pytest
+from blobcopy_filter import BlobFilter
+from blobcopy_inventory import LocalInventorySource, manifest_files, parse_inventory_date, row_to_blob
+from blobcopy_planner import PartPlanner
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+FIELDS = ['Name', 'Creation-Time', 'Last-Modified', 'Etag', 'Content-Length', 'Content-Type', 'Content-MD5', 'hdi_isfolder']
+
+ROWS = [
+    {'Name': 'data/logs/2024/a.csv', 'Last-Modified': '2024-03-01T10:00:00.1234567Z', 'Etag': '0x1', 'Content-Length': '100',
+     'Content-Type': 'text/csv', 'Content-MD5': base64.b64encode(b'0123456789abcdef').decode()},
+    {'Name': 'data/logs/2023/b.csv', 'Last-Modified': '2023-06-01T10:00:00Z', 'Etag': '0x2', 'Content-Length': '200'},
+    {'Name': 'data/images/c.png', 'Last-Modified': 'Fri, 01 Mar 2024 10:00:00 GMT', 'Etag': '0x3', 'Content-Length': '300'},
+    {'Name': 'data/logs', 'Last-Modified': '2024-03-01T10:00:00Z', 'Etag': '0x4', 'Content-Length': '0', 'hdi_isfolder': 'true'},
+    {'Name': 'other/logs/d.csv', 'Last-Modified': '2024-03-01T10:00:00Z', 'Etag': '0x5', 'Content-Length': '400'},
+]
+
+# A report run as Azure writes it to the inventory container, the manifest paths start with the container name
+def write_report(root, run, files, rule='azs3copy'):
+    folder = os.path.join(root, run)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, rule + '-manifest.json'), 'w') as manifest:
+        json.dump({'files': [{'blob': 'inventory/' + name} for name in files]}, manifest)
+    return folder
+
+def write_csv(folder, name, rows):
+    with open(os.path.join(folder, name), 'w', newline='') as report:
+        writer = csv.DictWriter(report, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+@pytest.fixture
+def csv_report(tmp_path):
+    folder = write_report(str(tmp_path), '2024/03/02/01-00-00', ['2024/03/02/01-00-00/azs3copy_1.csv', '2024/03/02/01-00-00/azs3copy_2.csv'])
+    write_csv(folder, 'azs3copy_1.csv', ROWS[:3])
+    write_csv(folder, 'azs3copy_2.csv', ROWS[3:])
+    return str(tmp_path)
+
+def test_latest_manifest_is_the_newest_run(csv_report):
+    write_report(csv_report, '2024/03/01/01-00-00', [])
+    source = LocalInventorySource(csv_report, 'azs3copy')
+    assert source.latest_manifest() == os.path.join('2024', '03', '02', '01-00-00', 'azs3copy-manifest.json')
+    assert LocalInventorySource(csv_report, 'other').latest_manifest() is None
+
+def test_manifest_files_drop_the_inventory_container(csv_report):
+    source = LocalInventorySource(csv_report, 'azs3copy')
+    files = manifest_files(source.manifest(source.latest_manifest()), 'inventory')
+    assert files == ['2024/03/02/01-00-00/azs3copy_1.csv', '2024/03/02/01-00-00/azs3copy_2.csv']
+
+def test_csv_rows_become_blobs(csv_report):
+    source = LocalInventorySource(csv_report, 'azs3copy')
+    blobs = [row_to_blob(row) for row in source.rows('2024/03/02/01-00-00/azs3copy_1.csv')]
+    assert [(blob.container, blob.name, blob.size, blob.etag) for blob in blobs] == [
+        ('data', 'logs/2024/a.csv', 100, '0x1'), ('data', 'logs/2023/b.csv', 200, '0x2'), ('data', 'images/c.png', 300, '0x3')]
+    # Seven fraction digits are cut to microseconds
+    assert blobs[0].last_modified == datetime(2024, 3, 1, 10, 0, 0, 123456, tzinfo=timezone.utc)
+    assert blobs[0].content_settings.content_type == 'text/csv'
+    assert blobs[0].content_settings.content_md5 == b'0123456789abcdef'
+    assert blobs[1].content_settings.content_type is None
+    assert blobs[2].last_modified == datetime(2024, 3, 1, 10, 0, 0, tzinfo=timezone.utc)
+
+def test_folders_are_skipped_and_the_container_can_be_set(csv_report):
+    source = LocalInventorySource(csv_report, 'azs3copy')
+    rows = list(source.rows('2024/03/02/01-00-00/azs3copy_2.csv'))
+    assert row_to_blob(rows[0]) is None
+    blob = row_to_blob(rows[1], 'fixed')
+    assert (blob.container, blob.name) == ('fixed', 'other/logs/d.csv')
+
+def test_parquet_rows_become_blobs(tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    folder = write_report(str(tmp_path), '2024/03/02/01-00-00', ['2024/03/02/01-00-00/azs3copy_1.parquet'])
+    table = pa.table({
+        'Name': ['data/logs/2024/a.csv', 'data/logs'],
+        'Last-Modified': [datetime(2024, 3, 1, 10, 0, 0), datetime(2024, 3, 1, 10, 0, 0)],
+        'Etag': ['0x1', '0x4'],
+        'Content-Length': [100, 0],
+        'Content-Type': ['text/csv', None],
+        'hdi_isfolder': [False, True],
+    })
+    pq.write_table(table, os.path.join(folder, 'azs3copy_1.parquet'))
+    source = LocalInventorySource(str(tmp_path), 'azs3copy')
+    name, = manifest_files(source.manifest(source.latest_manifest()), 'inventory')
+    blobs = [row_to_blob(row) for row in source.rows(name)]
+    assert blobs[1] is None
+    assert (blobs[0].container, blobs[0].name, blobs[0].size, blobs[0].etag) == ('data', 'logs/2024/a.csv', 100, '0x1')
+    # Parquet datetimes without a zone are UTC
+    assert blobs[0].last_modified == datetime(2024, 3, 1, 10, 0, 0, tzinfo=timezone.utc)
+    assert blobs[0].content_settings.content_type == 'text/csv'
+
+def test_inventory_dates():
+    assert parse_inventory_date('2024-03-01T10:00:00Z') == datetime(2024, 3, 1, 10, tzinfo=timezone.utc)
+    assert parse_inventory_date('2024-03-01T10:00:00.5Z') == datetime(2024, 3, 1, 10, 0, 0, 500000, tzinfo=timezone.utc)
+    assert parse_inventory_date('Fri, 01 Mar 2024 10:00:00 GMT') == datetime(2024, 3, 1, 10, tzinfo=timezone.utc)
+
+# Messages queued by the finder, in the order they were added
+class FakeDispatcher:
+
+    def __init__(self):
+        self.messages = []
+
+    def count_blob(self, size):
+        pass
+
+    def add(self, target, message):
+        self.messages.append((target, json.loads(message)))
+
+    def add_packed(self, target, message, size):
+        self.add(target, message)
+
+    def drain(self):
+        pass
+
+class Context:
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+@pytest.fixture
+def find_blobs():
+    pytest.importorskip('boto3')
+    pytest.importorskip('azure.storage.blob')
+    spec = importlib.util.spec_from_file_location('blobcopy_find_blobs', os.path.join(SRC, 'blobcopy-find-blobs.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run_inventory(find_blobs, report, tmp_path, begindate, **settings):
+    values = dict(settings, inventoryPath=report, checkpointStore='sqlite', checkpointPath=str(tmp_path / 'checkpoints.db'), run_id='run')
+    processStartDate = datetime.strptime(begindate, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    dispatcher = FakeDispatcher()
+    latestdate, finished = find_blobs.find_blobs_inventory(None, dispatcher, None, BlobFilter(values), values, 'run', Context(), processStartDate,
+                                                           processStartDate, PartPlanner(values), 'true', 'l2', 'l3')
+    assert finished
+    return latestdate, [(message['container'], message['blob']) for _, message in dispatcher.messages]
+
+def test_inventory_rows_filtered_by_prefix(find_blobs, csv_report, tmp_path):
+    _, sent = run_inventory(find_blobs, csv_report, tmp_path, '1911-01-01 00:00:00', includePrefixes='logs/')
+    assert sent == [('data', 'logs/2024/a.csv'), ('data', 'logs/2023/b.csv'), ('other', 'logs/d.csv')]
+
+def test_inventory_rows_filtered_by_begindate(find_blobs, csv_report, tmp_path):
+    latestdate, sent = run_inventory(find_blobs, csv_report, tmp_path, '2024-01-01 00:00:00', includeContainers='data')
+    assert sent == [('data', 'logs/2024/a.csv'), ('data', 'images/c.png')]
+    assert latestdate == datetime(2024, 3, 1, 10, 0, 0, tzinfo=timezone.utc)
+
+def test_inventory_report_is_read_once(find_blobs, csv_report, tmp_path):
+    run_inventory(find_blobs, csv_report, tmp_path, '1911-01-01 00:00:00')
+    _, sent = run_inventory(find_blobs, csv_report, tmp_path, '1911-01-01 00:00:00')
+    assert sent == []
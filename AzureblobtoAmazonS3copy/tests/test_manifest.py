@@ -0,0 +1,143 @@
+import gzip
+import io
+import time
+from datetime import datetime, timezone
+import pytest
+
+pytest.importorskip('boto3')
+from blobcopy_clients import clients
+from blobcopy_manifest import COPIED, DISPATCHED, S3ManifestStore, SqliteManifestStore, copied_buffer, flush_copied, record_copied
+
+class Blob:
+
+    def __init__(self, name, etag, size=10):
+        self.name = name
+        self.etag = etag
+        self.size = size
+        self.last_modified = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# Objects of one bucket, with the calls the manifest store makes
+class FakeS3:
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def delete_objects(self, Bucket, Delete, Quiet=True):
+        for item in Delete['Objects']:
+            self.objects.pop(item['Key'], None)
+
+    def get_paginator(self, name):
+        objects = self.objects
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                return [{'Contents': [{'Key': key} for key in sorted(objects) if key.startswith(Prefix)]}]
+        return Paginator()
+
+@pytest.fixture
+def s3():
+    fake = FakeS3()
+    clients[('boto3', 's3')] = fake
+    yield fake
+    clients.pop(('boto3', 's3'), None)
+    copied_buffer.clear()
+
+def test_commit_writes_only_the_new_entries(s3):
+    store = S3ManifestStore('bucket', compact_deltas=100)
+    manifest = store.open('container')
+    manifest.record(Blob('a', 'e1'))
+    manifest.commit()
+    manifest.record(Blob('b', 'e1'))
+    manifest.commit()
+    deltas = sorted(s3.objects)
+    assert len(deltas) == 2
+    assert b'"b"' in gzip.decompress(s3.objects[deltas[1]])
+    assert b'"a"' not in gzip.decompress(s3.objects[deltas[1]])
+    reopened = S3ManifestStore('bucket').open('container')
+    assert not reopened.needs_copy(Blob('a', 'e1'))
+    assert reopened.needs_copy(Blob('a', 'e2'))
+    assert reopened.needs_copy(Blob('c', 'e1'))
+
+def test_deltas_are_compacted(s3):
+    store = S3ManifestStore('bucket', compact_deltas=3)
+    manifest = store.open('container')
+    for name in 'abc':
+        manifest.record(Blob(name, 'e1'))
+        manifest.commit()
+        time.sleep(0.002)
+    reopened = S3ManifestStore('bucket', compact_deltas=3).open('container')
+    assert list(s3.objects) == ['_azs3copy/manifest/container/base.jsonl.gz']
+    assert all(not reopened.needs_copy(Blob(name, 'e1')) for name in 'abc')
+
+def test_shards_of_a_container_share_the_entries(s3):
+    store = S3ManifestStore('bucket')
+    first = store.open('container')
+    first.record(Blob('a', 'e1'))
+    first.commit()
+    assert not store.open('container').needs_copy(Blob('a', 'e1'))
+
+def test_stale_dispatch_is_sent_again(s3):
+    store = S3ManifestStore('bucket', resend_seconds=0)
+    manifest = store.open('container')
+    manifest.record(Blob('a', 'e1'))
+    manifest.commit()
+    time.sleep(0.01)
+    assert S3ManifestStore('bucket', resend_seconds=3600).open('container').needs_copy(Blob('a', 'e1')) is False
+    assert S3ManifestStore('bucket', resend_seconds=-1).open('container').needs_copy(Blob('a', 'e1'))
+
+def test_copy_completion_wins_over_a_later_dispatch(s3):
+    values = {'manifestStore': 's3', 'bucket_name': 'bucket', 'manifestResendHours': '-1', 'manifestFlushEntries': '1'}
+    record_copied(values, [{'container': 'container', 'blob': 'a', 'etag': 'e1', 'size': 10, 'lastmodified': '2024-01-01 00:00:00'}])
+    time.sleep(0.002)
+    store = S3ManifestStore('bucket', resend_seconds=-1)
+    manifest = store.open('container')
+    assert manifest.lookup('a')[3] == COPIED
+    manifest.record(Blob('a', 'e1'), DISPATCHED)
+    manifest.commit()
+    reopened = S3ManifestStore('bucket', resend_seconds=-1).open('container')
+    assert reopened.lookup('a')[3] == COPIED
+    assert not reopened.needs_copy(Blob('a', 'e1'))
+
+def copied(name):
+    return {'container': 'container', 'blob': name, 'etag': 'e1', 'size': 10, 'lastmodified': '2024-01-01 00:00:00'}
+
+def test_copies_of_several_invocations_share_a_delta(s3):
+    values = {'manifestStore': 's3', 'bucket_name': 'bucket', 'manifestFlushEntries': '3'}
+    record_copied(values, [copied('a')])
+    record_copied(values, [copied('b')])
+    assert s3.objects == {}
+    record_copied(values, [copied('c'), copied('d')])
+    delta, = s3.objects
+    assert [line.split(b',')[0] for line in gzip.decompress(s3.objects[delta]).splitlines()] == [b'["a"', b'["b"', b'["c"', b'["d"']
+    # The entries of the next invocations wait for the next delta, or for the end of the run
+    record_copied(values, [copied('e')])
+    assert len(s3.objects) == 1
+    flush_copied()
+    assert len(s3.objects) == 2
+    manifest = S3ManifestStore('bucket').open('container')
+    assert all(manifest.lookup(name)[3] == COPIED for name in 'abcde')
+
+def test_old_buffered_copies_are_written(s3):
+    values = {'manifestStore': 's3', 'bucket_name': 'bucket', 'manifestFlushSeconds': '0'}
+    record_copied(values, [copied('a')])
+    assert len(s3.objects) == 1
+
+def test_sqlite_manifest(tmp_path):
+    store = SqliteManifestStore(str(tmp_path / 'manifest.db'), resend_seconds=-1)
+    manifest = store.open('container')
+    manifest.record(Blob('a', 'e1'))
+    manifest.commit()
+    assert store.open('container').needs_copy(Blob('a', 'e1'))
+    record_copied({'manifestStore': 'sqlite', 'manifestPath': str(tmp_path / 'manifest.db')},
+                  [{'container': 'container', 'blob': 'a', 'etag': 'e1', 'size': 10, 'lastmodified': '2024-01-01 00:00:00'}])
+    manifest = store.open('container')
+    assert not manifest.needs_copy(Blob('a', 'e1'))
+    manifest.record(Blob('a', 'e1'))
+    manifest.commit()
+    assert store.open('container').lookup('a')[3] == COPIED
+    assert store.open('container').needs_copy(Blob('a', 'e2'))
@@ -0,0 +1,78 @@
+import importlib.util
+import os
+import re
+import subprocess
+import sys
+import zipfile
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+spec = importlib.util.spec_from_file_location('blobcopy_build_zips', os.path.join(SRC, 'blobcopy-build-zips.py'))
+build_zips = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(build_zips)
+
+def test_zips_hold_the_handler_and_its_shared_modules():
+    for path, handler in build_zips.ZIPS.items():
+        with zipfile.ZipFile(os.path.join(build_zips.ROOT, path)) as archive:
+            assert archive.namelist() == build_zips.zip_files(handler), path
+
+# Every commit that changes a handler or a shared module rebuilds its zips
+def test_committed_zips_and_readme_table_are_up_to_date():
+    assert build_zips.stale() == []
+
+def test_lazy_imports_are_packaged():
+    # The inventory reader is only imported in inventory mode
+    assert 'blobcopy_inventory.py' in build_zips.zip_files('blobcopy-find-blobs')
+    assert 'blobcopy_local.py' not in build_zips.zip_files('blobcopy-download')
+
+DASHBOARD = os.path.join(build_zips.ROOT, '..', 'CloudIntelligenceDashboardforAzure')
+
+# Handler -> zip of the functions of a CloudFormation stack
+def stack_functions(path):
+    with open(path) as stack:
+        text = stack.read()
+    return dict(re.findall(r'Handler: (\S+)\.lambda_handler.*?S3Key: (\S+\.zip)', text, re.S))
+
+def test_dashboard_stack_deploys_the_built_zips():
+    functions = stack_functions(os.path.join(DASHBOARD, 'CFN', 'cid-azure-stack.yaml'))
+    built = {os.path.basename(path): handler for path, handler in build_zips.ZIPS.items()}
+    for handler, key in functions.items():
+        assert built[key] == handler, key
+    with open(os.path.join(DASHBOARD, 'TF', 'cid-azure-azs3copy.tf')) as terraform:
+        for key in re.findall(r'filename\s+= "\.\./CFN/(cid-azure-lambda\d+\.zip)"', terraform.read()):
+            assert key in built
+
+def test_dashboard_secret_selects_the_latest_export():
+    with open(os.path.join(DASHBOARD, 'CFN', 'cid-azure-stack.yaml')) as stack:
+        text = stack.read()
+    assert '"exportSelection":"latest"' in text
+    assert '"keyPrefix":"azurecidraw/"' in text
+    with open(os.path.join(DASHBOARD, 'TF', 'cid-azure-azs3copy.tf')) as terraform:
+        text = terraform.read()
+    assert re.search(r'^\s+exportSelection = "latest"$', text, re.M)
+    assert re.search(r'^\s+keyPrefix\s+= "azurecidraw/"$', text, re.M)
+
+# Imports the finder of the dashboard the way lambda does, from the root of its zip only
+def test_dashboard_finder_loads_the_export_selector(tmp_path):
+    pytest.importorskip('boto3')
+    pytest.importorskip('azure.storage.blob')
+    functions = stack_functions(os.path.join(DASHBOARD, 'CFN', 'cid-azure-stack.yaml'))
+    with zipfile.ZipFile(os.path.join(DASHBOARD, 'CFN', functions['blobcopy-find-blobs'])) as archive:
+        archive.extractall(str(tmp_path))
+    script = ('import importlib.util, sys\n'
+              'sys.path.insert(0, sys.argv[1])\n'
+              'spec = importlib.util.spec_from_file_location("handler", sys.argv[1] + "/blobcopy-find-blobs.py")\n'
+              'handler = importlib.util.module_from_spec(spec)\n'
+              'spec.loader.exec_module(handler)\n'
+              'import blobcopy_exports, blobcopy_message\n'
+              'assert handler.ExportSelector is blobcopy_exports.ExportSelector\n'
+              'assert blobcopy_exports.__file__.startswith(sys.argv[1])\n'
+              'assert handler.ExportSelector({"exportSelection": "latest"}).enabled\n'
+              'print(blobcopy_message.object_key("folder/export.csv", "true", "azurecidraw/"))\n')
+    # Only the zip, the SDKs of this interpreter and no src folder on the path
+    path = [entry for entry in sys.path if os.path.abspath(entry) != os.path.abspath(SRC)]
+    result = subprocess.run([sys.executable, '-c', script, str(tmp_path)], capture_output=True, text=True, cwd=str(tmp_path),
+                            env=dict(os.environ, PYTHONPATH=os.pathsep.join(path)))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == 'azurecidraw/folder/export.csv'
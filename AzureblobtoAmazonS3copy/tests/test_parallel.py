@@ -0,0 +1,95 @@
+import base64
+import hashlib
+import random
+import threading
+import time
+import pytest
+from blobcopy_checksum import OrderedMd5Verifier
+from blobcopy_parallel import copy_in_parts
+
+MIB = 1024 * 1024
+
+class Download:
+
+    def __init__(self, data):
+        self.data = data
+
+    def readall(self):
+        return self.data
+
+# Ranges finish out of order, like concurrent downloads from Azure
+class BlobClient:
+
+    def __init__(self, data):
+        self.data = data
+
+    def download_blob(self, offset, length, validate_content=False):
+        time.sleep(random.uniform(0, 0.02))
+        return Download(self.data[offset:offset + length])
+
+class S3:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parts = {}
+        self.created = None
+        self.completed = None
+        self.aborted = False
+
+    def create_multipart_upload(self, **kwargs):
+        self.created = kwargs
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        with self.lock:
+            self.parts[PartNumber] = Body
+        return {'ETag': '"%d"' % PartNumber}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = b''.join(self.parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+def md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+DATA = bytes(random.getrandbits(8) for _ in range(64 * 1024)) * 256
+
+def test_parallel_copy_compares_the_content_md5():
+    s3 = S3()
+    parts = copy_in_parts(BlobClient(DATA), s3, 'bucket', 'key', len(DATA), 5 * MIB, 4, '', content_md5=md5(DATA))
+    assert parts == 4
+    assert s3.completed == DATA
+    assert not s3.aborted
+
+def test_content_md5_mismatch_aborts_the_upload():
+    s3 = S3()
+    with pytest.raises(RuntimeError, match='Content-MD5 mismatch'):
+        copy_in_parts(BlobClient(DATA), s3, 'bucket', 'key', len(DATA), 5 * MIB, 4, '', content_md5=md5(b'other'))
+    assert s3.aborted
+    assert s3.completed is None
+
+class FailingBlobClient(BlobClient):
+
+    def download_blob(self, offset, length, validate_content=False):
+        if offset == 0:
+            time.sleep(0.05)
+            raise IOError('connection reset')
+        return super().download_blob(offset, length, validate_content)
+
+# The ranges after a failed one do not wait for it forever
+def test_failed_range_releases_the_waiting_ranges():
+    s3 = S3()
+    with pytest.raises(IOError):
+        copy_in_parts(FailingBlobClient(DATA), s3, 'bucket', 'key', len(DATA), 5 * MIB, 4, '', content_md5=md5(DATA))
+    assert s3.aborted
+
+def test_ranges_are_hashed_in_blob_order():
+    verifier = OrderedMd5Verifier(md5(b'abc'))
+    threads = [threading.Thread(target=verifier.update_part, args=(number, chunk)) for number, chunk in [(3, b'c'), (2, b'b'), (1, b'a')]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    verifier.finish()
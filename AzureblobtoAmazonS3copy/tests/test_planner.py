@@ -0,0 +1,87 @@
+import math
+import pytest
+from blobcopy_planner import MAX_OBJECT_SIZE, MAX_PART_SIZE, MAX_PARTS, MIB, MIN_PART_SIZE, PartPlanner, fits, plan_parts
+
+GIB = 1024 * MIB
+TIB = 1024 * GIB
+
+# Memory bound of the part function with the defaults (half of partMemoryMB)
+DEFAULT_UPPER = 1024 * MIB
+
+def test_small_blob_gets_the_smallest_part():
+    plan = plan_parts(10 * MIB, min_part_size=MIN_PART_SIZE, target_part_size=MIN_PART_SIZE)
+    assert plan.part_size == MIN_PART_SIZE
+    assert plan.part_count == 2
+
+def test_overhead_target_within_the_preferred_part_count():
+    # 50 MB/s and 1 s overhead at 10% give 450 MiB parts
+    plan = plan_parts(50 * GIB, max_parts=10000)
+    assert plan.part_size == 450 * MIB
+    assert plan.part_count == math.ceil(50 * GIB / (450 * MIB))
+
+@pytest.mark.parametrize('size', [100 * GIB, 200 * GIB, TIB, 5 * TIB])
+def test_max_parts_does_not_beat_the_memory_bound(size):
+    plan = plan_parts(size, max_parts=100)
+    assert plan.part_size <= DEFAULT_UPPER
+    assert plan.part_count <= MAX_PARTS
+    assert fits(size, plan.part_size)
+
+def test_max_parts_is_kept_when_parts_fit():
+    # 100 GiB in 100 parts is exactly the memory bound
+    plan = plan_parts(100 * GIB, max_parts=100)
+    assert plan.part_count == 100
+    assert plan.part_size == DEFAULT_UPPER
+
+def test_part_count_raised_past_max_parts():
+    plan = plan_parts(200 * GIB, max_parts=100)
+    assert plan.part_size == DEFAULT_UPPER
+    assert plan.part_count == 200
+
+def test_largest_object_within_the_part_limit():
+    plan = plan_parts(MAX_OBJECT_SIZE, max_parts=100)
+    assert plan.part_count <= MAX_PARTS
+    assert plan.part_size <= DEFAULT_UPPER
+
+def test_larger_than_an_object_is_rejected():
+    with pytest.raises(ValueError):
+        plan_parts(MAX_OBJECT_SIZE + 1)
+
+def test_parts_too_large_for_the_memory_are_rejected():
+    # 1 TiB needs parts of at least 105 MiB, a 128 MB function holds 64 MiB
+    with pytest.raises(ValueError, match='memory and timeout'):
+        plan_parts(TIB, memory_mb=128)
+
+def test_memory_bound_at_the_part_limit():
+    # 10,000 parts of exactly the memory bound fit, one more byte does not
+    plan_parts(10000 * 64 * MIB, memory_mb=128)
+    with pytest.raises(ValueError):
+        plan_parts(10000 * 64 * MIB + 1, memory_mb=128)
+
+def test_explicit_target_part_size():
+    plan = plan_parts(GIB, memory_mb=5120, target_part_size=64 * MIB, min_part_size=64 * MIB, shared_memory=True, max_concurrency=8)
+    assert plan.part_size == 64 * MIB
+    assert plan.part_count == 16
+    assert plan.concurrency == 8
+
+def test_explicit_target_raised_for_the_part_limit():
+    plan = plan_parts(TIB, memory_mb=5120, target_part_size=64 * MIB, min_part_size=64 * MIB)
+    assert plan.part_count <= MAX_PARTS
+    assert fits(TIB, plan.part_size)
+
+def test_shared_memory_limits_the_concurrency():
+    plan = plan_parts(20 * GIB, memory_mb=2048, target_part_size=512 * MIB, min_part_size=512 * MIB, shared_memory=True)
+    assert plan.concurrency == 2
+
+def test_fits():
+    assert fits(GIB, MIN_PART_SIZE)
+    assert not fits(GIB, MIN_PART_SIZE - 1)
+    assert not fits(MAX_OBJECT_SIZE, MAX_PART_SIZE // 10)
+    assert not fits(GIB, MAX_PART_SIZE + 1)
+
+def test_planner_settings():
+    planner = PartPlanner({'partitionSize': str(100 * MIB), 'maxPartitionsPerFile': '100', 'partMemoryMB': '2056'})
+    plan = planner.plan(TIB)
+    assert plan.part_size <= 1028 * MIB
+    assert fits(TIB, plan.part_size)
+    assert planner.is_large(3 * GIB)
+    assert not planner.is_large(GIB)
@@ -0,0 +1,96 @@
+import importlib.util
+import json
+import os
+import threading
+import pytest
+
+pytest.importorskip('boto3')
+from blobcopy_tracker import SqliteUploadTracker, get_upload_tracker
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'uploads.db')
+
+def test_duplicate_part_delivery_is_counted_once(path):
+    tracker = SqliteUploadTracker(path)
+    assert not tracker.record('upload', 1, '"e1"', 3)
+    assert not tracker.record('upload', 2, '"e2"', 3)
+    # Part 2 is delivered again, the upload still misses part 3
+    assert not tracker.record('upload', 2, '"e2"', 3)
+    assert tracker.record('upload', 3, '"e3"', 3)
+    # A redelivered part after the completion does not trigger the recombinator again
+    assert not tracker.record('upload', 3, '"e3"', 3)
+    assert [part['PartNumber'] for part in tracker.parts('upload')] == [1, 2, 3]
+
+# Parts finish at the same moment in separate functions, each with its own connection
+def test_one_part_completes_the_upload_under_concurrent_parts(path):
+    total = 16
+    SqliteUploadTracker(path)
+    start = threading.Barrier(total)
+    completed = []
+
+    def finish(part_number):
+        tracker = SqliteUploadTracker(path)
+        start.wait()
+        if tracker.record('upload', part_number, '"e%d"' % part_number, total):
+            completed.append(part_number)
+        # Every part is also delivered twice
+        if tracker.record('upload', part_number, '"e%d"' % part_number, total):
+            completed.append(part_number)
+
+    threads = [threading.Thread(target=finish, args=(number,)) for number in range(1, total + 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(completed) == 1
+    assert len(SqliteUploadTracker(path).parts('upload')) == total
+
+def test_etags_and_checksums_for_the_recombinator(path):
+    tracker = get_upload_tracker({'trackerStore': 'sqlite', 'trackerPath': path})
+    tracker.record('upload', 2, '"e2"', 2, {'ChecksumSHA256': 'c2'})
+    tracker.record('upload', 1, '"e1"', 2, {'ChecksumSHA256': 'c1'})
+    tracker.record('other', 1, '"x"', 5)
+    assert tracker.parts('upload') == [{'ETag': '"e1"', 'PartNumber': 1, 'ChecksumSHA256': 'c1'},
+                                       {'ETag': '"e2"', 'PartNumber': 2, 'ChecksumSHA256': 'c2'}]
+    tracker.clear('upload', 2)
+    assert tracker.parts('upload') == []
+    assert tracker.parts('other') == [{'ETag': '"x"', 'PartNumber': 1}]
+    # The upload id can be tracked again once cleared
+    assert tracker.record('upload', 1, '"e1"', 1)
+
+class S3:
+
+    def __init__(self):
+        self.completed = None
+
+    def complete_multipart_upload(self, Bucket, Key, MultipartUpload, UploadId):
+        self.completed = MultipartUpload['Parts']
+        return {}
+
+    def get_paginator(self, name):
+        raise AssertionError('the recombinator lists the parts although the tracker has them')
+
+def test_recombinator_completes_the_upload_with_the_tracked_etags(path):
+    from blobcopy_clients import clients
+    from blobcopy_message import config_cache
+    spec = importlib.util.spec_from_file_location('blobcopy_large_file_recombinator', os.path.join(SRC, 'blobcopy-large-file-recombinator.py'))
+    recombinator = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(recombinator)
+    tracker = SqliteUploadTracker(path)
+    for number in (3, 1, 2):
+        tracker.record('upload', number, '"e%d"' % number, 3, {'ChecksumSHA256': 'c%d' % number})
+    s3 = S3()
+    clients[('boto3', 's3')] = s3
+    config_cache['arn:tracker'] = (float('inf'), {'trackerStore': 'sqlite', 'trackerPath': path})
+    try:
+        message = {'bucket_name': 'bucket', 'blobkey': 'key', 'UploadId': 'upload', 'PartNumber': 3, 'total_parts': 3, 'config_ref': 'arn:tracker'}
+        recombinator.lambda_handler({'Records': [{'Sns': {'Message': json.dumps(message)}}]}, None)
+    finally:
+        clients.pop(('boto3', 's3'), None)
+        config_cache.pop('arn:tracker', None)
+    assert s3.completed == [{'ETag': '"e%d"' % number, 'PartNumber': number, 'ChecksumSHA256': 'c%d' % number} for number in (1, 2, 3)]
+    # The entries of the completed upload are removed
+    assert tracker.parts('upload') == []
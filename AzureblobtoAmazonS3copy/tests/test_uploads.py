@@ -0,0 +1,74 @@
+import importlib.util
+import os
+from datetime import datetime, timedelta, timezone
+import pytest
+from blobcopy_uploads import reap
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+OLD = datetime.now(timezone.utc) - timedelta(hours=100)
+NEW = datetime.now(timezone.utc) - timedelta(hours=1)
+
+# Incomplete uploads of a bucket shared with other jobs
+class S3:
+
+    def __init__(self):
+        self.uploads = [
+            {'Key': 'azurecidraw/a.csv', 'UploadId': '1', 'Initiated': OLD},
+            {'Key': 'azurecidraw/b.csv', 'UploadId': '2', 'Initiated': NEW},
+            {'Key': 'backups/c.tar', 'UploadId': '3', 'Initiated': OLD},
+        ]
+        self.aborted = []
+
+    def get_paginator(self, name):
+        uploads = self.uploads
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                return [{'Uploads': [upload for upload in uploads if upload['Key'].startswith(Prefix)]}]
+        return Paginator()
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append((Bucket, Key))
+
+def test_only_stale_uploads_under_the_prefix_are_reaped():
+    s3 = S3()
+    assert reap(s3, 'bucket', 72, 'azurecidraw/') == 1
+    assert s3.aborted == [('bucket', 'azurecidraw/a.csv')]
+
+class Context:
+
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+class Metrics:
+
+    def __init__(self):
+        self.values = {}
+
+    def put(self, name, value):
+        self.values[name] = value
+
+@pytest.fixture
+def launcher():
+    pytest.importorskip('boto3')
+    from blobcopy_clients import clients
+    spec = importlib.util.spec_from_file_location('blobcopy_launch_qualification', os.path.join(SRC, 'blobcopy-launch-qualification.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    s3 = S3()
+    clients[('boto3', 's3')] = s3
+    yield module, s3
+    clients.pop(('boto3', 's3'), None)
+
+def test_reaping_is_opt_in(launcher):
+    module, s3 = launcher
+    module.reap_buckets(Context(), {}, [{'bucket_name': 'bucket'}], Metrics())
+    assert s3.aborted == []
+    assert module.reap_reserve({}) == 15.0
+
+def test_reaping_keeps_to_the_key_prefix_of_every_account(launcher):
+    module, s3 = launcher
+    secrets = {'reapIncompleteUploads': 'true', 'bucket_name': 'bucket', 'keyPrefix': 'azurecidraw/'}
+    module.reap_buckets(Context(), secrets, [secrets, dict(secrets, bucket_name='other', reapPrefix='backups/')], Metrics())
+    assert s3.aborted == [('bucket', 'azurecidraw/a.csv'), ('other', 'backups/c.tar')]
@@ -68,6 +68,8 @@ resource "aws_secretsmanager_secret_version" "SecretsManagerSecret" {
     sns_arn_l3  = "${aws_sns_topic.SNSTopicLargeFileInit.arn}"
     sns_arn_l4  = "${aws_sns_topic.SNSTopicLargeFilePart.arn}"
     sns_arn_l5  = "${aws_sns_topic.SNSTopicLargeFileRecomb.arn}"
+    exportSelection = "latest"
+    keyPrefix   = "azurecidraw/"
   })
 }
 
@@ -87,6 +89,8 @@ resource "aws_secretsmanager_secret_version" "SecretsManagerSecret" {
 #     sns_arn_l3  = "${aws_sns_topic.SNSTopicLargeFileInit.arn}"
 #     sns_arn_l4  = "${aws_sns_topic.SNSTopicLargeFilePart.arn}"
 #     sns_arn_l5  = "${aws_sns_topic.SNSTopicLargeFileRecomb.arn}"
+#     exportSelection = "latest"
+#     keyPrefix   = "azurecidraw/"
 #   })
 # }
 
@@ -599,6 +599,17 @@ resource "aws_s3_bucket_lifecycle_configuration" "cidazure" {
     }
     status = "Enabled"
   }
+
+  # Uploads left behind by failed copies stop being billed, the initiator resumes younger ones (reapAfterHours)
+  rule {
+    id     = "AbortIncompleteMultipartUploads"
+
+    filter {}
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 3
+    }
+    status = "Enabled"
+  }
 }
 
 ### Generate Athena saved query. named query is for reference only and not used as part of automation